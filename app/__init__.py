@@ -6,9 +6,10 @@ from flasgger import Swagger
 from flask_cors import CORS
 
 from config import Config  # Загружаем класс конфигурации
+from app.utils.replicas import RoutingSession, replica_router
 import os
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 migrate = Migrate()
 
 def register_blueprints(app):
@@ -18,9 +19,9 @@ def register_blueprints(app):
     app.register_blueprint(device_bp, url_prefix='/device')
     app.register_blueprint(bp, url_prefix='/admin')
 
-def create_app():
+def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
     cors = CORS(
         app,
         resources={
@@ -39,6 +40,29 @@ def create_app():
 
     db.init_app(app)
     migrate.init_app(app, db)
+    replica_router.init_app(app)
+
+    # За прокси request.remote_addr - адрес прокси: лимит по IP был бы общим для всех
+    if app.config.get("TRUSTED_PROXY_HOPS"):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config["TRUSTED_PROXY_HOPS"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    from app.utils.rate_limit import rate_limiter
+    rate_limiter.init_app(app)
+
+    from app.utils.invalidation import invalidation_bus
+    invalidation_bus.init_app(app)
+
+    from app.utils.overdue import overdue_scheduler
+    overdue_scheduler.init_app(app)
+
+    from app.utils.jobs import job_runner
+    job_runner.init_app(app)
+
+    from app.utils.serializers import OrjsonProvider, orjson
+    if app.config.get("ORJSON_ENABLED", True) and orjson:
+        app.json = OrjsonProvider(app)
 
     swagger_template = {
         "swagger": "2.0",
@@ -66,11 +90,28 @@ def create_app():
 
     with app.app_context():
         from app import models
-        print("Creating all tables...")
-        db.create_all()
+        from app.utils.schema import ensure_change_log_version, ensure_operation_role, identities_migrated
+        # Новые таблицы ссылаются на pk: в базе со строковыми ключами
+        # их создаёт flask migrate-identities после миграции
+        if identities_migrated():
+            print("Creating all tables...")
+            db.create_all()
+            ensure_change_log_version()
+            ensure_operation_role()
+
+            from app.utils.holdings import ensure_holdings
+            ensure_holdings()
+
+            from app.utils.search import ensure_search_indexes
+            ensure_search_indexes()
+        else:
+            print("Schema uses string primary keys: run flask migrate-identities")
 
     register_blueprints(app)
 
+    from app.commands import register_commands
+    register_commands(app)
+
     return app
 
 
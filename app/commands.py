@@ -0,0 +1,126 @@
+import click
+from flask import current_app
+
+from app.utils.archive import archive_operations
+from app.utils.changes import prune_change_log
+from app.utils.consistency import check_consistency
+from app.utils.holdings import rebuild_holdings
+from app.utils.jobs import job_runner
+from app.utils.key_state import build_snapshots
+from app.utils.partitions import convert_operation_table, ensure_operation_partitions, drop_operation_partitions
+from app.utils.schema import migrate_identities
+from app.utils.synthetic import generate_data
+
+
+def register_commands(app):
+    @app.cli.command("archive-operations")
+    @click.option("--days", type=int, default=None, help="Архивировать операции старше N дней")
+    @click.option("--chunk-size", type=int, default=None, help="Сколько строк удалять за одну транзакцию")
+    def archive_operations_command(days, chunk_size):
+        """Перенести старые операции в сжатый архив (запускать по cron)."""
+        config = current_app.config
+        # Снимки строятся до удаления, иначе состояние ключей на даты
+        # из архива нельзя будет восстановить
+        build_snapshots(config["KEY_SNAPSHOT_HOURS"])
+        try:
+            archived = archive_operations(
+                config["ARCHIVE_DIR"],
+                days if days is not None else config["ARCHIVE_AFTER_DAYS"],
+                chunk_size or config["ARCHIVE_CHUNK_SIZE"],
+                progress=lambda done: click.echo(f"Archived {done} operations..."),
+            )
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Done: {archived} operations archived to {config['ARCHIVE_DIR']}")
+
+    @app.cli.command("partition-operations")
+    @click.option("--months-ahead", type=int, default=3, help="На сколько месяцев вперёд создавать секции")
+    def partition_operations_command(months_ahead):
+        """Секционировать таблицу operation по месяцам и создать будущие секции (запускать по cron)."""
+        try:
+            if convert_operation_table(months_ahead):
+                click.echo("Table operation converted to monthly partitions")
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        created = ensure_operation_partitions(months_ahead)
+        click.echo(f"Partitions created: {', '.join(created) or 'none'}")
+
+    @app.cli.command("migrate-identities")
+    def migrate_identities_command():
+        """Перевести первичные и внешние ключи на bigint pk (строковый id остаётся как public_id)."""
+        try:
+            before, after = migrate_identities()
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        for name in sorted(set(before) | set(after)):
+            click.echo(f"{name}: {before.get(name, 0)} -> {after.get(name, 0)} bytes")
+
+    @app.cli.command("drop-operation-partitions")
+    @click.option("--months", type=int, required=True, help="Удалить секции старше N месяцев")
+    def drop_operation_partitions_command(months):
+        """Удалить старые секции журнала операций (вместо массового DELETE)."""
+        dropped = drop_operation_partitions(months)
+        click.echo(f"Dropped: {', '.join(dropped) or 'nothing'}")
+
+    @app.cli.command("prune-change-log")
+    @click.option("--days", type=int, default=30, help="Удалить изменения старше N дней")
+    def prune_change_log_command(days):
+        """Очистить журнал изменений для синхронизации устройств."""
+        deleted = prune_change_log(days)
+        click.echo(f"Deleted {deleted} change log entries")
+
+    @app.cli.command("snapshot-key-state")
+    @click.option("--every-hours", type=int, default=None, help="Интервал между снимками в часах")
+    def snapshot_key_state_command(every_hours):
+        """Дописать снимки состояния ключей для запросов на момент времени (запускать по cron)."""
+        created = build_snapshots(
+            every_hours or current_app.config["KEY_SNAPSHOT_HOURS"],
+            progress=lambda at: click.echo(f"Snapshot at {at.isoformat()}"),
+        )
+        click.echo(f"Done: {created} snapshots created")
+
+    @app.cli.command("check-consistency")
+    @click.option("--repair", is_flag=True, help="Исправить ключи по журналу операций")
+    @click.option("--chunk-size", type=int, default=1000, help="Сколько ключей читать за один запрос")
+    def check_consistency_command(repair, chunk_size):
+        """Сверить состояние ключей и ячеек с журналом операций."""
+        counts = check_consistency(
+            repair=repair,
+            chunk_size=chunk_size,
+            report=lambda kind, entity_id, key_number: click.echo(f"{kind}: {entity_id} {key_number or ''}".rstrip()),
+        )
+        for name, value in sorted(counts.items()):
+            click.echo(f"{name}: {value}")
+
+    @app.cli.command("generate-data")
+    @click.option("--devices", type=int, default=1000, help="Число устройств")
+    @click.option("--slots-per-device", type=int, default=20, help="Ячеек в каждом устройстве")
+    @click.option("--keys", type=int, default=20000, help="Число ключей")
+    @click.option("--users", type=int, default=50000, help="Число пользователей")
+    @click.option("--roles", type=int, default=50, help="Число ролей")
+    @click.option("--operations", type=int, default=10_000_000, help="Примерное число операций")
+    @click.option("--days", type=int, default=365, help="За сколько дней строить журнал")
+    @click.option("--seed", type=int, default=None, help="Seed генератора (одинаковый seed - одинаковые данные)")
+    @click.option("--end", type=click.DateTime(), default=None,
+                  help="Конец журнала, UTC (по умолчанию с --seed - 2025-01-01, без него - текущее время)")
+    def generate_data_command(devices, slots_per_device, keys, users, roles, operations, days, seed, end):
+        """Заполнить пустую БД синтетическими данными для нагрузочных замеров."""
+        try:
+            created = generate_data(
+                devices=devices, slots_per_device=slots_per_device, keys=keys, users=users,
+                roles=roles, operations=operations, days=days, seed=seed, end=end, progress=click.echo,
+            )
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Done: {created} operations generated")
+
+    @app.cli.command("rebuild-holdings")
+    def rebuild_holdings_command():
+        """Пересобрать таблицу выданных ключей по состоянию ключей."""
+        click.echo(f"Done: {rebuild_holdings()} keys are taken")
+
+    @app.cli.command("run-jobs")
+    @click.option("--once", is_flag=True, help="Выполнить задачи из очереди и выйти")
+    def run_jobs_command(once):
+        """Выполнять фоновые задачи /admin/jobs/ в отдельном процессе."""
+        job_runner.run_pending(once=once, on_job=lambda job_id: click.echo(f"Running job {job_id}"))
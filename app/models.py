@@ -1,5 +1,6 @@
 #general commit
 from . import db
+from sqlalchemy.dialects import postgresql
 import uuid
 from datetime import datetime
 from enum import Enum
@@ -8,27 +9,49 @@ class OperationType(Enum):
     TAKE = "take"
     RETURN = "return"
 
+def id_type(length=None):
+    # В PostgreSQL идентификаторы сравниваются побайтно (collation "C"):
+    # индексы и соединения по ним дешевле, чем с локалезависимой сортировкой
+    return db.String(length).with_variant(postgresql.VARCHAR(length, collation="C"), "postgresql")
+
+
+def pk_type():
+    # bigint в PostgreSQL; в SQLite автоинкремент есть только у INTEGER PRIMARY KEY
+    return db.BigInteger().with_variant(db.Integer(), "sqlite")
+
+
+def public_id_column(length):
+    # Внешний 8-символьный идентификатор (в API, токенах устройств, журнале изменений).
+    # Первичный ключ и внешние ключи - целочисленный pk
+    return db.Column(
+        "public_id", id_type(length), unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8]
+    )
+
+
 class Role(db.Model):
-    id = db.Column(db.String(64), primary_key=True, unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8])
+    pk = db.Column(pk_type(), primary_key=True)
+    id = public_id_column(64)
     name = db.Column(db.String, unique=True, nullable=False)
     users = db.relationship('User', back_populates='role')
     assigned_keys = db.relationship('Key', back_populates='assigned_role')
 
 
 class User(db.Model):
-    id = db.Column(db.String(64), primary_key=True, unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8])
+    pk = db.Column(pk_type(), primary_key=True)
+    id = public_id_column(64)
     name = db.Column(db.String)
     nfc_tag = db.Column(db.String, unique=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    role_id = db.Column(db.String, db.ForeignKey('role.id'))
+    role_pk = db.Column(pk_type(), db.ForeignKey('role.pk'), index=True)
     role = db.relationship('Role', back_populates='users')
     used_keys = db.relationship('Key', back_populates='last_user')
     operations = db.relationship('Operation', back_populates='user')
 
 
 class Device(db.Model):
-    id = db.Column(db.String(64), primary_key=True, unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8])
+    pk = db.Column(pk_type(), primary_key=True)
+    id = public_id_column(64)
     ip_address = db.Column(db.String)
     auth_token = db.Column(db.String, unique=True)
     timeout = db.Column(db.Integer)
@@ -39,11 +62,18 @@ class Device(db.Model):
     operations = db.relationship('Operation', back_populates='device')
 
 
+class DeviceTokenRevocation(db.Model):
+    # Без внешнего ключа: запись должна пережить удаление устройства
+    device_id = db.Column(id_type(64), primary_key=True)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
 class KeySlot(db.Model):
-    id = db.Column(db.String(64), primary_key=True, unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8])
+    pk = db.Column(pk_type(), primary_key=True)
+    id = public_id_column(64)
     number = db.Column(db.Integer, nullable=False)
     is_locked = db.Column(db.Boolean, default=False)
-    device_id = db.Column(db.String, db.ForeignKey('device.id'), nullable=False)
+    device_pk = db.Column(pk_type(), db.ForeignKey('device.pk'), nullable=False)
     device = db.relationship('Device', back_populates='key_stores')
     key = db.relationship(
         'Key',
@@ -52,7 +82,7 @@ class KeySlot(db.Model):
         passive_deletes=True
     )
     __table_args__ = (
-        db.UniqueConstraint('number', 'device_id', name='uq_slot_per_device'),
+        db.UniqueConstraint('device_pk', 'number', name='uq_slot_per_device'),
     )
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -60,16 +90,17 @@ class KeySlot(db.Model):
 
 
 class Key(db.Model):
-    id = db.Column(db.String(40), primary_key=True, unique=True, nullable=False, default=lambda: uuid.uuid4().hex[:8])
+    pk = db.Column(pk_type(), primary_key=True)
+    id = public_id_column(40)
     key_number = db.Column(db.String(20), unique=True, nullable=False)
     is_taken = db.Column(db.Boolean, default=False)
-    key_slot_id = db.Column(db.String, db.ForeignKey('key_slot.id', ondelete='SET NULL'), nullable=True)
+    key_slot_pk = db.Column(pk_type(), db.ForeignKey('key_slot.pk', ondelete='SET NULL'), nullable=True, index=True)
     key_slot = db.relationship('KeySlot', back_populates='key', post_update=True)
-    assigned_role_id = db.Column(db.String, db.ForeignKey('role.id'), nullable=False)
+    assigned_role_pk = db.Column(pk_type(), db.ForeignKey('role.pk'), nullable=False, index=True)
     assigned_role = db.relationship('Role', back_populates='assigned_keys')
-    last_user_id = db.Column(db.String, db.ForeignKey('user.id'), nullable=True)
+    last_user_pk = db.Column(pk_type(), db.ForeignKey('user.pk'), nullable=True)
     last_user = db.relationship('User', back_populates='used_keys')
-    last_device_id = db.Column(db.String, db.ForeignKey('device.id'), nullable=True)
+    last_device_pk = db.Column(pk_type(), db.ForeignKey('device.pk'), nullable=True)
     last_device = db.relationship('Device', back_populates='used_keys')
     operations = db.relationship('Operation', back_populates='key')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -79,12 +110,79 @@ class Key(db.Model):
 
 class Operation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String, db.ForeignKey('user.id'))
-    key_id = db.Column(db.String, db.ForeignKey('key.id'))
-    device_id = db.Column(db.String, db.ForeignKey('device.id'))
+    user_pk = db.Column(pk_type(), db.ForeignKey('user.pk'))
+    key_pk = db.Column(pk_type(), db.ForeignKey('key.pk'))
+    device_pk = db.Column(pk_type(), db.ForeignKey('device.pk'))
+    # Роль пользователя на момент операции: смена роли не переписывает аналитику
+    # по ролям. Без внешнего ключа, как в key_state_snapshot; NULL - операция
+    # записана до появления колонки
+    role_pk = db.Column(pk_type())
     type = db.Column(db.Enum('TAKE', 'RETURN', name='operationtype'), nullable=False)
     # type = db.Column(db.String)  # "take" | "return"
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', back_populates='operations')
     key = db.relationship('Key', back_populates='operations')
     device = db.relationship('Device', back_populates='operations')
+    __table_args__ = (
+        db.Index('ix_operation_key_pk_timestamp', 'key_pk', 'timestamp'),
+        db.Index('ix_operation_user_pk', 'user_pk'),
+        db.Index('ix_operation_device_pk', 'device_pk'),
+        db.Index('ix_operation_timestamp_id', 'timestamp', 'id'),
+    )
+
+
+class ChangeLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Версия, по которой устройства запрашивают изменения; общая для записей
+    # одной транзакции: в PostgreSQL её номер, в SQLite выдаётся при commit
+    # (см. app/utils/changes.py)
+    version = db.Column(db.BigInteger, index=True)
+    entity = db.Column(db.String(16), nullable=False)  # user | key | key_slot
+    entity_id = db.Column(id_type(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class KeyStateSnapshot(db.Model):
+    # Состояние ключа после всех операций с timestamp <= taken_at.
+    # pk ключа, пользователя и устройства - как в operation, без внешних ключей
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    key_pk = db.Column(pk_type(), nullable=False)
+    is_taken = db.Column(db.Boolean, nullable=False)
+    user_pk = db.Column(pk_type())
+    device_pk = db.Column(pk_type())
+    since = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_key_state_snapshot_taken_at_key_pk', 'taken_at', 'key_pk'),
+    )
+
+
+class KeyHolding(db.Model):
+    # Кто сейчас держит ключ: строка есть, пока ключ выдан.
+    # Поддерживается в той же транзакции, что и операции get_key / return_key
+    key_pk = db.Column(pk_type(), db.ForeignKey('key.pk', ondelete='CASCADE'), primary_key=True)
+    # Внешние id без внешних ключей: удаление пользователя или устройства не должно блокироваться
+    user_id = db.Column(id_type(64), index=True)
+    role_id = db.Column(id_type(64), index=True)
+    device_id = db.Column(id_type(64), index=True)
+    taken_at = db.Column(db.DateTime, nullable=False)
+
+
+class Job(db.Model):
+    # Фоновая задача администратора (см. app/utils/jobs.py)
+    id = db.Column(id_type(40), primary_key=True, default=lambda: uuid.uuid4().hex[:8])
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(16), nullable=False, default="queued")  # queued | running | succeeded | failed | cancelled
+    progress = db.Column(db.String)
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Обновляется вместе с progress: по нему видно, что задача ещё жива
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_job_status_created_at', 'status', 'created_at'),
+    )
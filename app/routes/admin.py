@@ -1,10 +1,26 @@
-from flask import Blueprint, request, jsonify
-from app.models import User, Role, db, Key, Operation, Device, KeySlot
-from app.utils.decorators import require_admin_auth
-from sqlalchemy.orm import joinedload
+from flask import Blueprint, request, jsonify, Response, current_app
+from app.models import User, Role, db, Key, Operation, Device, KeySlot, KeyHolding, Job
+from app.utils.decorators import require_admin_auth, require_admin_stream_auth, use_read_replica
+from app.utils.events import event_hub, stream_events
+from app.utils.device_commands import device_commands
+from app.utils.invalidation import invalidation_bus
+from app.utils.revocation import record_revocation
+from app.utils.archive import read_archived_operations, archive_horizon
+from app.utils import analytics
+from app.utils.key_state import state_at
+from app.utils.overdue import overdue_scheduler
+from app.utils.holdings import record_return, select_holdings
+from app.utils.jobs import JobAlreadyActive, job_runner
+from app.utils.search import search, MAX_OFFSET, SEARCH_TYPES
+from app.utils.serializers import (
+    serialize_key, select_keys, serialize_user, select_users, serialize_device, select_devices,
+    serialize_slot, select_slots, serialize_operation, select_operations, serialize_role, select_roles,
+    serialize_job, select_jobs
+)
+from sqlalchemy import func
 import uuid
 import jwt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 bp = Blueprint("admin", __name__, url_prefix="/admin")
 
@@ -51,8 +67,18 @@ def admin_login():
         return jsonify({"error": str(e)}), 500
 
 
+def _date_range_args():
+    date_from = request.args.get("date_from")
+    date_to = request.args.get("date_to")
+    return (
+        datetime.fromisoformat(date_from) if date_from else None,
+        datetime.fromisoformat(date_to) if date_to else None
+    )
+
+
 @bp.route("/operations/", methods=["GET"])
 @require_admin_auth
+@use_read_replica
 def get_operations():
     """
         Получить логи операций
@@ -77,6 +103,21 @@ def get_operations():
             type: integer
             required: false
             description: Фильтрация по ID устройства
+          - in: query
+            name: date_from
+            type: string
+            required: false
+            description: Операции начиная с даты (ISO 8601)
+          - in: query
+            name: date_to
+            type: string
+            required: false
+            description: Операции до даты включительно (ISO 8601)
+          - in: query
+            name: include_archive
+            type: boolean
+            required: false
+            description: Добавить операции из архива
         responses:
           200:
             description: Список операций
@@ -84,32 +125,39 @@ def get_operations():
     user_id = request.args.get("user_id")
     key_number = request.args.get("key_number")
     device_id = request.args.get("device_id")
+    include_archive = request.args.get("include_archive", "").lower() in ("1", "true", "yes")
+    try:
+        date_from, date_to = _date_range_args()
+    except ValueError:
+        return jsonify({"error": "Invalid date_from or date_to"}), 400
 
-    query = Operation.query.options(
-        joinedload(Operation.user),
-        joinedload(Operation.key),
-        joinedload(Operation.device)
-    )
+    query = select_operations()
 
     if user_id:
-        query = query.join(User).filter(User.id == user_id)
+        query = query.where(User.id == user_id)
     if key_number:
-        query = query.join(Key).filter(Key.key_number == key_number)
+        query = query.where(Key.key_number == key_number)
     if device_id:
-        query = query.join(Device).filter(Device.id == device_id)
-
-    operations = query.order_by(Operation.timestamp.desc()).all()
-
-    result = []
-    for op in operations:
-        result.append({
-            "id": op.id,
-            "user_id": op.user.id if op.user else None,
-            "key_number": op.key.key_number if op.key else None,
-            "device_id": op.device.id if op.device else None,
-            "type": op.type,
-            "timestamp": op.timestamp.isoformat()
-        })
+        query = query.where(Device.id == device_id)
+    # Ограничение по времени позволяет секционированной таблице читать только нужные месяцы
+    if date_from:
+        query = query.where(Operation.timestamp >= date_from)
+    if date_to:
+        query = query.where(Operation.timestamp <= date_to)
+
+    rows = db.session.execute(query.order_by(Operation.timestamp.desc()))
+    result = [serialize_operation(row) for row in rows]
+
+    if include_archive:
+        result.extend(read_archived_operations(
+            current_app.config["ARCHIVE_DIR"],
+            date_from=date_from,
+            date_to=date_to,
+            user_id=user_id,
+            key_number=key_number,
+            device_id=device_id
+        ))
+        result.sort(key=lambda op: op["timestamp"], reverse=True)
 
     try:
         return jsonify(result)
@@ -119,6 +167,672 @@ def get_operations():
 
 
 
+@bp.route("/events/", methods=["GET"])
+@require_admin_stream_auth
+def stream_key_events():
+    """
+        Поток событий об изменении ключей и ячеек (Server-Sent Events)
+        ---
+        tags:
+          - Admin - Operations
+        security:
+          - BearerAuth: []  # токен админа
+        produces:
+          - text/event-stream
+        parameters:
+          - in: header
+            name: Last-Event-ID
+            type: string
+            required: false
+            description: >
+              ID последнего полученного события для продолжения потока.
+              ID события из другого экземпляра API или до перезапуска даёт событие reset
+          - in: query
+            name: last_event_id
+            type: string
+            required: false
+            description: То же, что Last-Event-ID, для клиентов без доступа к заголовкам
+          - in: query
+            name: access_token
+            type: string
+            required: false
+            description: >
+              Токен админа для EventSource в браузере, который не передаёт заголовок
+              Authorization (также принимается cookie admin_token)
+        responses:
+          200:
+            description: >
+              Поток событий key_taken, key_returned, key_created, key_updated,
+              key_deleted, slot_created, slot_deleted. Событие reset означает,
+              что часть событий пропущена и состояние нужно перечитать целиком.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    sub = event_hub.subscribe(last_event_id)
+    return Response(
+        stream_events(event_hub, sub),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@bp.route("/analytics/top_keys/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def analytics_top_keys():
+    """
+        Самые востребованные ключи за период
+        ---
+        tags:
+          - Admin - Analytics
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: n
+            type: integer
+            required: false
+            minimum: 1
+            description: Сколько ключей вернуть (по умолчанию 10)
+          - in: query
+            name: date_from
+            type: string
+            required: false
+            description: Начало периода (ISO 8601)
+          - in: query
+            name: date_to
+            type: string
+            required: false
+            description: Конец периода (ISO 8601)
+        responses:
+          200:
+            description: Ключи с числом выдач по убыванию
+    """
+    try:
+        date_from, date_to = _date_range_args()
+        n = int(request.args.get("n", 10))
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    if n < 1:
+        return jsonify({"error": "Invalid parameters"}), 400
+
+    ops = analytics.get_operation_arrays(date_from, date_to)
+    top = analytics.top_keys(ops, n)
+    # В журнале pk ключей - наружу внешний id и номер
+    keys = {
+        pk: (key_id, number) for pk, key_id, number in
+        db.session.query(Key.pk, Key.id, Key.key_number).filter(Key.pk.in_([key_pk for key_pk, _ in top]))
+    }
+    return jsonify([
+        {"key_id": keys.get(key_pk, (None,))[0], "key_number": keys.get(key_pk, (None, None))[1], "takes": takes}
+        for key_pk, takes in top
+    ])
+
+
+@bp.route("/analytics/roles/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def analytics_roles():
+    """
+        Использование ключей по ролям
+        ---
+        tags:
+          - Admin - Analytics
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: date_from
+            type: string
+            required: false
+            description: Начало периода (ISO 8601)
+          - in: query
+            name: date_to
+            type: string
+            required: false
+            description: Конец периода (ISO 8601)
+        responses:
+          200:
+            description: >
+              Для каждой роли число выдач, суммарное время удержания ключей
+              и доля времени, когда ключи роли были на руках. Выдача относится
+              к роли пользователя в момент выдачи (операции, записанные до
+              появления operation.role_pk, - к его текущей роли)
+    """
+    try:
+        date_from, date_to = _date_range_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+
+    ops = analytics.get_operation_arrays(date_from, date_to)
+    if not len(ops):
+        return jsonify([])
+
+    # Время в БД хранится в UTC без часового пояса
+    start = date_from.replace(tzinfo=timezone.utc).timestamp() if date_from else ops.ts.min()
+    end = date_to.replace(tzinfo=timezone.utc).timestamp() if date_to else ops.ts.max()
+    keys_per_role = dict(
+        db.session.query(Role.id, func.count(Key.pk)).join(Key, Key.assigned_role_pk == Role.pk)
+        .group_by(Role.id).all()
+    )
+    names = dict(db.session.query(Role.id, Role.name).all())
+
+    result = analytics.role_utilization(ops, keys_per_role, max(end - start, 1))
+    for row in result:
+        row["role_name"] = names.get(row["role_id"])
+    return jsonify(result)
+
+
+@bp.route("/analytics/heatmap/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def analytics_heatmap():
+    """
+        Тепловая карта выдач ключей по дням недели и часам (UTC)
+        ---
+        tags:
+          - Admin - Analytics
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: date_from
+            type: string
+            required: false
+            description: Начало периода (ISO 8601)
+          - in: query
+            name: date_to
+            type: string
+            required: false
+            description: Конец периода (ISO 8601)
+        responses:
+          200:
+            description: Матрица 7x24, строка 0 - понедельник
+    """
+    try:
+        date_from, date_to = _date_range_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+
+    ops = analytics.get_operation_arrays(date_from, date_to)
+    return jsonify({"heatmap": analytics.hour_of_week_heatmap(ops).tolist()})
+
+
+@bp.route("/analytics/holding_times/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def analytics_holding_times():
+    """
+        Перцентили времени удержания ключей (в секундах)
+        ---
+        tags:
+          - Admin - Analytics
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: date_from
+            type: string
+            required: false
+            description: Начало периода (ISO 8601)
+          - in: query
+            name: date_to
+            type: string
+            required: false
+            description: Конец периода (ISO 8601)
+        responses:
+          200:
+            description: >
+              Общие перцентили и перцентили по ролям (роль пользователя
+              в момент выдачи, как в /admin/analytics/roles/)
+    """
+    try:
+        date_from, date_to = _date_range_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+
+    ops = analytics.get_operation_arrays(date_from, date_to)
+    overall, by_role = analytics.holding_percentiles(ops)
+    return jsonify({"overall": overall, "by_role": by_role})
+
+
+@bp.route("/overdue/", methods=["GET"])
+@require_admin_auth
+def list_overdue_keys():
+    """
+        Невозвращённые в срок ключи
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []
+        responses:
+          200:
+            description: >
+              Просроченные ключи по возрастанию срока возврата. Срок берётся из
+              политики роли взявшего, иначе из timeout устройства (в минутах).
+              При просрочке в /admin/events/ публикуется событие key_overdue
+            schema:
+              type: array
+              items:
+                type: object
+                properties:
+                  key_id:
+                    type: string
+                  key_number:
+                    type: string
+                  user_id:
+                    type: string
+                  role_id:
+                    type: string
+                  device_id:
+                    type: string
+                  taken_at:
+                    type: string
+                  due_at:
+                    type: string
+                  overdue_seconds:
+                    type: integer
+    """
+    return jsonify(overdue_scheduler.overdue())
+
+
+@bp.route("/search/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def search_entities():
+    """
+        Поиск пользователей, ключей и устройств
+        ---
+        tags:
+          - Admin
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: q
+            type: string
+            required: true
+            description: Часть или искажённый вариант имени, NFC-метки, номера ключа или IP
+            example: "иванов"
+          - in: query
+            name: types
+            type: string
+            required: false
+            description: Через запятую из user, key, device (по умолчанию все)
+          - in: query
+            name: limit
+            type: integer
+            required: false
+            default: 20
+          - in: query
+            name: offset
+            type: integer
+            required: false
+            default: 0
+            maximum: 1000
+        responses:
+          200:
+            description: >
+              Совпадения по убыванию score: сходство триграмм плюс бонус за
+              совпадение префикса или подстроки. Сущность встречается один раз,
+              field - поле, давшее лучшее совпадение
+            schema:
+              type: object
+              properties:
+                results:
+                  type: array
+                  items:
+                    type: object
+                    properties:
+                      type:
+                        type: string
+                      id:
+                        type: string
+                      field:
+                        type: string
+                      value:
+                        type: string
+                      label:
+                        type: string
+                      score:
+                        type: number
+                has_more:
+                  type: boolean
+          400:
+            description: Пустой запрос или неверные параметры
+    """
+    query = request.args.get("q", "").strip()
+    types = [t for t in request.args.get("types", "").split(",") if t] or list(SEARCH_TYPES)
+    try:
+        limit = min(int(request.args.get("limit", 20)), 100)
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    if not query or limit < 1 or not 0 <= offset <= MAX_OFFSET or not set(types) <= set(SEARCH_TYPES):
+        return jsonify({"error": "Invalid parameters"}), 400
+    results, has_more = search(query, types, limit, offset)
+    return jsonify({"results": results, "has_more": has_more})
+
+
+def _holdings_response(**filters):
+    query = select_holdings()
+    for column, value in filters.items():
+        query = query.where(getattr(KeyHolding, column) == value)
+    rows = db.session.execute(query.order_by(KeyHolding.taken_at))
+    return jsonify([{
+        "key_id": key_id,
+        "key_number": key_number,
+        "user_id": user_id,
+        "user_name": user_name,
+        "role_id": role_id,
+        "device_id": device_id,
+        "taken_at": taken_at.isoformat()
+    } for key_id, key_number, user_id, user_name, role_id, device_id, taken_at in rows])
+
+
+@bp.route("/holdings/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def list_holdings():
+    """
+        Ключи на руках
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: user_id
+            type: string
+            required: false
+          - in: query
+            name: role_id
+            type: string
+            required: false
+            description: Роль взявшего ключ
+          - in: query
+            name: device_id
+            type: string
+            required: false
+            description: Устройство, из которого взят ключ
+        responses:
+          200:
+            description: Выданные ключи по времени выдачи
+            schema:
+              type: array
+              items:
+                type: object
+                properties:
+                  key_id:
+                    type: string
+                  key_number:
+                    type: string
+                  user_id:
+                    type: string
+                  user_name:
+                    type: string
+                  role_id:
+                    type: string
+                  device_id:
+                    type: string
+                  taken_at:
+                    type: string
+    """
+    filters = {name: request.args[name] for name in ("user_id", "role_id", "device_id") if request.args.get(name)}
+    return _holdings_response(**filters)
+
+
+@bp.route("/holdings/user/<string:user_id>/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def list_user_holdings(user_id):
+    """
+        Ключи на руках у пользователя
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: user_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: Выданные пользователю ключи (формат как у /admin/holdings/)
+    """
+    return _holdings_response(user_id=user_id)
+
+
+@bp.route("/holdings/role/<string:role_id>/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def list_role_holdings(role_id):
+    """
+        Ключи на руках у сотрудников роли
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: role_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: Ключи, взятые сотрудниками роли (формат как у /admin/holdings/)
+    """
+    return _holdings_response(role_id=role_id)
+
+
+@bp.route("/holdings/device/<string:device_id>/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def list_device_holdings(device_id):
+    """
+        Невозвращённые ключи, взятые из устройства
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: device_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: Ключи, взятые из устройства (формат как у /admin/holdings/)
+    """
+    return _holdings_response(device_id=device_id)
+
+
+def _job_response(job_id):
+    row = db.session.execute(select_jobs().where(Job.id == job_id)).first()
+    if row is None:
+        return jsonify({"status": "error", "reason": "Job not found"}), 404
+    return jsonify(serialize_job(row))
+
+
+@bp.route("/jobs/", methods=["POST"])
+@require_admin_auth
+def submit_job():
+    """
+        Запустить фоновую задачу
+        ---
+        tags:
+          - Admin - Jobs
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: body
+            name: body
+            required: true
+            schema:
+              type: object
+              properties:
+                kind:
+                  type: string
+                  enum: [check_consistency, archive_operations, snapshot_key_state, rebuild_holdings, prune_change_log, ensure_partitions]
+                  example: "check_consistency"
+                params:
+                  type: object
+                  description: Параметры задачи, например {"repair": true} или {"days": 180}
+        responses:
+          202:
+            description: Задача поставлена в очередь; состояние - GET /admin/jobs/<id>/
+          400:
+            description: Неизвестный тип задачи или параметры
+          409:
+            description: >
+              Архивация уже в очереди или выполняется (job_id - её id):
+              два запуска дописывали бы одни и те же файлы архива
+    """
+    data = request.get_json() or {}
+    params = data.get("params") or {}
+    if not isinstance(params, dict):
+        return jsonify({"status": "error", "reason": "params must be an object"}), 400
+    try:
+        job = job_runner.submit(data.get("kind"), params)
+    except ValueError as e:
+        return jsonify({"status": "error", "reason": str(e)}), 400
+    except JobAlreadyActive as e:
+        return jsonify({"status": "error", "reason": str(e), "job_id": e.job_id}), 409
+    return _job_response(job.id), 202
+
+
+@bp.route("/jobs/", methods=["GET"])
+@require_admin_auth
+def list_jobs():
+    """
+        Последние фоновые задачи
+        ---
+        tags:
+          - Admin - Jobs
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: query
+            name: status
+            type: string
+            required: false
+            enum: [queued, running, succeeded, failed, cancelled]
+          - in: query
+            name: limit
+            type: integer
+            required: false
+            default: 100
+        responses:
+          200:
+            description: Задачи, новые первыми (без результатов)
+    """
+    try:
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    query = select_jobs().order_by(Job.created_at.desc()).limit(limit)
+    if request.args.get("status"):
+        query = query.where(Job.status == request.args["status"])
+    return jsonify([serialize_job(row) for row in db.session.execute(query)])
+
+
+@bp.route("/jobs/<string:job_id>/", methods=["GET"])
+@require_admin_auth
+def get_job(job_id):
+    """
+        Состояние фоновой задачи
+        ---
+        tags:
+          - Admin - Jobs
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: job_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: >
+              status (queued, running, succeeded, failed, cancelled), progress -
+              последнее сообщение задачи, updated_at - время последнего сообщения
+          404:
+            description: Задача не найдена
+    """
+    return _job_response(job_id)
+
+
+@bp.route("/jobs/<string:job_id>/result/", methods=["GET"])
+@require_admin_auth
+def get_job_result(job_id):
+    """
+        Результат фоновой задачи
+        ---
+        tags:
+          - Admin - Jobs
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: job_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: Результат успешно завершённой задачи
+          404:
+            description: Задача не найдена
+          409:
+            description: Задача ещё выполняется, отменена или завершилась ошибкой
+    """
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"status": "error", "reason": "Job not found"}), 404
+    if job.status != "succeeded":
+        return jsonify({"status": "error", "reason": f"Job is {job.status}", "error": job.error}), 409
+    return current_app.response_class(job.result, mimetype="application/json")
+
+
+@bp.route("/jobs/<string:job_id>/cancel/", methods=["POST"])
+@require_admin_auth
+def cancel_job(job_id):
+    """
+        Отменить фоновую задачу
+        ---
+        tags:
+          - Admin - Jobs
+        security:
+          - BearerAuth: []
+        parameters:
+          - in: path
+            name: job_id
+            type: string
+            required: true
+        responses:
+          200:
+            description: >
+              Отмена запрошена. Задача из очереди отменяется сразу, выполняющаяся -
+              после текущей порции работы (уже закоммиченные порции не откатываются)
+          404:
+            description: Задача не найдена
+          409:
+            description: Задача уже завершена
+    """
+    if db.session.get(Job, job_id) is None:
+        return jsonify({"status": "error", "reason": "Job not found"}), 404
+    if not job_runner.cancel(job_id):
+        return jsonify({"status": "error", "reason": "Job already finished"}), 409
+    return _job_response(job_id)
+
+
 @bp.route("/create_device/", methods=["POST"])
 @require_admin_auth
 def create_device():
@@ -186,6 +900,7 @@ def create_device():
     new_device = Device(ip_address=ip, auth_token=token, timeout=timeout)
     db.session.add(new_device)
     db.session.commit()
+    invalidation_bus.publish("device", new_device.id)
 
     return jsonify({
         "status": "ok",
@@ -269,14 +984,24 @@ def update_device(device_id):
         return jsonify({"status": "error", "reason": "Device not found"}), 404
 
     data = request.get_json()
+    timeout_changed = "timeout" in data and data["timeout"] != device.timeout
+    token_changed = "auth_token" in data and data["auth_token"] != device.auth_token
     if "ip_address" in data:
         device.ip_address = data["ip_address"]
     if "auth_token" in data:
         device.auth_token = data["auth_token"]
     if "timeout" in data:
         device.timeout = data["timeout"]
+    if token_changed:
+        record_revocation(device.id)
 
     db.session.commit()
+    invalidation_bus.publish("device", device.id)
+    if token_changed:
+        invalidation_bus.publish("device_token", device.id)
+
+    if timeout_changed:
+        device_commands.push(device.id, {"type": "config", "timeout": device.timeout})
 
     return jsonify({
         "status": "ok",
@@ -328,13 +1053,18 @@ def delete_device(device_id):
         }), 400
 
     db.session.delete(device)
+    record_revocation(device_id)
     db.session.commit()
+    invalidation_bus.publish("device", device_id)
+    invalidation_bus.publish("device_token", device_id)
+    device_commands.forget(device_id)
     return jsonify({"status": "ok", "message": f"Device {device_id} deleted"})
 
 
 
 @bp.route("/list_devices/", methods=["GET"])
 @require_admin_auth
+@use_read_replica
 def list_devices():
     """
     Получить список всех устройств
@@ -369,15 +1099,7 @@ def list_devices():
                       updated_at:
                         type: string
     """
-    devices = Device.query.all()
-    device_list = [{
-        "id": d.id,
-        "ip_address": d.ip_address,
-        "auth_token": d.auth_token,
-        "timeout": d.timeout,
-        "created_at": d.created_at.isoformat(),
-        "updated_at": d.updated_at.isoformat()
-    } for d in devices]
+    device_list = [serialize_device(row) for row in db.session.execute(select_devices())]
 
     return jsonify({"devices": device_list})
 
@@ -419,6 +1141,9 @@ def create_key():
         schema:
           type: object
           properties:
+            status:
+              type: string
+              example: ok
             id:
               type: string
             key_number:
@@ -427,8 +1152,18 @@ def create_key():
               type: boolean
             key_slot_id:
               type: string
+            device_id:
+              type: string
+            last_user_id:
+              type: string
+            last_device_id:
+              type: string
             assigned_role_id:
               type: string
+            created_at:
+              type: string
+            updated_at:
+              type: string
       400:
         description: Ошибка запроса или ключ уже существует
       404:
@@ -447,12 +1182,12 @@ def create_key():
         return jsonify({"status": "error", "reason": "Key already exists"}), 400
 
     # Проверка роли
-    role = Role.query.get(role_id)
+    role = Role.query.filter_by(id=role_id).first()
     if not role:
         return jsonify({"status": "error", "reason": "Role not found"}), 400
 
     # Проверка ячейки
-    slot = KeySlot.query.get(slot_id)
+    slot = KeySlot.query.filter_by(id=slot_id).first()
     if not slot:
         return jsonify({"status": "error", "reason": "Slot not found"}), 404
     if slot.key:
@@ -460,24 +1195,26 @@ def create_key():
 
     new_key = Key(
         key_number=key_number,
-        assigned_role_id=role_id,
+        assigned_role=role,
         key_slot=slot,
         is_taken=False  # по умолчанию
     )
 
     db.session.add(new_key)
     db.session.commit()
-
-    return jsonify({
-        "status": "ok",
-        "id": new_key.id,
-        "key_number": new_key.key_number,
-        "is_taken": new_key.is_taken,
-        "key_slot_id": new_key.key_slot_id,
-        "assigned_role_id": new_key.assigned_role_id,
-        "created_at": new_key.created_at.isoformat()
+    invalidation_bus.publish("key", new_key.id)
+
+    key_data = serialize_key(db.session.execute(select_keys().where(Key.pk == new_key.pk)).one())
+    event_hub.publish("key_created", {
+        "key_id": key_data["id"],
+        "key_number": key_data["key_number"],
+        "key_slot_id": key_data["key_slot_id"],
+        "device_id": key_data["device_id"],
+        "assigned_role_id": key_data["assigned_role_id"]
     })
 
+    return jsonify({"status": "ok", **key_data})
+
 
 
 
@@ -518,14 +1255,29 @@ def update_key(key_id):
         schema:
           type: object
           properties:
+            status:
+              type: string
+              example: ok
             id:
               type: string
             key_number:
               type: string
+            is_taken:
+              type: boolean
             key_slot_id:
               type: string
+            device_id:
+              type: string
+            last_user_id:
+              type: string
+            last_device_id:
+              type: string
             assigned_role_id:
               type: string
+            created_at:
+              type: string
+            updated_at:
+              type: string
       400:
         description: Ошибка запроса
       404:
@@ -533,7 +1285,7 @@ def update_key(key_id):
     """
 
     data = request.get_json()
-    key = Key.query.get(key_id)
+    key = Key.query.filter_by(id=key_id).first()
     if not key:
         return jsonify({"status": "error", "reason": "Key not found"}), 404
 
@@ -549,14 +1301,14 @@ def update_key(key_id):
 
     # Проверка существования роли
     if new_role_id:
-        role = Role.query.get(new_role_id)
+        role = Role.query.filter_by(id=new_role_id).first()
         if not role:
             return jsonify({"status": "error", "reason": "Role not found"}), 400
-        key.assigned_role_id = new_role_id
+        key.assigned_role = role
 
     # Проверка существования и доступности ячейки
-    if new_slot_id and new_slot_id != key.key_slot_id:
-        new_slot = KeySlot.query.get(new_slot_id)
+    if new_slot_id and (key.key_slot is None or new_slot_id != key.key_slot.id):
+        new_slot = KeySlot.query.filter_by(id=new_slot_id).first()
         if not new_slot:
             return jsonify({"status": "error", "reason": "Slot not found"}), 404
         if new_slot.key and new_slot.key.id != key.id:
@@ -569,16 +1321,19 @@ def update_key(key_id):
         key.key_slot = new_slot
 
     db.session.commit()
-
-    return jsonify({
-        "status": "ok",
-        "id": key.id,
-        "key_number": key.key_number,
-        "key_slot_id": key.key_slot_id,
-        "assigned_role_id": key.assigned_role_id,
-        "updated_at": key.updated_at.isoformat()
+    invalidation_bus.publish("key", key.id)
+
+    key_data = serialize_key(db.session.execute(select_keys().where(Key.pk == key.pk)).one())
+    event_hub.publish("key_updated", {
+        "key_id": key_data["id"],
+        "key_number": key_data["key_number"],
+        "key_slot_id": key_data["key_slot_id"],
+        "device_id": key_data["device_id"],
+        "assigned_role_id": key_data["assigned_role_id"]
     })
 
+    return jsonify({"status": "ok", **key_data})
+
 
 
 @bp.route("/delete_key/<string:key_id>/", methods=["DELETE"])
@@ -604,15 +1359,20 @@ def delete_key(key_id):
         description: Ключ не найден
     """
 
-    key = Key.query.get(key_id)
+    key = Key.query.filter_by(id=key_id).first()
     if not key:
         return jsonify({"status": "error", "reason": "Key not found"}), 404
 
     if key.key_slot:
         key.key_slot.key = None
 
+    # На SQLite ON DELETE CASCADE не срабатывает без PRAGMA foreign_keys
+    record_return(key.pk)
     db.session.delete(key)
     db.session.commit()
+    invalidation_bus.publish("key", key_id)
+
+    event_hub.publish("key_deleted", {"key_id": key_id})
 
     return jsonify({
         "status": "ok",
@@ -624,6 +1384,7 @@ def delete_key(key_id):
 
 @bp.route("/keys/", methods=["GET"])
 @require_admin_auth
+@use_read_replica
 def list_keys():
     """
         Получить список всех ключей
@@ -636,20 +1397,101 @@ def list_keys():
           200:
             description: Список ключей
     """
-    keys = Key.query.all()
-    result = []
-    for key in keys:
-        result.append({
-            "key_number": key.key_number,
-            "id": key.id,
-            "is_taken": key.is_taken,
-            "key_slot_id": key.key_slot_id,
-            "assigned_role_id": key.assigned_role_id,
-            "device_id": key.key_slot.device_id if key.key_slot else None,
-            "created_at": key.created_at.isoformat() if key.created_at else None,
-            "updated_at": key.updated_at.isoformat() if key.updated_at else None
+    return jsonify([serialize_key(row) for row in db.session.execute(select_keys())])
+
+
+@bp.route("/keys/at/", methods=["GET"])
+@require_admin_auth
+@use_read_replica
+def keys_at():
+    """
+        Состояние ключей на момент времени (по журналу операций)
+        ---
+        tags:
+          - Admin - Keys
+        security:
+          - BearerAuth: []  # токен админа
+        parameters:
+          - in: query
+            name: ts
+            type: string
+            required: true
+            description: Момент времени (ISO 8601, UTC)
+          - in: query
+            name: key_number
+            type: string
+            required: false
+            description: Только этот ключ (кто держал ключ в момент ts)
+          - in: query
+            name: device_id
+            type: string
+            required: false
+            description: Только ключи, лежавшие в этом устройстве в момент ts
+        responses:
+          200:
+            description: >
+              Состояние ключей, у которых до ts были операции.
+              user_id - кто держал ключ (is_taken=true) или последним вернул его,
+              device_id - откуда взят или куда возвращён, since - время операции
+          400:
+            description: Некорректные параметры
+          404:
+            description: Ключ не найден
+          409:
+            description: >
+              Операции между ближайшим снимком и ts перенесены в архив -
+              состояние можно получить только на момент снимка (snapshot_at)
+    """
+    try:
+        ts = datetime.fromisoformat(request.args["ts"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Invalid ts"}), 400
+    key_number = request.args.get("key_number")
+    device_id = request.args.get("device_id")
+
+    key_pk = None
+    if key_number:
+        key_pk = db.session.query(Key.pk).filter_by(key_number=key_number).scalar()
+        if key_pk is None:
+            return jsonify({"error": "Key not found"}), 404
+    device_pk = None
+    if device_id:
+        device_pk = db.session.query(Device.pk).filter_by(id=device_id).scalar()
+
+    # Журнал хранит pk - наружу отдаются внешние id
+    state, snapshot_at, replayed = state_at(ts, key_pk)
+    # Архивные операции в таблице отсутствуют: воспроизведение после снимка,
+    # сделанного раньше последней из них, вернуло бы неполное состояние
+    horizon = archive_horizon(current_app.config["ARCHIVE_DIR"])
+    if horizon and (snapshot_at is None or snapshot_at < horizon) and ts != snapshot_at:
+        return jsonify({
+            "error": "ts is older than the archive horizon and not on a snapshot",
+            "archive_horizon": horizon.isoformat(),
+            "snapshot_at": snapshot_at.isoformat() if snapshot_at else None
+        }), 409
+    keys_by_pk = {pk: (key_id, number) for pk, key_id, number in db.session.query(Key.pk, Key.id, Key.key_number)}
+    user_ids = dict(db.session.query(User.pk, User.id).all())
+    device_ids = dict(db.session.query(Device.pk, Device.id).all())
+    keys = []
+    for k_pk, (is_taken, user_pk, k_device_pk, since) in state.items():
+        if device_id and (is_taken or device_pk is None or k_device_pk != device_pk):
+            continue
+        k_id, number = keys_by_pk.get(k_pk, (None, None))
+        keys.append({
+            "key_id": k_id,
+            "key_number": number,
+            "is_taken": is_taken,
+            "user_id": user_ids.get(user_pk),
+            "device_id": device_ids.get(k_device_pk),
+            "since": since.isoformat() if since else None
         })
-    return jsonify(result)
+
+    return jsonify({
+        "ts": ts.isoformat(),
+        "snapshot_at": snapshot_at.isoformat() if snapshot_at else None,
+        "replayed_operations": replayed,
+        "keys": keys
+    })
 
 
 
@@ -720,12 +1562,25 @@ def create_slot():
         return jsonify({"error": "Device not found"}), 404
 
     # Проверка уникальности номера внутри устройства
-    if KeySlot.query.filter_by(number=slot_number, device_id=device.id).first():
+    if KeySlot.query.filter_by(number=slot_number, device_pk=device.pk).first():
         return jsonify({"error": "Slot already exists for this device"}), 400
 
-    slot = KeySlot(number=slot_number, device_id=device.id)
+    slot = KeySlot(number=slot_number, device=device)
     db.session.add(slot)
     db.session.commit()
+    invalidation_bus.publish("slot", slot.id)
+    invalidation_bus.publish("device", device.id)
+
+    event_hub.publish("slot_created", {
+        "slot_id": slot.id,
+        "slot_number": slot.number,
+        "device_id": device.id
+    })
+    device_commands.push(device.id, {
+        "type": "slot_lock",
+        "slot_number": slot.number,
+        "is_locked": bool(slot.is_locked)
+    })
 
     return jsonify({
         "status": "ok",
@@ -737,79 +1592,95 @@ def create_slot():
     })
 
 
-# @bp.route("/update_slot/<string:slot_id>/", methods=["PUT"])
-# @require_admin_auth
-# def update_slot(slot_id):
-#     """
-#     Обновить данные ячейки
-#     ---
-#     tags:
-#       - Admin - KeySlot
-#     security:
-#       - BearerAuth: []
-#     parameters:
-#       - name: slot_id
-#         in: path
-#         required: true
-#         schema:
-#           type: string
-#         description: Уникальный ID ячейки (slot_id)
-#       - in: body
-#         name: body
-#         required: true
-#         schema:
-#           type: object
-#           properties:
-#             is_locked:
-#               type: boolean
-#               example: true
-#     responses:
-#       200:
-#         description: Ячейка обновлена
-#         content:
-#           application/json:
-#             schema:
-#               type: object
-#               properties:
-#                 status:
-#                   type: string
-#                   example: ok
-#                 slot_id:
-#                   type: string
-#                   example: "a1b2c3d4"
-#                 number:
-#                   type: integer
-#                 is_locked:
-#                   type: boolean
-#                 device_id:
-#                   type: string
-#                 updated_at:
-#                   type: string
-#                   example: "2025-06-05T12:30:00"
-#       400:
-#         description: Ошибка запроса
-#       404:
-#         description: Ячейка не найдена
-#     """
-#     data = request.get_json()
-#
-#     slot = KeySlot.query.filter_by(id=slot_id).first()
-#     if not slot:
-#         return jsonify({"error": "Slot not found"}), 404
-#
-#     is_locked = data.get("is_locked")
-#     if is_locked is not None:
-#         slot.is_locked = bool(is_locked)
-#
-#     db.session.commit()
-#     return jsonify({
-#         "status": "ok",
-#         "slot_id": slot.id,
-#         "number": slot.number,
-#         "is_locked": slot.is_locked,
-#         "device_id": slot.device_id,
-#         "updated_at": slot.updated_at.isoformat()
-#     })
+@bp.route("/update_slot/<string:slot_id>/", methods=["PUT"])
+@require_admin_auth
+def update_slot(slot_id):
+    """
+    Обновить данные ячейки
+    ---
+    tags:
+      - Admin - KeySlot
+    security:
+      - BearerAuth: []
+    parameters:
+      - name: slot_id
+        in: path
+        required: true
+        schema:
+          type: string
+        description: Уникальный ID ячейки (slot_id)
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            is_locked:
+              type: boolean
+              example: true
+    responses:
+      200:
+        description: Ячейка обновлена
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                status:
+                  type: string
+                  example: ok
+                slot_id:
+                  type: string
+                  example: "a1b2c3d4"
+                number:
+                  type: integer
+                is_locked:
+                  type: boolean
+                device_id:
+                  type: string
+                updated_at:
+                  type: string
+                  example: "2025-06-05T12:30:00"
+      400:
+        description: Ошибка запроса
+      404:
+        description: Ячейка не найдена
+    """
+    data = request.get_json()
+
+    slot = KeySlot.query.filter_by(id=slot_id).first()
+    if not slot:
+        return jsonify({"error": "Slot not found"}), 404
+
+    is_locked = data.get("is_locked")
+    if is_locked is not None:
+        slot.is_locked = bool(is_locked)
+
+    db.session.commit()
+    device_id = slot.device.id
+    invalidation_bus.publish("slot", slot.id)
+    invalidation_bus.publish("device", device_id)
+
+    event_hub.publish("slot_updated", {
+        "slot_id": slot.id,
+        "slot_number": slot.number,
+        "device_id": device_id,
+        "is_locked": slot.is_locked
+    })
+    device_commands.push(device_id, {
+        "type": "slot_lock",
+        "slot_number": slot.number,
+        "is_locked": slot.is_locked
+    })
+
+    return jsonify({
+        "status": "ok",
+        "slot_id": slot.id,
+        "number": slot.number,
+        "is_locked": slot.is_locked,
+        "device_id": device_id,
+        "updated_at": slot.updated_at.isoformat()
+    })
 
 
 @bp.route("/delete_slot/<string:slot_id>/", methods=["DELETE"])
@@ -855,14 +1726,21 @@ def delete_slot(slot_id):
     if slot.key:
         return jsonify({"error": "Slot is occupied"}), 400
 
-    device_id = slot.device_id
+    device_id = slot.device.id
+    slot_number = slot.number
     db.session.delete(slot)
     db.session.commit()
+    invalidation_bus.publish("slot", slot_id)
+    invalidation_bus.publish("device", device_id)
+    device_commands.push(device_id, {"type": "slot_removed", "slot_number": slot_number})
+
+    event_hub.publish("slot_deleted", {"slot_id": slot_id, "device_id": device_id})
     return jsonify({"status": "ok", "message": f"Slot with id {slot_id} deleted from device with id{device_id}"})
 
 
 @bp.route("/slots/", methods=["GET"])
 @require_admin_auth
+@use_read_replica
 def list_slots():
     """
     Получить список всех ячеек
@@ -897,14 +1775,7 @@ def list_slots():
                     type: string
                     example: "key-001"
     """
-    slots = KeySlot.query.all()
-    result = [{
-        "slot_id": s.id,
-        "slot_number": s.number,
-        "device_id": s.device_id,
-        "key_number": s.key.key_number if s.key else None
-    } for s in slots]
-    return jsonify(result)
+    return jsonify([serialize_slot(row) for row in db.session.execute(select_slots())])
 
 
 
@@ -980,13 +1851,15 @@ def create_user():
         return jsonify({"status": "error", "reason": "NFC tag already exists"}), 400
 
     try:
-        new_user = User(name=name, nfc_tag=nfc_tag, role_id=role.id)
+        new_user = User(name=name, nfc_tag=nfc_tag, role=role)
         db.session.add(new_user)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         return jsonify({"status": "error", "reason": str(e)}), 500
 
+    invalidation_bus.publish("user", new_user.id)
+
     return jsonify({
         "status": "ok",
         "user": {
@@ -1081,7 +1954,7 @@ def update_user(user_id):
         role = Role.query.filter_by(id=data["role_id"]).first()
         if not role:
             return jsonify({"status": "error", "reason": "Role not found"}), 404
-        user.role_id = role.id
+        user.role = role
 
     try:
         db.session.commit()
@@ -1089,6 +1962,8 @@ def update_user(user_id):
         db.session.rollback()
         return jsonify({"status": "error", "reason": str(e)}), 500
 
+    invalidation_bus.publish("user", user.id)
+
     return jsonify({
         "status": "ok",
         "user": {
@@ -1142,12 +2017,14 @@ def delete_user(user_id):
 
     db.session.delete(user)
     db.session.commit()
+    invalidation_bus.publish("user", user_id)
     return jsonify({"status": "ok", "message": f"User deleted"})
 
 
 
 @bp.route("/users/", methods=["GET"])
 @require_admin_auth
+@use_read_replica
 def list_users():
     """
     Получить список всех пользователей
@@ -1180,17 +2057,7 @@ def list_users():
                     type: string
     """
 
-    users = User.query.all()
-    result = []
-    for user in users:
-        result.append({
-            "id": user.id,
-            "name": user.name,
-            "nfc_tag": user.nfc_tag,
-            "role_id": user.role_id,
-            "role_name": user.role.name if user.role else None
-        })
-    return jsonify(result)
+    return jsonify([serialize_user(row) for row in db.session.execute(select_users())])
 
 
 
@@ -1236,12 +2103,14 @@ def create_role():
     role = Role(name=name)
     db.session.add(role)
     db.session.commit()
+    invalidation_bus.publish("role", role.id)
 
     return jsonify({"message": "Role created", "id": role.id}), 201
 
 
 @bp.route('/roles/', methods=['GET'])
 @require_admin_auth
+@use_read_replica
 def list_roles():
     """
         Вывод списка всех категорий сотрудников
@@ -1263,8 +2132,7 @@ def list_roles():
                       name:
                         type: string
         """
-    roles = Role.query.all()
-    return jsonify([{"id": role.id, "name": role.name} for role in roles])
+    return jsonify([serialize_role(row) for row in db.session.execute(select_roles())])
 
 
 @bp.route('/roles/<string:role_id>/', methods=['PUT'])
@@ -1303,7 +2171,7 @@ def update_role(role_id):
     data = request.get_json()
     name = data.get('name')
 
-    role = Role.query.get(role_id)
+    role = Role.query.filter_by(id=role_id).first()
     if not role:
         return jsonify({"error": "Role not found"}), 404
 
@@ -1317,6 +2185,7 @@ def update_role(role_id):
 
     role.name = name
     db.session.commit()
+    invalidation_bus.publish("role", role_id)
 
     return jsonify({"message": "Role updated"})
 
@@ -1344,7 +2213,7 @@ def delete_role(role_id):
       404:
         description: Role not found
     """
-    role = Role.query.get(role_id)
+    role = Role.query.filter_by(id=role_id).first()
     if not role:
         return jsonify({"error": "Role not found"}), 404
 
@@ -1355,5 +2224,6 @@ def delete_role(role_id):
 
     db.session.delete(role)
     db.session.commit()
+    invalidation_bus.publish("role", role_id)
 
     return jsonify({"message": "Role deleted"})
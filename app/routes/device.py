@@ -1,9 +1,19 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request
 from app.models import Device, User, Key, Operation, KeySlot, db
-from app.utils.jwt_utils import generate_jwt
-from app.utils.decorators import require_device_auth
-from datetime import datetime
+from app.utils.jwt_utils import generate_jwt, decode_jwt_for_refresh, REFRESH_MAX_HOURS
+from app.utils.revocation import token_revocations
+from app.utils.decorators import require_device_auth, revoke_on_missing_device, rate_limit
+from app.utils.events import event_hub
+from app.utils.invalidation import invalidation_bus
+from app.utils.holdings import record_take, record_return
+from app.utils.device_commands import device_commands, LONG_POLL_MAX_SECONDS
+from app.utils.wire import parse_body, respond, lean_profile
+from app.utils.changes import build_snapshot, build_delta
+from app.utils.serializers import serialize_key, select_keys
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timezone
 import logging
+import math
 import enum
 
 class OperationType(enum.Enum):
@@ -15,6 +25,7 @@ bp = Blueprint("device", __name__, url_prefix="")
 
 @bp.route("/auth_card/", methods=["POST"])
 @require_device_auth
+@rate_limit
 def scan_card():
     """
     Валидация NFC карты и выдача информации о доступных ключах
@@ -31,6 +42,22 @@ def scan_card():
             nfcId:
               type: string
               example: "04A224B98C6280"
+      - in: query
+        name: profile
+        type: string
+        enum: [lean]
+        required: false
+        description: >
+          Сокращённый ответ для прошивки: только номера доступных ключей
+          и номера их ячеек (параллельные массивы)
+    consumes:
+      - application/json
+      - application/msgpack
+      - application/cbor
+    produces:
+      - application/json
+      - application/msgpack
+      - application/cbor
     responses:
       200:
         description: Успешная валидация
@@ -48,6 +75,16 @@ def scan_card():
               type: array
               items:
                 type: object
+            key_numbers:
+              type: array
+              description: Только в профиле lean
+              items:
+                type: string
+            slot_numbers:
+              type: array
+              description: Только в профиле lean
+              items:
+                type: integer
       401:
         description: Ошибка валидации
         schema:
@@ -59,11 +96,11 @@ def scan_card():
             log:
               type: string
     """
-    data = request.get_json()
+    data = parse_body()
     nfc_id = data.get("nfcId")
 
     if not nfc_id:
-        return jsonify({
+        return respond({
             "status": "error",
             "log": "NFC ID не передан"
         }), 401
@@ -71,48 +108,50 @@ def scan_card():
     user = User.query.filter_by(nfc_tag=nfc_id).first()
 
     if not user:
-        return jsonify({
+        return respond({
             "status": "error",
             "log": f"Пользователь с меткой '{nfc_id}' не найден"
         }), 401
 
-    device = Device.query.get(request.device_id)
-    if not device:
-        return jsonify({
-            "status": "error",
-            "log": "Устройство не найдено"
-        }), 401
-
-    # Ключи, соответствующие роли пользователя
-    role_keys = Key.query.filter_by(assigned_role_id=user.role_id).all()
+    if lean_profile():
+        # Один запрос без загрузки недоступных ключей и их ячеек
+        available = (
+            db.session.query(Key.key_number, KeySlot.number)
+            .join(KeySlot, KeySlot.pk == Key.key_slot_pk)
+            .filter(
+                Key.assigned_role_pk == user.role_pk,
+                KeySlot.device_pk == request.device_pk,
+                # IS NOT TRUE, как "not is_taken" в полном ответе: NULL - ключ свободен
+                Key.is_taken.isnot(True)
+            )
+            .order_by(KeySlot.number)
+            .all()
+        )
+        return respond({
+            "status": "success",
+            "key_numbers": [key_number for key_number, _ in available],
+            "slot_numbers": [number for _, number in available]
+        }), 200
+
+    # Ключи, соответствующие роли пользователя, вместе с устройством их ячейки
+    role_keys = db.session.execute(select_keys().where(Key.assigned_role_pk == user.role_pk))
 
     available_keys = []
     unavailable_keys = []
 
-    for key in role_keys:
-        key_data = {
-            "id": key.id,
-            "key_number": key.key_number,
-            "is_taken": key.is_taken,
-            "key_slot_id": key.key_slot_id,
-            "device_id": key.key_slot.device_id if key.key_slot else None,
-            "last_user_id": key.last_user_id,
-            "last_device_id": key.last_device_id,
-            "assigned_role_id": key.assigned_role_id,
-            "created_at": key.created_at.isoformat() if key.created_at else None,
-            "updated_at": key.updated_at.isoformat() if key.updated_at else None
-        }
+    for row in role_keys:
+        key_data = serialize_key(row)
 
         if (
-            key.key_slot and
-            key.key_slot.device_id == device.id and
-            not key.is_taken
+            key_data["key_slot_id"] and
+            key_data["device_id"] == request.device_id and
+            not key_data["is_taken"]
         ):
             available_keys.append(key_data)
         else:
             unavailable_keys.append(key_data)
 
-    return jsonify({
+    return respond({
         "status": "success",
         "available_keys": available_keys,
         "unavailable_keys": unavailable_keys
@@ -121,6 +160,7 @@ def scan_card():
 
 
 @bp.route("/init/", methods=["POST"])
+@rate_limit
 def init_device():
     """
         Инициализация устройства
@@ -146,20 +186,76 @@ def init_device():
           401:
             description: Ошибка авторизации устройства
     """
-    data = request.get_json()
+    data = parse_body()
     device_id = data.get("device_id")
     auth_key = data.get("auth_key")
 
     device = Device.query.filter_by(id=device_id, auth_token=auth_key).first()
     if not device:
-        return jsonify({"error": "Unauthorized"}), 401
+        return respond({"error": "Unauthorized"}), 401
 
-    token = generate_jwt({"device_id": device.id})
-    return jsonify({"token": token})
+    # device_pk нужен для записи операций без запроса к Device
+    token = generate_jwt({
+        "device_id": device.id,
+        "device_pk": device.pk,
+        "auth_time": int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp())
+    })
+    return respond({"token": token})
+
+
+@bp.route("/refresh/", methods=["POST"])
+@rate_limit
+def refresh_token():
+    """
+        Обновление токена устройства без повторной передачи auth_key
+        ---
+        tags:
+          - Device
+        security:
+          - BearerAuth: []  # действующий или недавно истёкший токен устройства
+        responses:
+          200:
+            description: Новый токен
+          401:
+            description: >
+              Токен недействителен, отозван, устройство удалено, истёк больше 10 минут назад или
+              цепочка обновлений длится дольше 24 часов - нужен /device/init/
+    """
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return respond({"error": "Authorization header missing or invalid"}), 401
+
+    try:
+        payload = decode_jwt_for_refresh(auth.split("Bearer ")[-1])
+    except Exception as e:
+        return respond({"error": "Invalid or expired token", "details": str(e)}), 401
+
+    device_id = payload.get("device_id")
+    device_pk = payload.get("device_pk")
+    auth_time = payload.get("auth_time")
+    if not device_id or not device_pk or not auth_time:
+        return respond({"error": "Invalid token payload"}), 401
+    if token_revocations.is_revoked(device_id, payload.get("iat", 0)):
+        return respond({"error": "Token revoked"}), 401
+    # Отзыв по шине мог ещё не дойти до этого процесса: устройство проверяется по pk
+    device = db.session.get(Device, device_pk)
+    if device is None or device.id != device_id:
+        token_revocations.revoke(device_id)
+        return respond({"error": "Token revoked"}), 401
+
+    now = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+    if now - auth_time > REFRESH_MAX_HOURS * 3600:
+        return respond({"error": "Refresh chain expired, re-init required"}), 401
+
+    # auth_time переносится в новый токен, поэтому цепочка ограничена по времени
+    token = generate_jwt({"device_id": device_id, "device_pk": device_pk, "auth_time": auth_time})
+    return respond({"token": token})
 
 
 @bp.route("/get_key/", methods=["POST"])
 @require_device_auth
+@rate_limit
+@revoke_on_missing_device
 def get_key():
     """
     Получение ключа
@@ -195,45 +291,58 @@ def get_key():
             keySlotNumber:
               type: string
     """
-    data = request.get_json()
+    data = parse_body()
     key_number = data.get("key_number")
     nfc_id = data.get("nfcId")
 
     if not key_number or not nfc_id:
-        return jsonify({"status": "error", "message": "Некорректные входные данные"}), 400
+        return respond({"status": "error", "message": "Некорректные входные данные"}), 400
 
-    user = User.query.filter_by(nfc_tag=nfc_id).first()
+    # Роль нужна для key_holding (её внешний id) - загружаем вместе с пользователем
+    user = User.query.options(joinedload(User.role)).filter_by(nfc_tag=nfc_id).first()
     key = Key.query.filter_by(key_number=key_number).first()
-    device = Device.query.get(request.device_id)
 
-    if not user or not key or not device:
-        return jsonify({"status": "error", "message": "Пользователь, ключ или устройство не найдены"}), 400
+    if not user or not key:
+        return respond({"status": "error", "message": "Пользователь, ключ или устройство не найдены"}), 400
 
-    if key.assigned_role_id and user.role_id != key.assigned_role_id:
-        return jsonify({"status": "error", "message": "Данный ключ вам недоступен"}), 403
+    if key.assigned_role_pk and user.role_pk != key.assigned_role_pk:
+        return respond({"status": "error", "message": "Данный ключ вам недоступен"}), 403
 
     if key.is_taken:
-        return jsonify({"status": "error", "message": "Данный ключ уже забран"}), 400
+        return respond({"status": "error", "message": "Данный ключ уже забран"}), 400
 
     key_slot_number = key.key_slot.number if key.key_slot else None
 
     key.is_taken = True
-    key.key_slot_id = None
-    key.last_user_id = user.id
-    key.last_device_id = device.id
+    key.key_slot_pk = None
+    key.last_user_pk = user.pk
+    key.last_device_pk = request.device_pk
 
     # Добавление записи в Operation
     operation = Operation(
-        user_id=user.id,
-        key_id=key.id,
-        device_id=device.id,
+        user_pk=user.pk,
+        key_pk=key.pk,
+        device_pk=request.device_pk,
+        role_pk=user.role_pk,
         type='TAKE',
         timestamp = datetime.utcnow()
     )
     db.session.add(operation)
+    record_take(key, user, request.device_id, operation.timestamp)
     db.session.commit()
+    invalidation_bus.publish("key", key.id)
+
+    event_hub.publish("key_taken", {
+        "key_id": key.id,
+        "key_number": key.key_number,
+        "user_id": user.id,
+        "device_id": request.device_id,
+        "slot_number": key_slot_number,
+        "operation_id": operation.id,
+        "timestamp": operation.timestamp.isoformat()
+    })
 
-    return jsonify({
+    return respond({
         "status": "success",
         "keyUuid": key.id,
         "keySlotNumber": key_slot_number
@@ -243,6 +352,8 @@ def get_key():
 
 @bp.route("/return_key/", methods=["POST"])
 @require_device_auth
+@rate_limit
+@revoke_on_missing_device
 def return_key():
     """
     Возврат ключа
@@ -281,48 +392,60 @@ def return_key():
             keySlotNumber:
               type: string
     """
-    data = request.get_json()
+    data = parse_body()
     key_slot_number = data.get("keySlotNumber")
     key_id = data.get("keyId")
     nfc_id = data.get("nfcId")
 
     if not key_slot_number or not key_id or not nfc_id:
-        return jsonify({"status": "error"}), 400
+        return respond({"status": "error"}), 400
 
-    key = Key.query.get(key_id)
+    key = Key.query.filter_by(id=key_id).first()
     user = User.query.filter_by(nfc_tag=nfc_id).first()
-    device = Device.query.get(request.device_id)
 
-    if not key or not key.is_taken or not user or not device:
-        return jsonify({"status": "error"}), 400
+    if not key or not key.is_taken or not user:
+        return respond({"status": "error"}), 400
 
     key_slot = KeySlot.query.filter_by(
         number=int(key_slot_number),
-        device_id=device.id
+        device_pk=request.device_pk
     ).first()
 
     if not key_slot:
-        return jsonify({"status": "error"}), 404
+        return respond({"status": "error"}), 404
     if key_slot.is_locked or key_slot.key is not None:
-        return jsonify({"status": "error", "message": "Slot already in use"}), 400
+        return respond({"status": "error", "message": "Slot already in use"}), 400
 
     key.is_taken = False
-    key.key_slot_id = key_slot.id
-    key.last_user_id = user.id
-    key.last_device_id = device.id
+    key.key_slot_pk = key_slot.pk
+    key.last_user_pk = user.pk
+    key.last_device_pk = request.device_pk
 
     # Добавление записи в Operation
     operation = Operation(
-        user_id=user.id,
-        key_id=key.id,
-        device_id=device.id,
+        user_pk=user.pk,
+        key_pk=key.pk,
+        device_pk=request.device_pk,
+        role_pk=user.role_pk,
         type='RETURN',
         timestamp=datetime.utcnow()
     )
     db.session.add(operation)
+    record_return(key.pk)
     db.session.commit()
+    invalidation_bus.publish("key", key.id)
+
+    event_hub.publish("key_returned", {
+        "key_id": key.id,
+        "key_number": key.key_number,
+        "user_id": user.id,
+        "device_id": request.device_id,
+        "slot_number": key_slot.number,
+        "operation_id": operation.id,
+        "timestamp": operation.timestamp.isoformat()
+    })
 
-    return jsonify({
+    return respond({
         "status": "success",
         "keyId": key.id,
         "nfcId": nfc_id,
@@ -332,6 +455,7 @@ def return_key():
 
 @bp.route("/get_empty_slot/", methods=["GET"])
 @require_device_auth
+@rate_limit
 def get_empty_slot():
     """
     Получить свободную ячейку устройства
@@ -346,32 +470,208 @@ def get_empty_slot():
       404:
         description: Нет свободных ячеек
     """
-    device = Device.query.get(request.device_id)
-    if not device:
-        return jsonify({"status": "error", "reason": "Устройство не найдено"}), 404
-
     # Найдём ячейку, если:
     # - key_slot относится к текущему устройству
     # - либо нет связанного ключа (Key), либо он есть, но key_number = None
     empty_slot = (
         KeySlot.query
-        .filter_by(device_id=device.id)
+        .filter_by(device_pk=request.device_pk)
         .outerjoin(Key)
-        .filter((Key.id == None) | (Key.key_number == None))
+        .filter((Key.pk == None) | (Key.key_number == None))
         .order_by(KeySlot.number.asc())
         .first()
     )
 
     if not empty_slot:
-        return jsonify({"status": "error", "reason": "Нет свободной ячейки"}), 404
+        return respond({"status": "error", "reason": "Нет свободной ячейки"}), 404
 
-    return jsonify({
+    return respond({
         "status": "success",
         "keySlotNumber": empty_slot.number,
         "keySlotId": empty_slot.id
     })
 
 
+@bp.route("/commands/", methods=["GET"])
+@require_device_auth
+@rate_limit
+def get_commands():
+    """
+    Ожидание команд для устройства (long-poll)
+    ---
+    tags:
+      - Device
+    security:
+      - BearerAuth: []  # токен устройства
+    parameters:
+      - in: query
+        name: since
+        type: integer
+        required: false
+        description: Версия последних полученных команд. Без параметра возвращается полная конфигурация
+      - in: query
+        name: wait
+        type: integer
+        required: false
+        description: Сколько секунд ждать изменений (не больше 30)
+    responses:
+      200:
+        description: >
+          Команды после версии since. full=true означает, что передана полная
+          конфигурация устройства и локальное состояние нужно заменить
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              enum: [success]
+            version:
+              type: integer
+            full:
+              type: boolean
+            commands:
+              type: array
+              items:
+                type: object
+      400:
+        description: Некорректные параметры
+      404:
+        description: Устройство не найдено
+    """
+    try:
+        since = request.args.get("since", type=int)
+        wait = float(request.args.get("wait", LONG_POLL_MAX_SECONDS))
+    except ValueError:
+        return respond({"status": "error", "reason": "Некорректные параметры"}), 400
+    if not math.isfinite(wait):
+        return respond({"status": "error", "reason": "Некорректные параметры"}), 400
+    wait = min(wait, LONG_POLL_MAX_SECONDS)
+
+    full = since is None
+    if not full:
+        # Канал команд заводится только для существующего устройства
+        if not db.session.query(Device.pk).filter_by(pk=request.device_pk).first():
+            return respond({"status": "error", "reason": "Устройство не найдено"}), 404
+        # Запрос отпускает соединение с БД на время ожидания
+        db.session.remove()
+        version, commands, full = device_commands.wait(request.device_id, since, max(wait, 0))
+
+    if full:
+        version = device_commands.current_version(request.device_id)
+        device = db.session.get(Device, request.device_pk)
+        if not device:
+            return respond({"status": "error", "reason": "Устройство не найдено"}), 404
+        commands = [{"type": "config", "timeout": device.timeout}]
+        commands += [
+            {"type": "slot_lock", "slot_number": slot.number, "is_locked": bool(slot.is_locked)}
+            for slot in device.key_stores
+        ]
+
+    return respond({
+        "status": "success",
+        "version": version,
+        "full": full,
+        "commands": commands
+    })
+
+
+@bp.route("/snapshot/", methods=["GET"])
+@require_device_auth
+@rate_limit
+def get_snapshot():
+    """
+    Снимок карт, ключей и ячеек для локальной проверки на устройстве
+    ---
+    tags:
+      - Device
+    security:
+      - BearerAuth: []  # токен устройства
+    parameters:
+      - in: query
+        name: since
+        type: integer
+        required: false
+        description: >
+          Версия локального снимка. Без параметра (или если журнал изменений
+          после неё уже очищен) возвращается полный снимок
+    produces:
+      - application/json
+      - application/msgpack
+      - application/cbor
+    responses:
+      200:
+        description: >
+          full=true - полный снимок, локальное состояние нужно заменить.
+          full=false - изменения после since: записи users/keys/slots заменяют
+          локальные, removed_* удаляются. more=true - есть ещё изменения,
+          нужно повторить запрос с новой версией
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              enum: [success]
+            version:
+              type: integer
+            full:
+              type: boolean
+            more:
+              type: boolean
+            users:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: string
+                  nfc_tag:
+                    type: string
+                  role_id:
+                    type: string
+            keys:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: string
+                  key_number:
+                    type: string
+                  role_id:
+                    type: string
+                  slot_number:
+                    type: integer
+            slots:
+              type: array
+              items:
+                type: object
+            removed_users:
+              type: array
+              items:
+                type: string
+            removed_keys:
+              type: array
+              items:
+                type: string
+            removed_slots:
+              type: array
+              items:
+                type: string
+      400:
+        description: Некорректные параметры
+    """
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return respond({"status": "error", "reason": "Некорректные параметры"}), 400
+
+    payload = build_delta(request.device_pk, since) if since is not None else None
+    if payload is None:
+        payload = build_snapshot(request.device_pk)
+
+    return respond({"status": "success", **payload})
 
 
 # @bp.route("/free_keyslot/", methods=["GET"])
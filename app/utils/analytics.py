@@ -0,0 +1,204 @@
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import select, cast, func, BigInteger
+
+from app.models import db, Operation, User, Role
+
+TAKE = 1
+RETURN = 0
+CHUNK_SIZE = 50000
+# Сколько секунд переиспользовать загруженные массивы между запросами
+CACHE_SECONDS = 300
+PERCENTILES = (50, 90, 95, 99)
+
+
+class OperationArrays:
+    """
+    Журнал операций в колоночном виде: pk ключей и внешние id ролей
+    заменены целочисленными кодами (индексы в key_ids / role_ids),
+    время хранится в секундах от эпохи (UTC).
+    """
+
+    def __init__(self, key, role, type, ts, key_ids, role_ids):
+        self.key = key
+        self.role = role
+        self.type = type
+        self.ts = ts
+        self.key_ids = key_ids
+        self.role_ids = role_ids
+        self._intervals = None
+
+    def __len__(self):
+        return len(self.ts)
+
+
+def _epoch_column():
+    if db.session.get_bind().dialect.name == "postgresql":
+        return cast(func.extract("epoch", Operation.timestamp), BigInteger)
+    return cast(func.strftime("%s", Operation.timestamp), BigInteger)
+
+
+def _grow(arrays, capacity):
+    return [np.resize(a, capacity) for a in arrays]
+
+
+def load_operations(date_from=None, date_to=None, chunk_size=CHUNK_SIZE):
+    query = (
+        select(Operation.key_pk, Role.id, Operation.type, _epoch_column())
+        .outerjoin(User, User.pk == Operation.user_pk)
+        # Роль на момент операции; у операций до появления role_pk - текущая роль пользователя
+        .outerjoin(Role, Role.pk == func.coalesce(Operation.role_pk, User.role_pk))
+        .where(Operation.timestamp.isnot(None))
+    )
+    if date_from:
+        query = query.where(Operation.timestamp >= date_from)
+    if date_to:
+        query = query.where(Operation.timestamp <= date_to)
+
+    key_index, role_index = {}, {}
+    capacity, n = chunk_size, 0
+    key = np.empty(capacity, np.int32)
+    role = np.empty(capacity, np.int32)
+    type_ = np.empty(capacity, np.int8)
+    ts = np.empty(capacity, np.int64)
+
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+    for rows in result.partitions(chunk_size):
+        m = len(rows)
+        if n + m > capacity:
+            capacity = max(capacity * 2, n + m)
+            key, role, type_, ts = _grow((key, role, type_, ts), capacity)
+
+        key_col, role_col, type_col, ts_col = zip(*rows)
+        key[n:n + m] = [key_index.setdefault(k, len(key_index)) for k in key_col]
+        role[n:n + m] = [role_index.setdefault(r, len(role_index)) for r in role_col]
+        type_[n:n + m] = [TAKE if t == "TAKE" else RETURN for t in type_col]
+        ts[n:n + m] = ts_col
+        n += m
+
+    return OperationArrays(
+        key[:n].copy(), role[:n].copy(), type_[:n].copy(), ts[:n].copy(),
+        list(key_index), list(role_index)
+    )
+
+
+_cache_lock = threading.Lock()
+_cache = {}
+
+
+def get_operation_arrays(date_from=None, date_to=None):
+    cache_key = (date_from, date_to)
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < CACHE_SECONDS:
+            return cached[1]
+    arrays = load_operations(date_from, date_to)
+    with _cache_lock:
+        # Держим в памяти только последний запрошенный диапазон
+        _cache.clear()
+        _cache[cache_key] = (time.monotonic(), arrays)
+    return arrays
+
+
+def _key_time_order(ops):
+    # Один int64 ключ сортировки (код ключа в старших битах, время в младших)
+    # сортируется в разы быстрее, чем np.lexsort по двум массивам
+    t0 = ops.ts.min()
+    span = int(ops.ts.max() - t0)
+    shift = max(span.bit_length(), 1)
+    if len(ops.key_ids).bit_length() + shift > 62:
+        return np.lexsort((ops.ts, ops.key))
+    packed = (ops.key.astype(np.int64) << shift) | (ops.ts - t0)
+    return np.argsort(packed)
+
+
+def holding_intervals(ops):
+    """
+    Сопоставляет каждую выдачу (TAKE) со следующим возвратом (RETURN) того же ключа.
+    Возвращает коды ключей, коды ролей взявших, длительности (сек) и время выдачи.
+    Результат запоминается в ops, так как сортировка - самая дорогая часть.
+    """
+    if ops._intervals is None:
+        ops._intervals = _pair_intervals(ops)
+    return ops._intervals
+
+
+def _pair_intervals(ops):
+    if len(ops) < 2:
+        empty = np.empty(0, np.int64)
+        return empty.astype(np.int32), empty.astype(np.int32), empty, empty
+    order = _key_time_order(ops)
+    key = ops.key[order]
+    ts = ops.ts[order]
+    type_ = ops.type[order]
+    pair = (type_[:-1] == TAKE) & (type_[1:] == RETURN) & (key[:-1] == key[1:])
+    idx = np.flatnonzero(pair)
+    return key[idx], ops.role[order][idx], ts[idx + 1] - ts[idx], ts[idx]
+
+
+def top_keys(ops, n=10):
+    if not len(ops) or n < 1:
+        return []
+    counts = np.bincount(ops.key[ops.type == TAKE], minlength=len(ops.key_ids))
+    n = min(n, len(counts))
+    top = np.argpartition(counts, -n)[-n:]
+    top = top[np.argsort(counts[top], kind="stable")[::-1]]
+    return [(ops.key_ids[i], int(counts[i])) for i in top if counts[i] > 0]
+
+
+def role_utilization(ops, keys_per_role, window_seconds):
+    """
+    Для каждой роли: число выдач, суммарное время удержания ключей и доля
+    времени, в течение которой ключи роли были на руках.
+    """
+    if not len(ops):
+        return []
+    n_roles = len(ops.role_ids)
+    takes = np.bincount(ops.role[ops.type == TAKE], minlength=n_roles)
+    _, interval_role, durations, _ = holding_intervals(ops)
+    held = np.bincount(interval_role, weights=durations, minlength=n_roles)
+
+    result = []
+    for code, role_id in enumerate(ops.role_ids):
+        key_count = keys_per_role.get(role_id, 0)
+        capacity = key_count * window_seconds
+        result.append({
+            "role_id": role_id,
+            "takes": int(takes[code]),
+            "holding_seconds": float(held[code]),
+            "keys": key_count,
+            "utilization": float(held[code] / capacity) if capacity else None
+        })
+    return result
+
+
+def hour_of_week_heatmap(ops):
+    """Число выдач по дням недели (0 - понедельник) и часам, UTC."""
+    ts = ops.ts[ops.type == TAKE]
+    # 1970-01-01 - четверг, сдвиг на 3 дня делает понедельник нулевым днём
+    day = (ts // 86400 + 3) % 7
+    hour = (ts // 3600) % 24
+    return np.bincount(day * 24 + hour, minlength=168).reshape(7, 24)
+
+
+def holding_percentiles(ops, percentiles=PERCENTILES):
+    _, interval_role, durations, _ = holding_intervals(ops)
+
+    def summary(values):
+        if not len(values):
+            return {"count": 0}
+        points = np.percentile(values, percentiles)
+        result = {"count": int(len(values)), "mean": float(values.mean())}
+        result.update({f"p{p}": float(v) for p, v in zip(percentiles, points)})
+        return result
+
+    by_role = []
+    if len(durations):
+        order = np.argsort(interval_role, kind="stable")
+        roles_sorted = interval_role[order]
+        bounds = np.flatnonzero(np.diff(roles_sorted)) + 1
+        for chunk in np.split(order, bounds):
+            by_role.append({"role_id": ops.role_ids[interval_role[chunk[0]]], **summary(durations[chunk])})
+    return summary(durations), by_role
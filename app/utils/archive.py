@@ -0,0 +1,189 @@
+import csv
+import fcntl
+import glob
+import gzip
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app.models import Operation, Key, User, Device, db
+
+ARCHIVE_FIELDS = ["id", "user_id", "key_id", "key_number", "device_id", "type", "timestamp"]
+FILE_PATTERN = "operations-{month}.csv.gz"
+# Ключ pg_try_advisory_lock: архивирует только один процесс за раз
+ARCHIVE_LOCK_ID = 74120302
+LOCK_FILE = ".archive.lock"
+
+
+def _month_path(archive_dir, month):
+    return os.path.join(archive_dir, FILE_PATTERN.format(month=month))
+
+
+def _append_rows(path, rows):
+    is_new = not os.path.exists(path)
+    # gzip в режиме дозаписи создаёт новый member, такие файлы читаются как один поток
+    with gzip.open(path, "at", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=ARCHIVE_FIELDS)
+        if is_new:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+@contextmanager
+def _archive_lock(archive_dir):
+    """
+    Два запуска одновременно выбрали бы одну порцию и дописали её в один файл,
+    перемешав члены gzip. В PostgreSQL - advisory lock на отдельном соединении
+    (держится между commit порций), иначе - блокировка файла в каталоге архива.
+    """
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect() as conn:
+            if not conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": ARCHIVE_LOCK_ID}).scalar():
+                raise RuntimeError("Архивация уже выполняется")
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ARCHIVE_LOCK_ID})
+                conn.commit()
+        return
+    with open(os.path.join(archive_dir, LOCK_FILE), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("Архивация уже выполняется")
+        yield
+
+
+def archive_operations(archive_dir, older_than_days, chunk_size=5000, progress=None):
+    """
+    Переносит операции старше older_than_days в помесячные CSV.gz файлы
+    и удаляет их из таблицы порциями по chunk_size строк.
+    Возвращает число перенесённых операций; RuntimeError - архивация уже
+    выполняется в другом процессе.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    with _archive_lock(archive_dir):
+        return _archive_operations(archive_dir, older_than_days, chunk_size, progress)
+
+
+def _archive_operations(archive_dir, older_than_days, chunk_size, progress):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+
+    while True:
+        rows = (
+            db.session.query(
+                Operation.id, User.id.label("user_id"), Key.id.label("key_id"), Key.key_number,
+                Device.id.label("device_id"), Operation.type, Operation.timestamp
+            )
+            # В архиве - внешние id: pk не переживают пересоздание записей
+            .outerjoin(User, User.pk == Operation.user_pk)
+            .outerjoin(Key, Key.pk == Operation.key_pk)
+            .outerjoin(Device, Device.pk == Operation.device_pk)
+            .filter(Operation.timestamp < cutoff)
+            .order_by(Operation.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            break
+
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row.timestamp.strftime("%Y-%m"), []).append({
+                "id": row.id,
+                "user_id": row.user_id,
+                "key_id": row.key_id,
+                "key_number": row.key_number,
+                "device_id": row.device_id,
+                "type": row.type,
+                "timestamp": row.timestamp.isoformat()
+            })
+        for month, month_rows in by_month.items():
+            _append_rows(_month_path(archive_dir, month), month_rows)
+
+        # Удаляем только после записи на диск: при сбое строки могут
+        # попасть в архив дважды, но не потеряются (см. read_archived_operations)
+        ids = [row.id for row in rows]
+        Operation.query.filter(Operation.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        archived += len(rows)
+        if progress:
+            progress(archived)
+
+    return archived
+
+
+def _archived_months(archive_dir, date_from=None, date_to=None):
+    months = []
+    for path in glob.glob(os.path.join(archive_dir, FILE_PATTERN.format(month="*"))):
+        month = os.path.basename(path)[len("operations-"):-len(".csv.gz")]
+        if date_from and month < date_from.strftime("%Y-%m"):
+            continue
+        if date_to and month > date_to.strftime("%Y-%m"):
+            continue
+        months.append((month, path))
+    return sorted(months)
+
+
+_horizon_cache = {}
+
+
+def archive_horizon(archive_dir):
+    """
+    Время самой поздней операции в архиве или None, если архива нет.
+    Читается последний помесячный файл; результат кэшируется по его mtime и размеру.
+    """
+    months = _archived_months(archive_dir)
+    if not months:
+        return None
+    path = months[-1][1]
+    stat = os.stat(path)
+    cached = _horizon_cache.get(path)
+    if cached and cached[0] == (stat.st_mtime, stat.st_size):
+        return cached[1]
+    horizon = None
+    with gzip.open(path, "rt", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            timestamp = datetime.fromisoformat(row["timestamp"])
+            if horizon is None or timestamp > horizon:
+                horizon = timestamp
+    _horizon_cache[path] = ((stat.st_mtime, stat.st_size), horizon)
+    return horizon
+
+
+def read_archived_operations(archive_dir, date_from=None, date_to=None,
+                             user_id=None, key_number=None, device_id=None):
+    """
+    Читает архивные операции в формате ответа /admin/operations/,
+    помесячно и по возрастанию времени.
+    """
+    for _, path in _archived_months(archive_dir, date_from, date_to):
+        seen = set()
+        with gzip.open(path, "rt", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if row["id"] in seen:
+                    continue
+                seen.add(row["id"])
+                timestamp = datetime.fromisoformat(row["timestamp"])
+                if date_from and timestamp < date_from:
+                    continue
+                if date_to and timestamp > date_to:
+                    continue
+                if user_id and row["user_id"] != user_id:
+                    continue
+                if key_number and row["key_number"] != key_number:
+                    continue
+                if device_id and row["device_id"] != device_id:
+                    continue
+                yield {
+                    "id": int(row["id"]),
+                    "user_id": row["user_id"] or None,
+                    "key_number": row["key_number"] or None,
+                    "device_id": row["device_id"] or None,
+                    "type": row["type"],
+                    "timestamp": row["timestamp"]
+                }
@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import Session
+
+from app.models import ChangeLog, User, Key, KeySlot, Role, db
+
+TRACKED = {User: "user", Key: "key", KeySlot: "key_slot"}
+# Максимум изменений в одном ответе; остальное клиент дозапрашивает
+DELTA_LIMIT = 1000
+# Номер текущей транзакции PostgreSQL (xid8, растёт монотонно)
+PG_XACT_ID = "pg_current_xact_id()::text::bigint"
+
+
+@event.listens_for(Session, "after_flush")
+def _record_changes(session, flush_context):
+    rows = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        entity = TRACKED.get(type(obj))
+        if entity is None:
+            continue
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        rows.append({"entity": entity, "entity_id": obj.id, "created_at": datetime.utcnow()})
+    if not rows:
+        return
+    conn = session.connection()
+    insert = ChangeLog.__table__.insert()
+    if conn.dialect.name == "postgresql":
+        # Версия - номер транзакции, без общей блокировки на запись
+        conn.execute(insert.values(version=text(PG_XACT_ID)), rows)
+    else:
+        conn.execute(insert, rows)
+        session.info["change_log_pending"] = True
+
+
+@event.listens_for(Session, "before_commit")
+def _assign_versions(session):
+    """
+    SQLite: записи транзакции получают одну версию max(version) + 1 при commit.
+    Пишет одна транзакция за раз, поэтому версии растут в порядке фиксации.
+    В PostgreSQL версия уже проставлена при вставке (см. current_version).
+    """
+    session.flush()
+    if not session.info.pop("change_log_pending", False):
+        return
+    conn = session.connection()
+    base = conn.execute(select(func.max(ChangeLog.version))).scalar() or 0
+    conn.execute(
+        ChangeLog.__table__.update().where(ChangeLog.version.is_(None)).values(version=base + 1)
+    )
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop("change_log_pending", None)
+
+
+def current_version():
+    """
+    Версия, после которой журнал больше не пополнится записями с меньшей
+    или равной версией. В PostgreSQL транзакции фиксируются не в порядке
+    своих номеров, поэтому это не max(version), а номер перед xmin текущего
+    снимка: все транзакции с меньшими номерами уже завершены. Долгая
+    пишущая транзакция задерживает дельты, но не теряет изменений.
+    """
+    if db.session.get_bind().dialect.name == "postgresql":
+        xmin = db.session.execute(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")).scalar()
+        return xmin - 1
+    return db.session.query(func.max(ChangeLog.version)).scalar() or 0
+
+
+def _user_row(user, role_id):
+    return {"id": user.id, "nfc_tag": user.nfc_tag, "role_id": role_id}
+
+
+def _key_row(key, slot_number, role_id):
+    return {
+        "id": key.id,
+        "key_number": key.key_number,
+        "role_id": role_id,
+        "slot_number": slot_number
+    }
+
+
+def _slot_row(slot):
+    return {"id": slot.id, "number": slot.number, "is_locked": bool(slot.is_locked)}
+
+
+def _users(*criteria):
+    # Роль - внешним id, как в остальном API
+    query = db.session.query(User, Role.id).outerjoin(Role, Role.pk == User.role_pk).filter(*criteria)
+    return [_user_row(user, role_id) for user, role_id in query.all()]
+
+
+def _device_keys(device_pk, key_ids=None):
+    # Ключи, закреплённые за ячейками этого устройства
+    query = (
+        db.session.query(Key, KeySlot.number, Role.id)
+        .join(KeySlot, KeySlot.pk == Key.key_slot_pk)
+        .outerjoin(Role, Role.pk == Key.assigned_role_pk)
+        .filter(KeySlot.device_pk == device_pk)
+    )
+    if key_ids is not None:
+        query = query.filter(Key.id.in_(key_ids))
+    return [_key_row(key, number, role_id) for key, number, role_id in query.all()]
+
+
+def build_snapshot(device_pk):
+    version = current_version()
+    return {
+        "version": version,
+        "full": True,
+        "users": _users(User.nfc_tag.isnot(None)),
+        "keys": _device_keys(device_pk),
+        "slots": [_slot_row(s) for s in KeySlot.query.filter_by(device_pk=device_pk).all()]
+    }
+
+
+def build_delta(device_pk, since):
+    """
+    Изменения после версии since для устройства device_pk, или None,
+    если часть журнала уже удалена и нужен полный снимок.
+    """
+    # Границу берём до чтения журнала: всё, что до неё, уже видно
+    horizon = current_version()
+    oldest = db.session.query(func.min(ChangeLog.version)).scalar()
+    # Курсор старше очищенной части журнала или не из этой нумерации
+    if (oldest is not None and since < oldest) or since > horizon:
+        return None
+
+    changes = (
+        ChangeLog.query
+        .filter(ChangeLog.version > since, ChangeLog.version <= horizon)
+        .order_by(ChangeLog.version, ChangeLog.id)
+        .limit(DELTA_LIMIT + 1)
+        .all()
+    )
+    more = len(changes) > DELTA_LIMIT
+    if more:
+        # Страница заканчивается на границе версии: курсор не может указывать
+        # на середину транзакции
+        cut = changes[DELTA_LIMIT].version
+        changes = [change for change in changes if change.version < cut]
+        if not changes:
+            changes = ChangeLog.query.filter(ChangeLog.version == cut).order_by(ChangeLog.id).all()
+        version = changes[-1].version
+    else:
+        version = horizon
+
+    ids = {"user": set(), "key": set(), "key_slot": set()}
+    for change in changes:
+        ids[change.entity].add(change.entity_id)
+
+    users = _users(User.id.in_(ids["user"])) if ids["user"] else []
+    keys = _device_keys(device_pk, ids["key"]) if ids["key"] else []
+    slots = (
+        KeySlot.query.filter(KeySlot.id.in_(ids["key_slot"]), KeySlot.device_pk == device_pk).all()
+        if ids["key_slot"] else []
+    )
+    return {
+        "version": version,
+        "full": False,
+        "more": more,
+        "users": users,
+        "removed_users": sorted(ids["user"] - {u["id"] for u in users}),
+        "keys": keys,
+        # Ключ удалён или перенесён в другое устройство
+        "removed_keys": sorted(ids["key"] - {k["id"] for k in keys}),
+        "slots": [_slot_row(s) for s in slots],
+        "removed_slots": sorted(ids["key_slot"] - {s.id for s in slots})
+    }
+
+
+def prune_change_log(older_than_days):
+    """
+    Удаляет старые записи журнала. Записи последней из старых версий
+    остаются: курсор меньше неё build_delta считает устаревшим.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    boundary = db.session.query(func.max(ChangeLog.version)).filter(ChangeLog.created_at < cutoff).scalar()
+    if boundary is None:
+        return 0
+    deleted = ChangeLog.query.filter(ChangeLog.version < boundary).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,167 @@
+from collections import Counter
+
+from sqlalchemy import select, func, update
+
+from app.models import db, Key, KeySlot, Operation
+from app.utils.holdings import sync_holding
+
+CHUNK_SIZE = 1000
+# Проблемы, которые исправляются по последней операции ключа
+REPAIRABLE = {"taken_key_in_slot", "is_taken_mismatch", "last_user_mismatch", "last_device_mismatch"}
+
+
+def _latest_operation_id():
+    # Последняя операция ключа через индекс (key_pk, timestamp)
+    return (
+        select(Operation.id)
+        .where(Operation.key_pk == Key.pk)
+        .order_by(Operation.timestamp.desc(), Operation.id.desc())
+        .limit(1)
+        .correlate(Key)
+        .scalar_subquery()
+    )
+
+
+def _key_chunks(chunk_size):
+    """Ключи с их последней операцией и устройством ячейки, порциями по pk."""
+    base = (
+        select(
+            Key.pk, Key.id, Key.key_number, Key.is_taken, Key.key_slot_pk, Key.last_user_pk,
+            Key.last_device_pk, Key.updated_at, KeySlot.device_pk.label("slot_device_pk"),
+            Operation.type.label("op_type"), Operation.user_pk.label("op_user_pk"),
+            Operation.device_pk.label("op_device_pk"), Operation.timestamp.label("op_timestamp")
+        )
+        .outerjoin(KeySlot, KeySlot.pk == Key.key_slot_pk)
+        .outerjoin(Operation, Operation.id == _latest_operation_id())
+        .order_by(Key.pk)
+        .limit(chunk_size)
+    )
+    last_pk = None
+    while True:
+        query = base if last_pk is None else base.where(Key.pk > last_pk)
+        rows = db.session.execute(query).all()
+        # Каждая порция - отдельная короткая транзакция
+        db.session.commit()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1].pk
+
+
+def _key_problems(row):
+    problems = []
+    if row.is_taken and row.key_slot_pk:
+        problems.append("taken_key_in_slot")
+    if not row.is_taken and not row.key_slot_pk:
+        problems.append("returned_key_without_slot")
+    if row.op_type is None:
+        return problems
+    if row.is_taken != (row.op_type == "TAKE"):
+        problems.append("is_taken_mismatch")
+    if row.last_user_pk != row.op_user_pk:
+        problems.append("last_user_mismatch")
+    if row.last_device_pk != row.op_device_pk:
+        problems.append("last_device_mismatch")
+    if row.op_type == "RETURN" and row.slot_device_pk and row.slot_device_pk != row.op_device_pk:
+        problems.append("slot_device_mismatch")
+    return problems
+
+
+def _repair_key(row):
+    """
+    Приводит ключ к его последней операции. Обновление условное (по updated_at),
+    чтобы не затереть выдачу или возврат, прошедшие после чтения порции.
+    key_holding исправляется в той же транзакции.
+    """
+    values = {
+        "is_taken": row.op_type == "TAKE",
+        "last_user_pk": row.op_user_pk,
+        "last_device_pk": row.op_device_pk
+    }
+    if row.op_type == "TAKE":
+        values["key_slot_pk"] = None
+    result = db.session.execute(
+        update(Key)
+        .where(Key.pk == row.pk, Key.updated_at == row.updated_at)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    sync_holding(
+        row.pk, values["is_taken"], row.op_user_pk, row.op_device_pk, row.op_timestamp or row.updated_at
+    )
+    return True
+
+
+def _duplicate_slots():
+    # (pk, внешний id) ячеек с несколькими ключами
+    duplicates = (
+        select(Key.key_slot_pk)
+        .where(Key.key_slot_pk.isnot(None))
+        .group_by(Key.key_slot_pk)
+        .having(func.count() > 1)
+    )
+    return db.session.execute(select(KeySlot.pk, KeySlot.id).where(KeySlot.pk.in_(duplicates))).all()
+
+
+def _repair_slot(slot_pk):
+    """В ячейке остаётся ключ с самой поздней операцией, остальные из неё убираются."""
+    last_operation_at = (
+        select(func.max(Operation.timestamp))
+        .where(Operation.key_pk == Key.pk)
+        .correlate(Key)
+        .scalar_subquery()
+    )
+    keys = db.session.execute(
+        select(Key.pk, Key.updated_at, last_operation_at.label("last_operation_at"))
+        .where(Key.key_slot_pk == slot_pk)
+    ).all()
+    keys.sort(key=lambda k: (k.last_operation_at is not None, k.last_operation_at or k.updated_at))
+    for key in keys[:-1]:
+        db.session.execute(
+            update(Key)
+            .where(Key.pk == key.pk, Key.updated_at == key.updated_at)
+            .values(key_slot_pk=None)
+            .execution_options(synchronize_session=False)
+        )
+    return len(keys) - 1
+
+
+def check_consistency(repair=False, chunk_size=CHUNK_SIZE, report=None, progress=None):
+    """
+    Сверяет ключи, ячейки и последние операции порциями по chunk_size ключей.
+    report(kind, entity_id, key_number) вызывается для каждой найденной проблемы
+    (entity_id - id ключа или, для ячеек, id ячейки), progress(checked) - после
+    каждой порции ключей.
+    При repair=True ключи приводятся к последней операции журнала, а из ячеек
+    с несколькими ключами убираются все, кроме последнего возвращённого.
+    Возвращает счётчики проблем и исправлений.
+    """
+    counts = Counter()
+    for rows in _key_chunks(chunk_size):
+        counts["keys"] += len(rows)
+        to_repair = []
+        for row in rows:
+            problems = _key_problems(row)
+            for kind in problems:
+                counts[kind] += 1
+                if report:
+                    report(kind, row.id, row.key_number)
+            if repair and row.op_type is not None and REPAIRABLE.intersection(problems):
+                to_repair.append(row)
+        if to_repair:
+            counts["repaired_keys"] += sum(_repair_key(row) for row in to_repair)
+            db.session.commit()
+        if progress:
+            progress(counts["keys"])
+
+    for slot_pk, slot_id in _duplicate_slots():
+        counts["slot_with_several_keys"] += 1
+        if report:
+            report("slot_with_several_keys", slot_id, None)
+        if repair:
+            counts["repaired_slots"] += _repair_slot(slot_pk)
+            db.session.commit()
+    return counts
@@ -1,7 +1,12 @@
-from flask import request, jsonify
+from flask import request, jsonify, g
 from app.utils.jwt_utils import decode_jwt
 from functools import wraps
 from app.utils.admin_jwt_utils import verify_admin_jwt
+from app.utils.replicas import replica_router
+from app.utils.rate_limit import rate_limiter
+from app.utils.revocation import token_revocations
+from app.models import Device, db
+from sqlalchemy.exc import IntegrityError
 
 def require_admin_auth(f):
     from functools import wraps
@@ -17,6 +22,28 @@ def require_admin_auth(f):
         request.admin_id = admin_id
         return f(*args, **kwargs)
     return decorated_function
+
+
+def require_admin_stream_auth(f):
+    # Для потоков SSE: EventSource в браузере не умеет передавать заголовок
+    # Authorization, поэтому токен принимается ещё из ?access_token= или cookie admin_token
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get("Authorization", "")
+        if auth_header.startswith("Bearer "):
+            token = auth_header.split(" ")[1]
+        else:
+            token = request.args.get("access_token") or request.cookies.get("admin_token")
+        if not token:
+            return jsonify({"error": "Authorization header is missing"}), 401
+        admin_id = verify_admin_jwt(token)
+        if not admin_id:
+            return jsonify({"error": "Invalid or expired token"}), 401
+        request.admin_id = admin_id
+        return f(*args, **kwargs)
+    return decorated
+
+
 def require_device_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -27,10 +54,59 @@ def require_device_auth(f):
         try:
             payload = decode_jwt(token)
             request.device_id = payload.get("device_id")
-            if not request.device_id:
+            request.device_pk = payload.get("device_pk")
+            if not request.device_id or not request.device_pk:
                 return jsonify({"error": "Invalid token payload"}), 403
         except Exception as e:
             return jsonify({"error": "Invalid or expired token", "details": str(e)}), 403
+        # Токену доверяем без запроса к Device: удаление устройства или смена
+        # его ключа отзывает ранее выданные токены
+        if token_revocations.is_revoked(request.device_id, payload.get("iat", 0)):
+            return jsonify({"error": "Token revoked"}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+
+def revoke_on_missing_device(f):
+    # Для обработчиков, которые пишут операции от имени устройства. Отзыв по шине
+    # с INVALIDATION_BACKEND=memory виден другим воркерам только через
+    # REFRESH_SECONDS - до этого токен удалённого устройства проходит
+    # require_device_auth, и запись падает на внешнем ключе. Устройство ищем
+    # только в этом случае, обычный запрос лишнего обращения к БД не делает
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except IntegrityError:
+            db.session.rollback()
+            if db.session.get(Device, request.device_pk) is not None:
+                raise
+            token_revocations.revoke(request.device_id)
+            return jsonify({"error": "Token revoked"}), 401
+    return decorated
+
+
+def rate_limit(f):
+    # Ставится под require_device_auth, чтобы знать device_id
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        retry_after = rate_limiter.check(request.remote_addr, getattr(request, "device_id", None))
+        if retry_after is not None:
+            return jsonify({"status": "error", "reason": "Too many requests"}), 429, {"Retry-After": str(retry_after)}
         return f(*args, **kwargs)
     return decorated
 
+
+def use_read_replica(f):
+    # Только для обработчиков, которые ничего не пишут в базу
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        engine = replica_router.pick()
+        if engine is None:
+            return f(*args, **kwargs)
+        g.read_engine = engine
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.pop("read_engine", None)
+    return decorated
@@ -0,0 +1,108 @@
+import threading
+from collections import deque
+
+from app.utils.invalidation import invalidation_bus
+
+# Сколько последних команд хранится для каждого устройства
+COMMAND_HISTORY_SIZE = 100
+LONG_POLL_MAX_SECONDS = 30
+
+
+class _DeviceChannel:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.commands = deque(maxlen=COMMAND_HISTORY_SIZE)
+
+
+class DeviceCommandRegistry:
+    """
+    Реестр ожидающих long-poll запросов устройств.
+    Для каждого устройства хранится своя очередь команд и своё условие,
+    поэтому изменение одного устройства будит только его ожидающие запросы.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def _channel(self, device_id, create=True):
+        # Каналы создаются только для существующих устройств: push вызывается
+        # после изменения устройства, wait - после проверки устройства в БД
+        with self._lock:
+            channel = self._channels.get(device_id)
+            if channel is None and create:
+                channel = self._channels[device_id] = _DeviceChannel()
+            return channel
+
+    def push(self, device_id, command):
+        channel = self._channel(device_id)
+        with channel.cond:
+            channel.version += 1
+            channel.commands.append((channel.version, command))
+            channel.cond.notify_all()
+            return channel.version
+
+    def current_version(self, device_id):
+        channel = self._channel(device_id, create=False)
+        if channel is None:
+            return 0
+        with channel.cond:
+            return channel.version
+
+    def wait(self, device_id, since, timeout):
+        """
+        Возвращает (version, commands, full). full=True означает, что
+        команды после since уже вытеснены из истории (или since из прошлого
+        запуска сервера) и устройству нужна полная конфигурация.
+        """
+        channel = self._channel(device_id)
+        with channel.cond:
+            channel.cond.wait_for(lambda: channel.version != since, timeout)
+            if channel.version == since:
+                return since, [], False
+
+            oldest = channel.commands[0][0] if channel.commands else channel.version + 1
+            if since > channel.version or since + 1 < oldest:
+                return channel.version, [], True
+
+            commands = [cmd for version, cmd in channel.commands if version > since]
+            return channel.version, commands, False
+
+    def invalidate(self, device_id):
+        """
+        Сбрасывает историю команд: ожидающие запросы получат полную
+        конфигурацию из БД. Используется, когда изменение пришло с другого
+        экземпляра API и сами команды неизвестны.
+        """
+        channel = self._channel(device_id, create=False)
+        if channel is None:
+            return
+        with channel.cond:
+            channel.version += 1
+            channel.commands.clear()
+            channel.cond.notify_all()
+
+    def invalidate_all(self):
+        with self._lock:
+            device_ids = list(self._channels)
+        for device_id in device_ids:
+            self.invalidate(device_id)
+
+    def forget(self, device_id):
+        self.invalidate(device_id)
+        with self._lock:
+            self._channels.pop(device_id, None)
+
+
+device_commands = DeviceCommandRegistry()
+
+
+def _on_device_invalidated(entity, device_id):
+    if device_id is None:
+        device_commands.invalidate_all()
+    else:
+        device_commands.invalidate(device_id)
+
+
+invalidation_bus.subscribe("device", _on_device_invalidated, remote_only=True)
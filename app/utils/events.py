@@ -0,0 +1,128 @@
+import json
+import threading
+import uuid
+from collections import deque
+
+# Сколько последних событий хранится для переподключения по Last-Event-ID
+HISTORY_SIZE = 1000
+# Максимальное число непрочитанных событий на одного подписчика
+SUBSCRIBER_BUFFER_SIZE = 256
+HEARTBEAT_SECONDS = 15
+
+
+class Subscriber:
+    def __init__(self, buffer_size):
+        self.queue = deque(maxlen=buffer_size)
+        # Выставляется, если подписчик пропустил события (переполнение буфера
+        # или слишком старый Last-Event-ID) и должен перечитать состояние целиком
+        self.needs_reset = False
+
+
+class EventHub:
+    """
+    Внутрипроцессная рассылка событий подписчикам SSE.
+    Каждый подписчик имеет свой ограниченный буфер, так что медленный клиент
+    не задерживает остальных и не раздувает память.
+    Id события - "<epoch>-<номер>": номера свои в каждом процессе, и по epoch
+    переподключение к другому воркеру (или после перезапуска) получает reset,
+    а не чужие события с теми же номерами.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE, buffer_size=SUBSCRIBER_BUFFER_SIZE):
+        self._cond = threading.Condition()
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self._buffer_size = buffer_size
+        self._last_id = 0
+        self.epoch = uuid.uuid4().hex[:8]
+
+    def event_id(self, number):
+        return f"{self.epoch}-{number}"
+
+    def _parse_event_id(self, last_event_id):
+        """Номер события этого процесса или None, если id чужой или некорректный."""
+        epoch, _, number = str(last_event_id).rpartition("-")
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        return int(number)
+
+    def publish(self, event_type, data):
+        with self._cond:
+            self._last_id += 1
+            event = (self._last_id, event_type, data)
+            self._history.append(event)
+            for sub in self._subscribers:
+                if len(sub.queue) == sub.queue.maxlen:
+                    sub.needs_reset = True
+                sub.queue.append(event)
+            self._cond.notify_all()
+            return self._last_id
+
+    def subscribe(self, last_event_id=None):
+        sub = Subscriber(self._buffer_size)
+        with self._cond:
+            if last_event_id:
+                number = self._parse_event_id(last_event_id)
+                if number is None:
+                    # Id выдан другим процессом: какие события пропущены, неизвестно
+                    sub.needs_reset = True
+                    last_event_id = self._last_id
+                else:
+                    last_event_id = number
+                missed = [e for e in self._history if e[0] > last_event_id]
+                oldest_id = self._history[0][0] if self._history else self._last_id + 1
+                # Часть событий уже вытеснена из истории или номер больше выданных
+                if last_event_id + 1 < oldest_id or last_event_id > self._last_id:
+                    sub.needs_reset = True
+                if len(missed) > sub.queue.maxlen:
+                    sub.needs_reset = True
+                sub.queue.extend(missed)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._cond:
+            self._subscribers.discard(sub)
+
+    def wait(self, sub, timeout):
+        with self._cond:
+            if not sub.queue and not sub.needs_reset:
+                self._cond.wait(timeout)
+            events = list(sub.queue)
+            sub.queue.clear()
+            reset = sub.needs_reset
+            sub.needs_reset = False
+        return events, reset
+
+    def subscriber_count(self):
+        with self._cond:
+            return len(self._subscribers)
+
+
+def format_sse(data, event_type=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event_type:
+        lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_events(hub, sub, heartbeat=HEARTBEAT_SECONDS):
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            events, reset = hub.wait(sub, heartbeat)
+            if reset:
+                # Клиент должен заново загрузить /admin/keys/ и /admin/operations/
+                yield format_sse({}, event_type="reset")
+            if not events and not reset:
+                yield ": keep-alive\n\n"
+            for number, event_type, data in events:
+                yield format_sse(data, event_type=event_type, event_id=hub.event_id(number))
+    finally:
+        hub.unsubscribe(sub)
+
+
+event_hub = EventHub()
@@ -0,0 +1,80 @@
+from sqlalchemy import select, func
+
+from app.models import db, Key, KeyHolding, Operation, User, Role, Device
+
+
+def record_take(key, user, device_id, taken_at):
+    """Добавляет выдачу в текущую транзакцию (merge - на случай устаревшей строки)."""
+    db.session.merge(KeyHolding(
+        key_pk=key.pk, user_id=user.id, role_id=user.role.id if user.role else None,
+        device_id=device_id, taken_at=taken_at
+    ))
+
+
+def record_return(key_pk):
+    db.session.query(KeyHolding).filter_by(key_pk=key_pk).delete(synchronize_session=False)
+
+
+def sync_holding(key_pk, is_taken, user_pk, device_pk, taken_at):
+    """
+    Приводит строку key_holding к состоянию ключа в текущей транзакции
+    (для исправлений по журналу, где есть только pk).
+    """
+    if not is_taken:
+        record_return(key_pk)
+        return
+    user_id, role_id = db.session.execute(
+        select(User.id, Role.id).outerjoin(Role, Role.pk == User.role_pk).where(User.pk == user_pk)
+    ).first() or (None, None)
+    device_id = db.session.execute(select(Device.id).where(Device.pk == device_pk)).scalar()
+    db.session.merge(KeyHolding(
+        key_pk=key_pk, user_id=user_id, role_id=role_id, device_id=device_id, taken_at=taken_at
+    ))
+
+
+def select_holdings():
+    return (
+        select(
+            Key.id, Key.key_number, KeyHolding.user_id, User.name,
+            KeyHolding.role_id, KeyHolding.device_id, KeyHolding.taken_at
+        )
+        .join(Key, Key.pk == KeyHolding.key_pk)
+        .outerjoin(User, User.id == KeyHolding.user_id)
+    )
+
+
+def rebuild_holdings():
+    """
+    Пересобирает таблицу по выданным ключам и их последней выдаче.
+    Возвращает число выданных ключей.
+    """
+    taken_at = (
+        select(func.max(Operation.timestamp))
+        .where(Operation.key_pk == Key.pk, Operation.type == "TAKE")
+        .correlate(Key)
+        .scalar_subquery()
+    )
+    rows = db.session.execute(
+        select(Key.pk, User.id, Role.id, Device.id, taken_at, Key.updated_at)
+        .outerjoin(User, User.pk == Key.last_user_pk)
+        .outerjoin(Role, Role.pk == User.role_pk)
+        .outerjoin(Device, Device.pk == Key.last_device_pk)
+        .where(Key.is_taken.is_(True))
+    ).all()
+    db.session.query(KeyHolding).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(KeyHolding.__table__.insert(), [
+            {"key_pk": key_pk, "user_id": user_id, "role_id": role_id, "device_id": device_id,
+             "taken_at": taken or updated}
+            for key_pk, user_id, role_id, device_id, taken, updated in rows
+        ])
+    db.session.commit()
+    return len(rows)
+
+
+def ensure_holdings():
+    """При первом запуске с новой таблицей заполняет её по текущим ключам."""
+    if db.session.query(KeyHolding.key_pk).first() is not None:
+        return
+    if db.session.query(Key.pk).filter(Key.is_taken.is_(True)).first() is not None:
+        rebuild_holdings()
@@ -0,0 +1,146 @@
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+CHANNEL = "keybox_invalidation"
+RECONNECT_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresTransport:
+    """
+    Рассылка инвалидаций между экземплярами API через LISTEN/NOTIFY.
+    Слушающее соединение живёт в отдельном фоновом потоке.
+    """
+
+    def __init__(self, dsn, instance_id, on_message):
+        self.dsn = dsn
+        self.instance_id = instance_id
+        self.on_message = on_message
+        self._send_lock = threading.Lock()
+        self._send_conn = None
+
+    def start(self):
+        thread = threading.Thread(target=self._listen_forever, name="invalidation-listener", daemon=True)
+        thread.start()
+
+    def send(self, entity, entity_id):
+        # None ("всё по сущности") передаётся пустой строкой - пустых id не бывает
+        payload = f"{self.instance_id}:{entity}:{'' if entity_id is None else entity_id}"
+        with self._send_lock:
+            try:
+                if self._send_conn is None or self._send_conn.closed:
+                    self._send_conn = psycopg2.connect(self.dsn)
+                    self._send_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with self._send_conn.cursor() as cur:
+                    cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+            except psycopg2.Error:
+                logger.exception("Не удалось отправить инвалидацию %s", payload)
+                self._send_conn = None
+
+    def _listen_forever(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Соединение LISTEN потеряно, переподключение")
+            time.sleep(RECONNECT_SECONDS)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {CHANNEL}")
+        # Пока соединения не было, сообщения могли потеряться: сбрасываем всё
+        self.on_message("*", None)
+        try:
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    origin, entity, entity_id = notify.payload.split(":", 2)
+                    if origin != self.instance_id:
+                        self.on_message(entity, entity_id or None)
+        finally:
+            conn.close()
+
+
+class InvalidationBus:
+    """
+    Шина инвалидаций: админские изменения публикуют (сущность, id),
+    локальные кэши подписываются на нужные сущности.
+    Без транспорта (INVALIDATION_BACKEND=memory) работает в пределах процесса.
+    Подписка на "*" получает все сообщения; entity "*" с id None означает
+    "сбросить всё" (например, после переподключения к шине).
+    """
+
+    def __init__(self):
+        self.instance_id = uuid.uuid4().hex[:8]
+        self._handlers = defaultdict(list)
+        self._lock = threading.Lock()
+        self._transport = None
+        self._transport_pid = None
+
+    def init_app(self, app):
+        """
+        Слушающий поток один на процесс: повторные create_app() (тесты,
+        CLI, несколько приложений) используют уже запущенный транспорт.
+        После fork поток родителя в дочернем процессе не существует -
+        транспорт запускается заново, с новым instance_id.
+        """
+        backend = app.config.get("INVALIDATION_BACKEND", "memory")
+        if backend == "postgres":
+            dsn = app.config.get("INVALIDATION_DATABASE_URL") or app.config["SQLALCHEMY_DATABASE_URI"]
+            dsn = dsn.replace("postgresql+psycopg2://", "postgresql://")
+            with self._lock:
+                if self._transport and self._transport_pid == os.getpid():
+                    if self._transport.dsn != dsn:
+                        raise ValueError("Invalidation bus is already listening on another database")
+                    return
+                if self._transport_pid is not None:
+                    self.instance_id = uuid.uuid4().hex[:8]
+                self._transport = PostgresTransport(dsn, self.instance_id, self._receive_remote)
+                self._transport_pid = os.getpid()
+            self._transport.start()
+        elif backend != "memory":
+            raise ValueError(f"Unknown INVALIDATION_BACKEND: {backend}")
+
+    def subscribe(self, entity, handler, remote_only=False):
+        """handler(entity, entity_id) вызывается при каждой инвалидации entity."""
+        with self._lock:
+            self._handlers[entity].append((handler, remote_only))
+
+    def publish(self, entity, entity_id):
+        self._dispatch(entity, entity_id, remote=False)
+        if self._transport:
+            self._transport.send(entity, entity_id)
+
+    def _receive_remote(self, entity, entity_id):
+        self._dispatch(entity, entity_id, remote=True)
+
+    def _dispatch(self, entity, entity_id, remote):
+        with self._lock:
+            if entity == "*":
+                handlers = [h for hs in self._handlers.values() for h in hs]
+            else:
+                handlers = self._handlers[entity] + self._handlers["*"]
+        for handler, remote_only in handlers:
+            if remote_only and not remote:
+                continue
+            try:
+                handler(entity, entity_id)
+            except Exception:
+                logger.exception("Ошибка обработчика инвалидации %s:%s", entity, entity_id)
+
+
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,395 @@
+import inspect
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from app.models import db, Job
+from app.utils.archive import archive_operations
+from app.utils.changes import prune_change_log
+from app.utils.consistency import check_consistency
+from app.utils.events import event_hub
+from app.utils.holdings import rebuild_holdings
+from app.utils.key_state import build_snapshots
+from app.utils.partitions import ensure_operation_partitions
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ("succeeded", "failed", "cancelled")
+# Не чаще одной записи прогресса в БД за столько секунд
+PROGRESS_INTERVAL = 1.0
+# Сколько проблем check_consistency попадает в результат задачи
+MAX_REPORTED_PROBLEMS = 1000
+POLL_SECONDS = 2
+# Как часто выполняющиеся задачи отмечаются в БД (updated_at) и читается cancel_requested
+HEARTBEAT_SECONDS = 15
+# Задача running без отметки дольше этого времени брошена (процесс остановлен) и
+# возвращается в очередь; очередь, которую дольше никто не забирает, подхватывает пул
+STALE_SECONDS = 120
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobAlreadyActive(Exception):
+    """Задача этого типа уже в очереди или выполняется (job_id - её id)."""
+
+    def __init__(self, job_id):
+        super().__init__(f"Job {job_id} is already queued or running")
+        self.job_id = job_id
+
+
+class JobContext:
+    """
+    Передаётся в задачу. progress() сохраняет прогресс и заодно проверяет
+    запрос отмены: задача прерывается исключением JobCancelled в ближайшей
+    точке, где сообщает о прогрессе (после закоммиченной порции работы).
+    """
+
+    def __init__(self, job_id, runner):
+        self.job_id = job_id
+        self._runner = runner
+        self._last_write = 0.0
+
+    def progress(self, message, force=False):
+        if self._runner.cancel_seen(self.job_id):
+            raise JobCancelled()
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+        # Отдельное соединение: прогресс не должен коммитить незавершённую работу задачи
+        with db.engine.begin() as conn:
+            conn.execute(
+                update(Job).where(Job.id == self.job_id)
+                .values(progress=str(message), updated_at=datetime.utcnow())
+            )
+            cancel = conn.execute(
+                select(Job.cancel_requested).where(Job.id == self.job_id)
+            ).scalar()
+        if cancel:
+            raise JobCancelled()
+
+
+def _check_consistency_job(ctx, repair=False, chunk_size=1000):
+    problems = []
+
+    def report(kind, entity_id, key_number):
+        if len(problems) < MAX_REPORTED_PROBLEMS:
+            problems.append({"kind": kind, "entity_id": entity_id, "key_number": key_number})
+
+    counts = check_consistency(
+        repair=repair, chunk_size=chunk_size, report=report,
+        progress=lambda checked: ctx.progress(f"{checked} keys checked"),
+    )
+    return {"counts": dict(counts), "problems": problems}
+
+
+def _archive_operations_job(ctx, days=None, chunk_size=None):
+    config = current_app.config
+    # Как и в flask archive-operations: снимки до удаления операций
+    build_snapshots(config["KEY_SNAPSHOT_HOURS"], progress=lambda at: ctx.progress(f"snapshot {at.isoformat()}"))
+    archived = archive_operations(
+        config["ARCHIVE_DIR"],
+        days if days is not None else config["ARCHIVE_AFTER_DAYS"],
+        chunk_size or config["ARCHIVE_CHUNK_SIZE"],
+        progress=lambda done: ctx.progress(f"{done} operations archived"),
+    )
+    return {"archived": archived}
+
+
+def _snapshot_key_state_job(ctx, every_hours=None):
+    created = build_snapshots(
+        every_hours or current_app.config["KEY_SNAPSHOT_HOURS"],
+        progress=lambda at: ctx.progress(f"snapshot {at.isoformat()}"),
+    )
+    return {"snapshots": created}
+
+
+def _rebuild_holdings_job(ctx):
+    return {"taken": rebuild_holdings()}
+
+
+def _prune_change_log_job(ctx, days=30):
+    return {"deleted": prune_change_log(days)}
+
+
+def _ensure_partitions_job(ctx, months_ahead=3):
+    return {"created": ensure_operation_partitions(months_ahead)}
+
+
+# kind -> функция(ctx, **params), результат должен сериализоваться в JSON
+JOB_KINDS = {
+    "check_consistency": _check_consistency_job,
+    "archive_operations": _archive_operations_job,
+    "snapshot_key_state": _snapshot_key_state_job,
+    "rebuild_holdings": _rebuild_holdings_job,
+    "prune_change_log": _prune_change_log_job,
+    "ensure_partitions": _ensure_partitions_job,
+}
+# Типы, которые не запускаются второй раз, пока первая задача не завершена:
+# архивация дописывает одни и те же файлы (см. app/utils/archive.py)
+EXCLUSIVE_KINDS = ("archive_operations",)
+
+
+class JobRunner:
+    """
+    Фоновые задачи в пуле потоков, состояние - в таблице job.
+    Задачу забирает тот, кто первым переведёт её из queued в running
+    (условный UPDATE), поэтому пулы нескольких экземпляров API и отдельный
+    процесс flask run-jobs могут работать одновременно.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self._app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._cancelled = set()
+        # Задачи, которые выполняет этот процесс, и отданные в его пул, но ещё не начатые
+        self._running = set()
+        self._queued = set()
+        self._thread = None
+
+    def init_app(self, app):
+        self._app = app
+        self.workers = app.config.get("JOB_WORKERS", 0)
+        if self.workers > 0:
+            # Как и у overdue_scheduler: с первым запросом, а не в CLI-командах
+            app.before_request(self.ensure_started)
+
+    def ensure_started(self, pickup=True):
+        """
+        Запускает поток обслуживания: отметки выполняющихся задач, возврат
+        брошенных в очередь и (pickup) передачу задач из очереди в пул.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._maintain, args=(pickup,), name="job-heartbeat", daemon=True
+                )
+                self._thread.start()
+
+    def _maintain(self, pickup):
+        # При старте забираются все задачи очереди: их мог поставить остановленный процесс
+        waited = 0
+        while True:
+            with self._app.app_context():
+                try:
+                    self._heartbeat()
+                    requeued = self.requeue_stale()
+                    if pickup:
+                        for job_id in requeued:
+                            self._enqueue(job_id)
+                        self._pickup(waited)
+                except Exception:
+                    logger.exception("Ошибка обслуживания фоновых задач")
+                finally:
+                    db.session.remove()
+            waited = STALE_SECONDS
+            time.sleep(HEARTBEAT_SECONDS)
+
+    def _heartbeat(self):
+        with self._lock:
+            running = list(self._running)
+        if not running:
+            return
+        with db.engine.begin() as conn:
+            conn.execute(update(Job).where(Job.id.in_(running)).values(updated_at=datetime.utcnow()))
+            # Отмену могли запросить через другой экземпляр API
+            cancelled = conn.execute(
+                select(Job.id).where(Job.id.in_(running), Job.cancel_requested.is_(True))
+            ).scalars().all()
+        with self._lock:
+            self._cancelled.update(cancelled)
+
+    def requeue_stale(self):
+        """
+        Возвращает в очередь задачи running, которые давно не отмечались, -
+        их процесс остановлен. Задачи с запрошенной отменой отменяются.
+        Возвращает id возвращённых в очередь.
+        """
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=STALE_SECONDS)
+        requeued = []
+        with db.engine.begin() as conn:
+            stale = conn.execute(
+                select(Job.id, Job.cancel_requested)
+                .where(Job.status == "running", Job.updated_at < cutoff)
+            ).all()
+            for job_id, cancel_requested in stale:
+                if cancel_requested:
+                    values = dict(status="cancelled", finished_at=now)
+                else:
+                    values = dict(status="queued", started_at=None, progress="requeued")
+                # Условие повторяется: задачу мог отметить её процесс
+                if conn.execute(
+                    update(Job).where(Job.id == job_id, Job.status == "running", Job.updated_at < cutoff)
+                    .values(updated_at=now, **values)
+                ).rowcount and not cancel_requested:
+                    requeued.append(job_id)
+        if requeued:
+            logger.warning("Брошенные фоновые задачи возвращены в очередь: %s", ", ".join(requeued))
+        return requeued
+
+    def _pickup(self, waited):
+        cutoff = datetime.utcnow() - timedelta(seconds=waited)
+        job_ids = db.session.execute(
+            select(Job.id).where(Job.status == "queued", Job.updated_at <= cutoff).order_by(Job.created_at)
+        ).scalars().all()
+        db.session.rollback()
+        for job_id in job_ids:
+            self._enqueue(job_id)
+
+    def _enqueue(self, job_id):
+        with self._lock:
+            if job_id in self._queued:
+                return
+            self._queued.add(job_id)
+        self._pool().submit(self._execute, job_id)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            return self._executor
+
+    def submit(self, kind, params=None):
+        """
+        Ставит задачу в очередь; ValueError - неизвестный тип или параметры,
+        JobAlreadyActive - задача из EXCLUSIVE_KINDS уже в очереди или выполняется.
+        """
+        params = params or {}
+        fn = JOB_KINDS.get(kind)
+        if fn is None:
+            raise ValueError(f"Unknown job kind: {kind}")
+        try:
+            inspect.signature(fn).bind(None, **params)
+        except TypeError as e:
+            raise ValueError(str(e))
+        if kind in EXCLUSIVE_KINDS:
+            active = db.session.execute(
+                select(Job.id).where(Job.kind == kind, Job.status.in_(("queued", "running"))).limit(1)
+            ).scalar()
+            if active is not None:
+                raise JobAlreadyActive(active)
+
+        job = Job(kind=kind, params=json.dumps(params))
+        db.session.add(job)
+        db.session.commit()
+        if self.workers > 0:
+            self._enqueue(job.id)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Запрашивает отмену. Задача из очереди отменяется сразу, выполняющаяся -
+        при следующем сообщении о прогрессе. Возвращает False, если задача уже завершена.
+        """
+        now = datetime.utcnow()
+        updated = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status.notin_(FINISHED))
+            .values(cancel_requested=True, updated_at=now)
+        ).rowcount
+        dequeued = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == "queued")
+            .values(status="cancelled", finished_at=now)
+        ).rowcount
+        db.session.commit()
+        if updated and not dequeued:
+            with self._lock:
+                self._cancelled.add(job_id)
+        return bool(updated)
+
+    def cancel_seen(self, job_id):
+        """
+        Отмена, о которой уже известно процессу: запрошенная через него или
+        прочитанная из БД потоком обслуживания. JobContext.progress() вдобавок
+        читает cancel_requested при каждой записи прогресса.
+        """
+        with self._lock:
+            return job_id in self._cancelled
+
+    def _claim(self, job_id):
+        with db.engine.begin() as conn:
+            return conn.execute(
+                update(Job).where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", started_at=datetime.utcnow(), updated_at=datetime.utcnow())
+            ).rowcount == 1
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            conn.execute(
+                update(Job).where(Job.id == job_id)
+                .values(status=status, result=result, error=error, finished_at=now, updated_at=now)
+            )
+        with self._lock:
+            self._cancelled.discard(job_id)
+        event_hub.publish("job_finished", {"id": job_id, "status": status})
+
+    def _execute(self, job_id):
+        with self._lock:
+            self._queued.discard(job_id)
+        with self._app.app_context():
+            try:
+                if self._claim(job_id):
+                    self.run(job_id)
+            except Exception:
+                logger.exception("Ошибка фоновой задачи %s", job_id)
+            finally:
+                db.session.remove()
+
+    def run(self, job_id):
+        job = db.session.get(Job, job_id)
+        kind, params = job.kind, json.loads(job.params or "{}")
+        db.session.rollback()
+        ctx = JobContext(job_id, self)
+        with self._lock:
+            self._running.add(job_id)
+        try:
+            ctx.progress("started", force=True)
+            result = JOB_KINDS[kind](ctx, **params)
+        except JobCancelled:
+            db.session.rollback()
+            self._finish(job_id, "cancelled")
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Фоновая задача %s (%s) завершилась ошибкой", job_id, kind)
+            self._finish(job_id, "failed", error=str(e))
+        else:
+            self._finish(job_id, "succeeded", result=json.dumps(result, default=str))
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def run_pending(self, once=False, on_job=None):
+        """Цикл отдельного обработчика (flask run-jobs): забирает задачи из очереди по одной."""
+        # Задачи этот цикл забирает сам, пулу они не передаются
+        self.ensure_started(pickup=False)
+        while True:
+            job_ids = [
+                job_id for (job_id,) in db.session.query(Job.id)
+                .filter(Job.status == "queued").order_by(Job.created_at).limit(10)
+            ]
+            db.session.rollback()
+            for job_id in job_ids:
+                if self._claim(job_id):
+                    if on_job:
+                        on_job(job_id)
+                    self.run(job_id)
+            if once and not job_ids:
+                return
+            if not job_ids:
+                time.sleep(POLL_SECONDS)
+
+
+job_runner = JobRunner()
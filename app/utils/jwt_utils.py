@@ -1,15 +1,32 @@
 import jwt
 import os
+import time
 from datetime import datetime, timedelta
 
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
-EXPIRATION_MINUTES = 60
+# Срок жизни токена устройства; короткий срок - для замеров обновления токенов
+EXPIRATION_MINUTES = int(os.getenv("DEVICE_TOKEN_MINUTES", 60))
+# Истёкший токен можно обменять на новый в течение этого времени
+REFRESH_GRACE_MINUTES = 10
+# После стольких часов от /device/init/ цепочка обновлений обрывается
+REFRESH_MAX_HOURS = 24
 
 def generate_jwt(payload, expires_delta=timedelta(minutes=EXPIRATION_MINUTES)):
     payload = payload.copy()
-    payload["exp"] = datetime.utcnow() + expires_delta
+    # iat с долями секунды: отзыв сравнивается с ним как "выдан не позже",
+    # и токен, полученный в ту же секунду после отзыва, не должен считаться отозванным
+    issued_at = time.time()
+    payload["iat"] = issued_at
+    payload["exp"] = datetime.utcfromtimestamp(issued_at) + expires_delta
     return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
 
 def decode_jwt(token):
     return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
 
+
+def decode_jwt_for_refresh(token):
+    return jwt.decode(
+        token, SECRET_KEY, algorithms=["HS256"],
+        leeway=timedelta(minutes=REFRESH_GRACE_MINUTES)
+    )
+
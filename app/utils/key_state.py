@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, or_, and_
+
+from app.models import db, Operation, KeyStateSnapshot
+
+CHUNK_SIZE = 50000
+SNAPSHOT_HOURS = 24
+# Операции из ещё не завершённых транзакций могут появиться задним числом,
+# поэтому снимки не строятся ближе этого интервала к текущему времени
+SETTLE_MINUTES = 5
+EPOCH = datetime(1970, 1, 1)
+
+
+def _operations(after=None, until=None, key_pk=None, chunk_size=CHUNK_SIZE):
+    """
+    Операции в порядке (timestamp, id), порциями по chunk_size.
+    Порции выбираются по ключу (timestamp, id), а не одним курсором,
+    поэтому между порциями можно фиксировать транзакции.
+    """
+    base = select(
+        Operation.id, Operation.key_pk, Operation.user_pk,
+        Operation.device_pk, Operation.type, Operation.timestamp
+    ).where(Operation.timestamp.isnot(None))
+    if after:
+        base = base.where(Operation.timestamp > after)
+    if until:
+        base = base.where(Operation.timestamp <= until)
+    if key_pk:
+        base = base.where(Operation.key_pk == key_pk)
+
+    cursor = None
+    while True:
+        query = base
+        if cursor:
+            query = query.where(or_(
+                Operation.timestamp > cursor[0],
+                and_(Operation.timestamp == cursor[0], Operation.id > cursor[1])
+            ))
+        rows = db.session.execute(
+            query.order_by(Operation.timestamp, Operation.id).limit(chunk_size)
+        ).all()
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        cursor = (rows[-1].timestamp, rows[-1].id)
+
+
+def fold(state, operations):
+    """
+    Применяет операции к состоянию {key_pk: (is_taken, user_pk, device_pk, since)}.
+    После TAKE user_pk - кто держит ключ, device_pk - откуда взят;
+    после RETURN - кто вернул и в какое устройство. Возвращает число операций.
+    """
+    count = 0
+    for _, key_pk, user_pk, device_pk, type_, ts in operations:
+        state[key_pk] = (type_ == "TAKE", user_pk, device_pk, ts)
+        count += 1
+    return count
+
+
+def _latest_snapshot_time(until=None):
+    query = db.session.query(func.max(KeyStateSnapshot.taken_at))
+    if until:
+        query = query.filter(KeyStateSnapshot.taken_at <= until)
+    return query.scalar()
+
+
+def _load_snapshot(taken_at, key_pk=None):
+    query = select(
+        KeyStateSnapshot.key_pk, KeyStateSnapshot.is_taken, KeyStateSnapshot.user_pk,
+        KeyStateSnapshot.device_pk, KeyStateSnapshot.since
+    ).where(KeyStateSnapshot.taken_at == taken_at)
+    if key_pk:
+        query = query.where(KeyStateSnapshot.key_pk == key_pk)
+    return {row[0]: tuple(row[1:]) for row in db.session.execute(query)}
+
+
+def _write_snapshot(taken_at, state, chunk_size=CHUNK_SIZE):
+    rows = [
+        {"taken_at": taken_at, "key_pk": key_pk, "is_taken": is_taken,
+         "user_pk": user_pk, "device_pk": device_pk, "since": since}
+        for key_pk, (is_taken, user_pk, device_pk, since) in state.items()
+    ]
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(KeyStateSnapshot.__table__.insert(), rows[i:i + chunk_size])
+    db.session.commit()
+
+
+def _next_boundary(moment, step):
+    # Границы снимков кратны step от эпохи, чтобы не зависеть от времени запуска
+    steps = (moment - EPOCH) // step + 1
+    return EPOCH + steps * step
+
+
+def state_at(ts, key_pk=None):
+    """
+    Состояние ключей на момент ts: ближайший предыдущий снимок плюс
+    операции после него. Возвращает (состояние, время снимка, число операций).
+    """
+    snapshot_at = _latest_snapshot_time(ts)
+    state = _load_snapshot(snapshot_at, key_pk) if snapshot_at else {}
+    replayed = fold(state, _operations(snapshot_at, ts, key_pk))
+    return state, snapshot_at, replayed
+
+
+def build_snapshots(every_hours=SNAPSHOT_HOURS, until=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Дописывает снимки на границах каждых every_hours часов от последнего
+    снимка до until за один проход по журналу. Интервалы без операций
+    пропускаются: для них подходит предыдущий снимок.
+    Возвращает число созданных снимков.
+    """
+    step = timedelta(hours=every_hours)
+    until = until or datetime.utcnow() - timedelta(minutes=SETTLE_MINUTES)
+    start = _latest_snapshot_time()
+    if start:
+        state = _load_snapshot(start)
+    else:
+        start = db.session.query(func.min(Operation.timestamp)).scalar()
+        if start is None:
+            return 0
+        start -= timedelta(microseconds=1)
+        state = {}
+
+    boundary = _next_boundary(start, step)
+    if boundary > until:
+        return 0
+    created, changed = 0, False
+    for _, key_pk, user_pk, device_pk, type_, ts in _operations(start, until, chunk_size=chunk_size):
+        if ts > boundary:
+            if changed:
+                _write_snapshot(boundary, state, chunk_size)
+                created += 1
+                if progress:
+                    progress(boundary)
+            # Ближайшая граница, не раньше этой операции
+            boundary = _next_boundary(ts - timedelta(microseconds=1), step)
+            changed = False
+        state[key_pk] = (type_ == "TAKE", user_pk, device_pk, ts)
+        changed = True
+
+    # Все операции до until учтены, значит и до границы, если она не позже until
+    if changed and boundary <= until:
+        _write_snapshot(boundary, state, chunk_size)
+        created += 1
+    return created
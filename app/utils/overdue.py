@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.models import db, Key, KeyHolding, Device
+from app.utils.events import event_hub
+from app.utils.invalidation import invalidation_bus
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MINUTES = 480
+# Сколько /admin/overdue/ ждёт первичной загрузки после старта
+READY_WAIT_SECONDS = 5
+
+
+def parse_role_minutes(value):
+    """'role_id=minutes,role_id=minutes' -> {role_id: minutes}"""
+    result = {}
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        role_id, minutes = item.split("=", 1)
+        result[role_id.strip()] = int(minutes)
+    return result
+
+
+class Hold:
+    __slots__ = ("key_id", "key_number", "user_id", "role_id", "device_id", "taken_at", "due_at")
+
+    def __init__(self, key_id, key_number, user_id, role_id, device_id, taken_at, due_at):
+        self.key_id = key_id
+        self.key_number = key_number
+        self.user_id = user_id
+        self.role_id = role_id
+        self.device_id = device_id
+        self.taken_at = taken_at
+        self.due_at = due_at
+
+    def to_dict(self, now):
+        return {
+            "key_id": self.key_id,
+            "key_number": self.key_number,
+            "user_id": self.user_id,
+            "role_id": self.role_id,
+            "device_id": self.device_id,
+            "taken_at": self.taken_at.isoformat(),
+            "due_at": self.due_at.isoformat(),
+            "overdue_seconds": int((now - self.due_at).total_seconds())
+        }
+
+
+class OverdueScheduler:
+    """
+    Выданные ключи в куче по сроку возврата. Фоновый поток спит до
+    ближайшего срока, помечает ключ просроченным и публикует key_overdue.
+    Выдачи и возвраты приходят через шину инвалидаций (сущность "key"),
+    поэтому учитываются и запросы, обработанные другими экземплярами API.
+    Срок: политика роли взявшего (OVERDUE_ROLE_MINUTES), иначе Device.timeout
+    устройства выдачи в минутах, иначе OVERDUE_DEFAULT_MINUTES.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.default_minutes = DEFAULT_MINUTES
+        self.role_minutes = {}
+        self._app = None
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        # key_id -> Hold для всех выданных ключей; просроченные - ещё и в _overdue
+        self._holds = {}
+        self._overdue = {}
+        self._pending = set()
+        self._reset = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config.get("OVERDUE_ENABLED", True)
+        self.default_minutes = app.config.get("OVERDUE_DEFAULT_MINUTES", DEFAULT_MINUTES)
+        self.role_minutes = parse_role_minutes(app.config.get("OVERDUE_ROLE_MINUTES"))
+        if self.enabled:
+            # Поток запускается с первым запросом, а не в CLI-командах
+            app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="overdue-scheduler", daemon=True)
+                self._thread.start()
+
+    def key_changed(self, key_id):
+        with self._cond:
+            if key_id is None:
+                self._reset = True
+            else:
+                self._pending.add(key_id)
+            self._cond.notify()
+
+    def overdue(self):
+        if not self.enabled:
+            return []
+        self._ready.wait(READY_WAIT_SECONDS)
+        now = datetime.utcnow()
+        with self._cond:
+            holds = sorted(self._overdue.values(), key=lambda h: h.due_at)
+        return [hold.to_dict(now) for hold in holds]
+
+    def _due_at(self, taken_at, role_id, device_timeout):
+        minutes = self.role_minutes.get(role_id) or device_timeout or self.default_minutes
+        return taken_at + timedelta(minutes=minutes)
+
+    def _load(self, key_ids=None):
+        """Выданные ключи (все или из key_ids) по таблице key_holding."""
+        query = (
+            select(
+                Key.id, Key.key_number, KeyHolding.user_id, KeyHolding.role_id,
+                KeyHolding.device_id, Device.timeout, KeyHolding.taken_at
+            )
+            .join(Key, Key.pk == KeyHolding.key_pk)
+            .outerjoin(Device, Device.id == KeyHolding.device_id)
+        )
+        if key_ids is not None:
+            query = query.where(Key.id.in_(key_ids))
+        holds = {}
+        for key_id, key_number, user_id, role_id, device_id, timeout, taken_at in db.session.execute(query):
+            holds[key_id] = Hold(
+                key_id, key_number, user_id, role_id, device_id, taken_at, self._due_at(taken_at, role_id, timeout)
+            )
+        return holds
+
+    def _apply(self, key_ids, holds):
+        with self._cond:
+            for key_id in key_ids:
+                hold, current = holds.get(key_id), self._holds.get(key_id)
+                if hold and current and (hold.taken_at, hold.due_at) == (current.taken_at, current.due_at):
+                    # Та же выдача (например, изменили номер ключа): событие не повторяется
+                    current.key_number = hold.key_number
+                    continue
+                self._holds.pop(key_id, None)
+                self._overdue.pop(key_id, None)
+                if hold:
+                    self._holds[key_id] = hold
+                    # Старая запись кучи для этого ключа отбрасывается при извлечении
+                    heapq.heappush(self._heap, (hold.due_at, next(self._seq), hold))
+
+    def _rebuild(self):
+        holds = self._load()
+        with self._cond:
+            self._holds = holds
+            self._overdue = {}
+            self._heap = [(hold.due_at, next(self._seq), hold) for hold in holds.values()]
+            heapq.heapify(self._heap)
+
+    def _fire_due(self):
+        now = datetime.utcnow()
+        fired = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, hold = heapq.heappop(self._heap)
+                if self._holds.get(hold.key_id) is hold:
+                    self._overdue[hold.key_id] = hold
+                    fired.append(hold)
+        for hold in fired:
+            event_hub.publish("key_overdue", hold.to_dict(now))
+
+    def _seconds_to_next(self):
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - datetime.utcnow()).total_seconds(), 0)
+
+    def _run(self):
+        with self._app.app_context():
+            try:
+                self._rebuild()
+            except Exception:
+                logger.exception("Не удалось загрузить выданные ключи")
+            finally:
+                db.session.remove()
+                self._ready.set()
+            while True:
+                with self._cond:
+                    if not self._pending and not self._reset:
+                        self._cond.wait(self._seconds_to_next())
+                    pending, self._pending = self._pending, set()
+                    reset, self._reset = self._reset, False
+                try:
+                    if reset:
+                        self._rebuild()
+                    elif pending:
+                        self._apply(pending, self._load(pending))
+                except Exception:
+                    logger.exception("Ошибка обновления выданных ключей")
+                finally:
+                    db.session.remove()
+                self._fire_due()
+
+
+overdue_scheduler = OverdueScheduler()
+
+
+def _on_key_changed(entity, key_id):
+    overdue_scheduler.key_changed(key_id)
+
+
+invalidation_bus.subscribe("key", _on_key_changed)
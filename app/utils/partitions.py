@@ -0,0 +1,169 @@
+import re
+from datetime import date
+
+from sqlalchemy import text
+
+from app.models import db
+from app.utils.schema import create_operation_indexes
+
+PARTITION_NAME = "operation_y{year:04d}m{month:02d}"
+PARTITION_RE = re.compile(r"^operation_y(\d{4})m(\d{2})$")
+# Операции без времени при конвертации попадают в самую раннюю секцию
+EPOCH = "1970-01-01"
+DEFAULT_PARTITION = "operation_default"
+# Ключ pg_advisory_xact_lock: секции создаёт только один процесс за раз
+PARTITION_LOCK_ID = 74120301
+
+
+def _is_postgres():
+    return db.engine.dialect.name == "postgresql"
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned():
+    if not _is_postgres():
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'operation' AND pg_table_is_visible(c.oid)"
+    )).first() is not None
+
+
+def _partition_exists(name):
+    return db.session.execute(
+        text("SELECT 1 FROM pg_class WHERE relname = :name AND pg_table_is_visible(oid)"),
+        {"name": name}
+    ).first() is not None
+
+
+def _create_partition(month_start):
+    """
+    Создаёт секцию месяца. Строки этого месяца, уже попавшие в секцию DEFAULT,
+    переносятся в новую таблицу до ATTACH - иначе PostgreSQL отказывается
+    подключать секцию. Возвращает имя секции или None, если она уже есть.
+    """
+    name = PARTITION_NAME.format(year=month_start.year, month=month_start.month)
+    if _partition_exists(name):
+        return None
+    start, end = month_start.isoformat(), _add_months(month_start, 1).isoformat()
+    session = db.session
+    session.execute(text(f"CREATE TABLE {name} (LIKE operation INCLUDING DEFAULTS)"))
+    if _partition_exists(DEFAULT_PARTITION):
+        session.execute(text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            f"WHERE timestamp >= '{start}' AND timestamp < '{end}' RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ))
+    # Индексы и внешние ключи секционированной таблицы создаются на секции при подключении
+    session.execute(text(f"ALTER TABLE operation ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+    return name
+
+
+def ensure_operation_partitions(months_ahead=3, since=None):
+    """
+    Создаёт помесячные секции на текущий и months_ahead следующих месяцев,
+    а при заданной дате since - и на все месяцы начиная с неё.
+    Ничего не делает, если таблица не секционирована (в т.ч. на SQLite).
+    Запускается из flask partition-operations (по cron) или фоновой задачей,
+    а не при старте каждого воркера; параллельные запуски ждут друг друга.
+    """
+    if not is_partitioned():
+        return []
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+    month = (since or date.today()).replace(day=1)
+    last = _add_months(date.today().replace(day=1), months_ahead)
+    created = []
+    while month <= last:
+        name = _create_partition(month)
+        if name:
+            created.append(name)
+        month = _add_months(month, 1)
+    db.session.commit()
+    return created
+
+
+def convert_operation_table(months_ahead=3):
+    """
+    Одноразовая миграция: переносит существующую таблицу operation
+    в таблицу, секционированную по месяцам по полю timestamp.
+    """
+    if not _is_postgres():
+        raise RuntimeError("Секционирование поддерживается только в PostgreSQL")
+    if is_partitioned():
+        return False
+
+    session = db.session
+    session.execute(text("LOCK TABLE operation IN ACCESS EXCLUSIVE MODE"))
+    session.execute(text("ALTER TABLE operation RENAME TO operation_legacy"))
+    session.execute(text("ALTER TABLE operation_legacy ALTER COLUMN id DROP DEFAULT"))
+    session.execute(text("ALTER TABLE operation_legacy RENAME CONSTRAINT operation_pkey TO operation_legacy_pkey"))
+    # Ключ секционирования обязан входить в первичный ключ
+    session.execute(text(
+        "CREATE TABLE operation ("
+        " id INTEGER NOT NULL DEFAULT nextval('operation_id_seq'),"
+        " user_pk BIGINT REFERENCES \"user\" (pk),"
+        " key_pk BIGINT REFERENCES key (pk),"
+        " device_pk BIGINT REFERENCES device (pk),"
+        " role_pk BIGINT,"
+        " type operationtype NOT NULL,"
+        " timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+        " PRIMARY KEY (id, timestamp)"
+        ") PARTITION BY RANGE (timestamp)"
+    ))
+    session.execute(text("ALTER SEQUENCE operation_id_seq OWNED BY operation.id"))
+    session.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF operation DEFAULT"))
+
+    first = session.execute(text(
+        f"SELECT min(COALESCE(timestamp, '{EPOCH}')) FROM operation_legacy"
+    )).scalar()
+    month = (first.date() if first else date.today()).replace(day=1)
+    last = _add_months(date.today().replace(day=1), months_ahead)
+    while month <= last:
+        _create_partition(month)
+        month = _add_months(month, 1)
+
+    session.execute(text(
+        "INSERT INTO operation (id, user_pk, key_pk, device_pk, role_pk, type, timestamp) "
+        f"SELECT id, user_pk, key_pk, device_pk, role_pk, type, COALESCE(timestamp, '{EPOCH}') "
+        "FROM operation_legacy"
+    ))
+    session.execute(text("DROP TABLE operation_legacy"))
+    # Индексы строятся после переноса данных, на секционированной таблице
+    # они автоматически создаются во всех секциях
+    create_operation_indexes()
+    session.commit()
+    return True
+
+
+def drop_operation_partitions(older_than_months):
+    """
+    Удаляет секции, целиком лежащие раньше, чем older_than_months месяцев назад.
+    Возвращает имена удалённых секций.
+    """
+    if not is_partitioned():
+        return []
+    cutoff = _add_months(date.today().replace(day=1), -older_than_months)
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'operation'"
+    )).scalars().all()
+
+    dropped = []
+    for name in sorted(names):
+        match = PARTITION_RE.match(name)
+        if not match:
+            continue
+        month_start = date(int(match.group(1)), int(match.group(2)), 1)
+        if _add_months(month_start, 1) <= cutoff:
+            db.session.execute(text(f"ALTER TABLE operation DETACH PARTITION {name}"))
+            db.session.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    db.session.commit()
+    return dropped
@@ -0,0 +1,107 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Не больше стольких корзин в памяти. При переполнении давно не использованные
+# удаляются пачкой до половины, чтобы следующие новые ключи не вызывали очистку снова
+MAX_BUCKETS = 100000
+
+REDIS_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class MemoryBucketStore:
+    """
+    Корзины в памяти процесса, в порядке последнего использования (LRU).
+    У каждой корзины свои rate и capacity: лимиты по IP и по устройству разные.
+    """
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_buckets = max_buckets
+
+    def take(self, key, rate, capacity):
+        """Возвращает (разрешено, через сколько секунд появится токен)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (capacity, now))[:2]
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, rate, capacity)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self._max_buckets:
+                self._evict()
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def _evict(self):
+        # Очистка раз на max_buckets // 2 новых ключей: в среднем O(1) на запрос.
+        # Удаляются самые давно использованные корзины - обычно уже полные
+        while len(self._buckets) > self._max_buckets // 2:
+            self._buckets.popitem(last=False)
+
+
+class RedisBucketStore:
+    """Общие для всех экземпляров API корзины (нужен пакет redis)."""
+
+    def __init__(self, url):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key, rate, capacity):
+        allowed, tokens = self._script(keys=[f"ratelimit:{key}"], args=[rate, capacity])
+        tokens = float(tokens)
+        return bool(allowed), 0 if allowed else (1 - tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self):
+        self.enabled = False
+        self.store = MemoryBucketStore()
+        self.device_rate = 2.0
+        self.device_burst = 10
+        self.ip_rate = 20.0
+        self.ip_burst = 50
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get("RATE_LIMIT_ENABLED", True)
+        self.device_rate = config.get("DEVICE_RATE_PER_SECOND", self.device_rate)
+        self.device_burst = config.get("DEVICE_RATE_BURST", self.device_burst)
+        self.ip_rate = config.get("IP_RATE_PER_SECOND", self.ip_rate)
+        self.ip_burst = config.get("IP_RATE_BURST", self.ip_burst)
+        storage_url = config.get("RATE_LIMIT_STORAGE_URL")
+        self.store = RedisBucketStore(storage_url) if storage_url else MemoryBucketStore()
+
+    def check(self, ip, device_id=None):
+        """Возвращает None, если запрос разрешён, иначе Retry-After в секундах."""
+        if not self.enabled:
+            return None
+        allowed, wait = self.store.take(f"ip:{ip}", self.ip_rate, self.ip_burst)
+        if allowed and device_id:
+            allowed, wait = self.store.take(f"device:{device_id}", self.device_rate, self.device_burst)
+        return None if allowed else max(1, math.ceil(wait))
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,87 @@
+import itertools
+import threading
+import time
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+
+
+class RoutingSession(Session):
+    """
+    Сессия, которая на время запроса с g.read_engine отправляет чтение
+    на реплику. Запись (flush) всегда идёт на основную базу.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get("read_engine")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Выбирает реплику для чтения по кругу, пропуская реплики
+    с отставанием больше max_lag секунд или недоступные.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self.max_lag = 10
+        self.check_interval = 5
+        self._lag = {}
+        self._lock = threading.Lock()
+        self._cycle = None
+
+    def init_app(self, app):
+        urls = [url.strip() for url in app.config.get("READ_REPLICA_URLS", "").split(",") if url.strip()]
+        options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        self.engines = [
+            create_engine(url, **({} if url.startswith("sqlite") else options)) for url in urls
+        ]
+        self.max_lag = app.config.get("REPLICA_MAX_LAG_SECONDS", 10)
+        self.check_interval = app.config.get("REPLICA_LAG_CHECK_SECONDS", 5)
+        self._lag = {}
+        self._cycle = itertools.cycle(self.engines) if self.engines else None
+
+    def _measure_lag(self, engine):
+        if engine.dialect.name != "postgresql":
+            return 0.0
+        try:
+            with engine.connect() as conn:
+                # Если реплика применила всё полученное, отставания нет,
+                # даже когда на основной базе давно не было записей
+                return float(conn.execute(text(
+                    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                )).scalar())
+        except Exception:
+            return float("inf")
+
+    def lag(self, engine):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._lag.get(engine)
+            if cached and now - cached[0] < self.check_interval:
+                return cached[1]
+        lag = self._measure_lag(engine)
+        with self._lock:
+            self._lag[engine] = (now, lag)
+        return lag
+
+    def pick(self):
+        """Возвращает engine реплики или None, если читать нужно с основной базы."""
+        if not self._cycle:
+            return None
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = next(self._cycle)
+            if self.lag(engine) <= self.max_lag:
+                return engine
+        return None
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,87 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from app.models import DeviceTokenRevocation, db
+from app.utils.invalidation import invalidation_bus
+from app.utils.jwt_utils import EXPIRATION_MINUTES, REFRESH_GRACE_MINUTES
+
+# Как часто перечитывать отзывы из БД (на случай потерянных сообщений шины)
+REFRESH_SECONDS = 30
+# Отзыв больше ничего не отсекает, когда все выданные до него токены истекли
+# и их уже нельзя обменять в /device/refresh/
+RETENTION = timedelta(minutes=EXPIRATION_MINUTES + REFRESH_GRACE_MINUTES)
+
+
+def _epoch(dt):
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TokenRevocations:
+    """
+    Отзыв токенов устройств без запроса к БД на каждый вызов: для устройства
+    хранится момент отзыва, все токены, выданные не позже него, недействительны.
+    Источник истины - таблица device_token_revocation; в памяти словарь
+    обновляется по шине инвалидаций и раз в REFRESH_SECONDS перечитывается.
+    """
+
+    def __init__(self):
+        self._revoked_at = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+
+    def revoke(self, device_id, at=None):
+        with self._lock:
+            self._revoked_at[device_id] = at if at is not None else time.time()
+
+    def is_revoked(self, device_id, issued_at):
+        self._refresh_if_stale()
+        revoked_at = self._revoked_at.get(device_id)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def _refresh_if_stale(self):
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < REFRESH_SECONDS:
+            return
+        self._loaded_at = now
+        horizon = datetime.utcnow() - RETENTION
+        rows = (
+            db.session.query(DeviceTokenRevocation.device_id, DeviceTokenRevocation.revoked_at)
+            .filter(DeviceTokenRevocation.revoked_at >= horizon)
+            .all()
+        )
+        loaded = {device_id: _epoch(revoked_at) for device_id, revoked_at in rows}
+        with self._lock:
+            # Отзывы, пришедшие по шине, но ещё не видимые в этом чтении, сохраняем
+            for device_id, revoked_at in self._revoked_at.items():
+                if revoked_at > loaded.get(device_id, 0) and revoked_at >= _epoch(horizon):
+                    loaded[device_id] = revoked_at
+            self._revoked_at = loaded
+
+    def invalidate(self):
+        self._loaded_at = None
+
+
+def record_revocation(device_id):
+    """
+    Добавляет отзыв в текущую транзакцию; после commit нужно опубликовать
+    "device_token" в шину. Заодно удаляет отзывы, пережившие срок токенов.
+    """
+    now = datetime.utcnow()
+    DeviceTokenRevocation.query.filter(DeviceTokenRevocation.revoked_at < now - RETENTION).delete(
+        synchronize_session=False
+    )
+    db.session.merge(DeviceTokenRevocation(device_id=device_id, revoked_at=now))
+
+
+token_revocations = TokenRevocations()
+
+
+def _on_device_token_revoked(entity, device_id):
+    if device_id is None:
+        token_revocations.invalidate()
+    else:
+        token_revocations.revoke(device_id)
+
+
+invalidation_bus.subscribe("device_token", _on_device_token_revoked)
@@ -0,0 +1,197 @@
+from sqlalchemy import text
+
+from app.models import db
+
+# Сущности с внешним строковым id: получают целочисленный pk (в порядке зависимостей)
+ENTITY_TABLES = ["role", "device", "user", "key_slot", "key"]
+
+# (таблица, старая колонка, новая колонка, на кого ссылается, ON DELETE, NOT NULL)
+FOREIGN_KEYS = [
+    ("user", "role_id", "role_pk", "role", None, False),
+    ("key_slot", "device_id", "device_pk", "device", None, True),
+    ("key", "key_slot_id", "key_slot_pk", "key_slot", "SET NULL", False),
+    ("key", "assigned_role_id", "assigned_role_pk", "role", None, True),
+    ("key", "last_user_id", "last_user_pk", "user", None, False),
+    ("key", "last_device_id", "last_device_pk", "device", None, False),
+    ("operation", "user_id", "user_pk", "user", None, False),
+    ("operation", "key_id", "key_pk", "key", None, False),
+    ("operation", "device_id", "device_pk", "device", None, False),
+    ("key_holding", "key_id", "key_pk", "key", "CASCADE", True),
+]
+
+# Колонки без внешних ключей, которые тоже переходят на pk.
+# key_holding и key_state_snapshot появились позже исходной схемы: если их нет,
+# их создаёт db.create_all() уже с pk
+SNAPSHOT_COLUMNS = [
+    ("key_state_snapshot", "key_id", "key_pk", "key"),
+    ("key_state_snapshot", "user_id", "user_pk", "user"),
+    ("key_state_snapshot", "device_id", "device_pk", "device"),
+]
+
+OPERATION_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_operation_key_pk_timestamp ON operation (key_pk, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_operation_user_pk ON operation (user_pk)",
+    "CREATE INDEX IF NOT EXISTS ix_operation_device_pk ON operation (device_pk)",
+    "CREATE INDEX IF NOT EXISTS ix_operation_timestamp_id ON operation (timestamp, id)",
+]
+
+# Индексы остальных таблиц, как их создаёт db.create_all(): (таблица, команда)
+INDEXES = [
+    ("user", 'CREATE INDEX IF NOT EXISTS ix_user_role_pk ON "user" (role_pk)'),
+    ("key", 'CREATE INDEX IF NOT EXISTS ix_key_key_slot_pk ON "key" (key_slot_pk)'),
+    ("key", 'CREATE INDEX IF NOT EXISTS ix_key_assigned_role_pk ON "key" (assigned_role_pk)'),
+    ("key_slot", 'ALTER TABLE key_slot ADD CONSTRAINT uq_slot_per_device UNIQUE (device_pk, number)'),
+    ("key_holding", 'ALTER TABLE key_holding ADD PRIMARY KEY (key_pk)'),
+    ("key_state_snapshot",
+     'CREATE INDEX IF NOT EXISTS ix_key_state_snapshot_taken_at_key_pk ON key_state_snapshot (taken_at, key_pk)'),
+]
+
+
+def create_operation_indexes():
+    for statement in OPERATION_INDEXES:
+        db.session.execute(text(statement))
+
+
+def operation_index_sizes():
+    """Размеры индексов таблицы operation (включая секции) в байтах."""
+    rows = db.session.execute(text(
+        "SELECT i.relname, pg_relation_size(i.oid) "
+        "FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "JOIN pg_class t ON t.oid = x.indrelid "
+        "WHERE t.relname = 'operation' OR t.relname LIKE 'operation\\_%'"
+    )).all()
+    return dict(rows)
+
+
+def _has_column(table, column):
+    return db.session.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"
+    ), {"table": table, "column": column}).first() is not None
+
+
+def _has_table(table):
+    return db.session.execute(text(
+        "SELECT 1 FROM information_schema.tables WHERE table_schema = current_schema() AND table_name = :table"
+    ), {"table": table}).first() is not None
+
+
+def identities_migrated():
+    """False, если база создана до перехода на целочисленные pk (нужен flask migrate-identities)."""
+    if db.engine.dialect.name != "postgresql":
+        return True
+    return _has_column("role", "pk") or not _has_column("role", "id")
+
+
+def ensure_change_log_version():
+    """
+    Приводит change_log.version к текущей схеме, где в PostgreSQL версия - номер
+    транзакции, общий для её записей: добавляет колонку в базу, созданную до
+    неё, и заменяет уникальный индекс обычным. Прежним записям достаётся номер
+    транзакции миграции; курсоры устройств из прежней нумерации build_delta
+    отклоняет и отдаёт полный снимок.
+    """
+    if db.engine.dialect.name != "postgresql":
+        return
+    if not _has_column("change_log", "version"):
+        db.session.execute(text("ALTER TABLE change_log ADD COLUMN version BIGINT"))
+    unique = db.session.execute(text(
+        "SELECT indisunique FROM pg_index WHERE indexrelid = to_regclass('ix_change_log_version')"
+    )).scalar()
+    if unique is not False:
+        db.session.execute(text("DROP INDEX IF EXISTS ix_change_log_version"))
+        db.session.execute(text("UPDATE change_log SET version = pg_current_xact_id()::text::bigint"))
+        db.session.execute(text("CREATE INDEX ix_change_log_version ON change_log (version)"))
+    db.session.commit()
+
+
+def ensure_operation_role():
+    """
+    Добавляет operation.role_pk в базу, созданную до неё. Прежние операции
+    остаются с NULL: аналитика относит их к текущей роли пользователя.
+    """
+    if db.engine.dialect.name != "postgresql" or _has_column("operation", "role_pk"):
+        return
+    db.session.execute(text("ALTER TABLE operation ADD COLUMN role_pk BIGINT"))
+    db.session.commit()
+
+
+def migrate_identities():
+    """
+    Переводит существующую базу со строковых первичных ключей на целочисленные:
+    у сущностей появляется bigint pk, прежний id становится уникальным public_id,
+    внешние ключи (в том числе в operation) и key_holding/key_state_snapshot
+    ссылаются на pk. Всё выполняется в одной транзакции; повторный запуск
+    ничего не делает. Таблицы, которых не было в исходной схеме, затем
+    создаются через db.create_all(). Возвращает размеры индексов operation
+    до и после миграции.
+    """
+    if db.engine.dialect.name != "postgresql":
+        raise RuntimeError("Миграция идентификаторов поддерживается только в PostgreSQL")
+
+    before = operation_index_sizes()
+    if identities_migrated():
+        return before, before
+
+    session = db.session
+    # Базы из промежуточных версий уже могут содержать эти таблицы со строковыми id
+    foreign_keys = [fk for fk in FOREIGN_KEYS if _has_column(fk[0], fk[1])]
+    snapshot_columns = [column for column in SNAPSHOT_COLUMNS if _has_column(column[0], column[1])]
+    for table in ENTITY_TABLES:
+        session.execute(text(f'LOCK TABLE "{table}" IN ACCESS EXCLUSIVE MODE'))
+        # Существующие строки нумеруются при добавлении колонки
+        session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN pk BIGSERIAL'))
+
+    # Старые индексы operation всё равно удаляются вместе с колонками,
+    # а пока они есть, UPDATE обновляет и их
+    for table, old, _, _, _, _ in foreign_keys:
+        if table == "operation":
+            session.execute(text(f"DROP INDEX IF EXISTS ix_operation_{old}"))
+    session.execute(text("DROP INDEX IF EXISTS ix_operation_key_id_timestamp"))
+
+    # Одно UPDATE на таблицу: каждое переписывает все её строки
+    by_table = {}
+    for table, old, new, target, *_ in foreign_keys + snapshot_columns:
+        session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {new} BIGINT'))
+        by_table.setdefault(table, []).append(f'{new} = (SELECT pk FROM "{target}" WHERE id = t.{old})')
+    for table, assignments in by_table.items():
+        session.execute(text(f'UPDATE "{table}" AS t SET {", ".join(assignments)}'))
+    if snapshot_columns:
+        # Снимки удалённых ключей восстановить нечем
+        session.execute(text("DELETE FROM key_state_snapshot WHERE key_pk IS NULL"))
+
+    # Вместе со старыми колонками удаляются их ограничения и индексы
+    for table, old, _, _, _, _ in foreign_keys:
+        session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN {old} CASCADE'))
+    for table, old, _, _ in snapshot_columns:
+        session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN {old}'))
+
+    for table in ENTITY_TABLES:
+        session.execute(text(f'ALTER TABLE "{table}" DROP CONSTRAINT {table}_pkey'))
+        session.execute(text(f'ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS {table}_id_key'))
+        session.execute(text(f'ALTER TABLE "{table}" RENAME COLUMN id TO public_id'))
+        session.execute(text(f'ALTER TABLE "{table}" ADD PRIMARY KEY (pk)'))
+        session.execute(text(f'ALTER TABLE "{table}" ADD CONSTRAINT {table}_public_id_key UNIQUE (public_id)'))
+
+    for table, _, new, target, on_delete, not_null in foreign_keys:
+        if not_null:
+            session.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN {new} SET NOT NULL'))
+        session.execute(text(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT {table}_{new}_fkey FOREIGN KEY ({new}) '
+            f'REFERENCES "{target}" (pk)' + (f" ON DELETE {on_delete}" if on_delete else "")
+        ))
+    if snapshot_columns:
+        session.execute(text("ALTER TABLE key_state_snapshot ALTER COLUMN key_pk SET NOT NULL"))
+    for table, statement in INDEXES:
+        if _has_table(table):
+            session.execute(text(statement))
+    create_operation_indexes()
+    session.commit()
+    session.execute(text("ANALYZE operation"))
+    session.commit()
+    # Таблицы, которые в базе со строковыми ключами не создавались (create_app их пропускает)
+    db.create_all()
+    ensure_change_log_version()
+    ensure_operation_role()
+    return before, operation_index_sizes()
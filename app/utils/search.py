@@ -0,0 +1,315 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import case, func, or_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, User, Key, Device
+from app.utils.invalidation import invalidation_bus
+
+logger = logging.getLogger(__name__)
+
+# Как pg_trgm.similarity_threshold по умолчанию
+SIMILARITY_THRESHOLD = 0.3
+PREFIX_BONUS = 1.0
+# Сколько вхождений подстроки ещё дешевле обойти через re.finditer
+FREQUENT_MATCHES = 2000
+SUBSTRING_BONUS = 0.5
+# Как часто индекс в памяти перечитывается целиком. С INVALIDATION_BACKEND=memory
+# шина не выходит за пределы процесса: изменения, сделанные через другие воркеры,
+# видны только после перечитывания (с postgres - сразу)
+RELOAD_SECONDS = 60
+# Дальше по выдаче не листают: каждое поле отдаёт offset + limit + 1 строк
+MAX_OFFSET = 1000
+
+# (тип, поле, модель, колонка, колонка подписи)
+SEARCH_FIELDS = [
+    ("user", "name", User, User.name, User.name),
+    ("user", "nfc_tag", User, User.nfc_tag, User.name),
+    ("key", "key_number", Key, Key.key_number, Key.key_number),
+    ("device", "ip_address", Device, Device.ip_address, Device.ip_address),
+]
+SEARCH_TYPES = ("user", "key", "device")
+# Наибольшее число полей поиска у одного типа сущности
+FIELDS_PER_ENTITY = max(Counter(field[0] for field in SEARCH_FIELDS).values())
+
+SEARCH_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_user_name_trgm ON "user" USING gin (name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_user_nfc_tag_trgm ON "user" USING gin (nfc_tag gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_key_key_number_trgm ON "key" USING gin (key_number gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_device_ip_address_trgm ON device USING gin (ip_address gin_trgm_ops)',
+]
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(value):
+    """Триграммы как в pg_trgm: по словам в нижнем регистре, с двумя пробелами в начале и одним в конце."""
+    result = set()
+    for word in _WORD.findall(value.lower()):
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class NgramIndex:
+    """
+    Триграммный индекс в памяти для БД без pg_trgm (SQLite).
+    Загружается при первом поиске; изменения пользователей, ключей и
+    устройств приходят по шине инвалидаций и применяются перед следующим поиском,
+    а раз в RELOAD_SECONDS индекс перечитывается целиком.
+    Общие триграммы с запросом считаются для всех документов сразу (numpy.bincount
+    по спискам вхождений), подстрока ищется перебором значений.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._loaded_at = 0.0
+        self._pending = set()
+        self._clear()
+
+    def _clear(self):
+        # Документ - одно поле сущности; удалённые документы остаются в списках
+        # вхождений (значение None) и отсекаются до следующей полной загрузки
+        self._meta = []  # (тип, id, поле, значение, подпись)
+        self._values = []  # значение в нижнем регистре, None - удалён
+        self._sizes = []  # число триграмм значения
+        self._postings = {}
+        self._by_entity = {}
+        self._dead = 0
+        self._arrays = {}
+        self._columns = None
+        self._codes = None
+
+    def invalidate(self, entity, entity_id):
+        with self._lock:
+            if entity_id is None:
+                self._loaded = False
+            else:
+                self._pending.add((entity, entity_id))
+
+    def _rows(self, entity=None, ids=None):
+        for type_, field, model, column, label in SEARCH_FIELDS:
+            if entity is not None and type_ != entity:
+                continue
+            query = select(model.id, column, label).where(column.isnot(None))
+            if ids is not None:
+                query = query.where(model.id.in_(ids))
+            for entity_id, value, label_value in db.session.execute(query):
+                yield type_, entity_id, field, value, label_value
+
+    def _add(self, type_, entity_id, field, value, label):
+        doc_id = len(self._meta)
+        grams = trigrams(value)
+        self._meta.append((type_, entity_id, field, value, label))
+        self._values.append(value.lower())
+        self._sizes.append(len(grams))
+        self._by_entity.setdefault((type_, entity_id), []).append(doc_id)
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(doc_id)
+            self._arrays.pop(gram, None)
+        self._columns = None
+
+    def _remove(self, type_, entity_id):
+        for doc_id in self._by_entity.pop((type_, entity_id), ()):
+            self._values[doc_id] = None
+            self._dead += 1
+            self._columns = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            loaded = self._loaded and now - self._loaded_at < RELOAD_SECONDS
+            pending, self._pending = self._pending, set()
+        if not loaded:
+            rows = list(self._rows())
+            with self._lock:
+                self._clear()
+                for row in rows:
+                    self._add(*row)
+                self._loaded = True
+                self._loaded_at = now
+            return
+        by_entity = {}
+        for entity, entity_id in pending:
+            by_entity.setdefault(entity, []).append(entity_id)
+        for entity, ids in by_entity.items():
+            fresh = {(entity, entity_id): [] for entity_id in ids}
+            for row in self._rows(entity, ids):
+                fresh[row[:2]].append(row)
+            with self._lock:
+                for doc_key, rows in fresh.items():
+                    # Выдача и возврат ключа тоже публикуют "key" - поля поиска при этом не меняются
+                    if rows == [self._meta[doc_id] for doc_id in self._by_entity.get(doc_key, ())]:
+                        continue
+                    self._remove(*doc_key)
+                    for row in rows:
+                        self._add(*row)
+                # Удалённых документов больше половины - при следующем поиске индекс перестроится
+                if self._dead * 2 > len(self._meta):
+                    self._loaded = False
+
+    def _posting(self, gram):
+        array = self._arrays.get(gram)
+        if array is None:
+            array = self._arrays[gram] = np.array(self._postings.get(gram, ()), np.int64)
+        return array
+
+    def _find_all(self, query, text_blob):
+        """Позиции вхождений query в text_blob (при частых - и перекрывающихся)."""
+        if text_blob.count(query) <= FREQUENT_MATCHES:
+            return np.fromiter((m.start() for m in re.finditer(re.escape(query), text_blob)), np.int64)
+        # Частая подстрока: сравнение массивов кодов символов вместо цикла по совпадениям
+        if self._codes is None or self._codes[0] is not text_blob:
+            self._codes = (text_blob, np.frombuffer(text_blob.encode("utf-32-le"), np.uint32))
+        codes = self._codes[1]
+        pattern = np.frombuffer(query.encode("utf-32-le"), np.uint32)
+        size = len(codes) - len(pattern) + 1
+        found = codes[:size] == pattern[0]
+        for offset in range(1, len(pattern)):
+            found &= codes[offset:offset + size] == pattern[offset]
+        return np.flatnonzero(found)
+
+    def search(self, query, types, limit):
+        """Лучшие limit документов: (score, тип, id, поле, значение, подпись)."""
+        self._refresh()
+        query_trigrams = trigrams(query)
+        with self._lock:
+            if self._columns is None:
+                # Все значения одной строкой через \0: подстроку ищет один проход re
+                values = [value or "" for value in self._values]
+                self._columns = (
+                    np.array(self._sizes, np.float64),
+                    np.array([SEARCH_TYPES.index(m[0]) for m in self._meta], np.int8),
+                    np.array([v is not None for v in self._values], bool),
+                    "\0".join(values),
+                    np.cumsum([0] + [len(value) + 1 for value in values[:-1]]),
+                    # Номер документа для каждого символа строки
+                    np.repeat(np.arange(len(values), dtype=np.int32), [len(value) + 1 for value in values]),
+                )
+                self._codes = None
+            sizes, doc_types, alive, text_blob, starts, doc_of = self._columns
+            count = len(self._meta)
+            postings = [self._posting(gram) for gram in query_trigrams]
+            meta = self._meta
+
+        if postings:
+            shared = np.bincount(np.concatenate(postings), minlength=count)[:count]
+            score = shared / (len(query_trigrams) + sizes - shared)
+        else:
+            score = np.zeros(count)
+        matched = score >= SIMILARITY_THRESHOLD
+        if count and "\0" not in query:
+            # Начало значения - первое вхождение в документе, если значение начинается с запроса
+            positions = self._find_all(query, text_blob)
+            docs = doc_of[positions]
+            # Позиции отсортированы: первое вхождение в документе - где сменился номер
+            first = np.flatnonzero(np.diff(docs, prepend=-1))
+            docs = docs[first]
+            score[docs] += np.where(positions[first] == starts[docs], PREFIX_BONUS, SUBSTRING_BONUS)
+            matched[docs] = True
+
+        type_codes = [SEARCH_TYPES.index(t) for t in types]
+        found = np.flatnonzero(matched & alive & np.isin(doc_types, type_codes))
+        if len(found) > limit:
+            # Равные последнему попавшему тоже возвращаются: какие из них войдут
+            # в страницу, решает сортировка в search(), как и в запросе к PostgreSQL
+            cutoff = -np.partition(-score[found], limit - 1)[limit - 1]
+            found = found[score[found] >= cutoff]
+        return [(float(score[doc_id]),) + meta[doc_id] for doc_id in found.tolist()]
+
+
+ngram_index = NgramIndex()
+_use_pg_trgm = False
+
+
+def ensure_search_indexes():
+    """
+    В PostgreSQL включает pg_trgm и создаёт GIN-индексы по полям поиска.
+    Если расширение недоступно (нет прав), поиск работает по индексу в памяти.
+    """
+    global _use_pg_trgm
+    if db.engine.dialect.name != "postgresql":
+        return False
+    try:
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for statement in SEARCH_INDEXES:
+            db.session.execute(text(statement))
+        db.session.commit()
+        _use_pg_trgm = True
+    except SQLAlchemyError:
+        db.session.rollback()
+        logger.warning("pg_trgm недоступен, поиск использует индекс в памяти", exc_info=True)
+    return _use_pg_trgm
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search_database(query, types, limit):
+    pattern = _escape_like(query)
+    results = []
+    for type_, field, model, column, label in SEARCH_FIELDS:
+        if type_ not in types:
+            continue
+        score = (
+            func.similarity(column, query)
+            + case((column.ilike(pattern + "%", escape="\\"), PREFIX_BONUS),
+                   (column.ilike("%" + pattern + "%", escape="\\"), SUBSTRING_BONUS), else_=0.0)
+        )
+        rows = db.session.execute(
+            select(model.id, column, label, score)
+            .where(or_(column.ilike("%" + pattern + "%", escape="\\"), column.op("%")(query)))
+            # Как сортировка в search(): при равном score границы страниц не плавают
+            .order_by(score.desc(), label.collate("C"), model.id.collate("C"))
+            .limit(limit)
+        )
+        results.extend(
+            (float(row_score), type_, entity_id, field, value, label_value)
+            for entity_id, value, label_value, row_score in rows
+        )
+    return results
+
+
+def search(query, types=SEARCH_TYPES, limit=20, offset=0):
+    """
+    Нечёткий поиск по имени и NFC-метке пользователя, номеру ключа и IP устройства.
+    Результаты по убыванию score (сходство триграмм + бонус за префикс/подстроку),
+    по одной строке на сущность - с лучшим из её полей. Возвращает (results, has_more).
+    """
+    query = query.strip().lower()
+    types = set(types)
+    # Каждое поле отдаёт свои лучшие offset + limit + 1 совпадений - их хватает для нужной страницы
+    wanted = offset + limit + 1
+    if _use_pg_trgm:
+        rows = _search_database(query, types, wanted)
+    else:
+        rows = ngram_index.search(query, types, wanted * FIELDS_PER_ENTITY)
+    rows.sort(key=lambda row: (-row[0], row[1], row[5] or "", row[2]))
+
+    best, seen = [], set()
+    for score, type_, entity_id, field, value, label in rows:
+        if (type_, entity_id) in seen:
+            continue
+        seen.add((type_, entity_id))
+        best.append({
+            "type": type_, "id": entity_id, "field": field, "value": value,
+            "label": label, "score": round(score, 3)
+        })
+    page = best[offset:offset + limit + 1]
+    return page[:limit], len(page) > limit
+
+
+def _on_entity_changed(entity, entity_id):
+    ngram_index.invalidate(entity, entity_id)
+
+
+# Сообщение "*" (сброс всего) шина доставляет и этим подписчикам, с entity_id None
+for _entity in SEARCH_TYPES:
+    invalidation_bus.subscribe(_entity, _on_entity_changed)
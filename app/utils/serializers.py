@@ -0,0 +1,156 @@
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from app.models import Key, KeySlot, User, Role, Device, Operation, Job
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _row_serializer(fields, datetime_fields=()):
+    """
+    Сериализатор строки результата (Row, tuple или любой итерируемый
+    объект с полями в порядке fields) в dict; даты - в ISO 8601.
+    """
+    positions = [fields.index(name) for name in datetime_fields]
+
+    def serialize(row):
+        values = list(row)
+        for i in positions:
+            if values[i] is not None:
+                values[i] = values[i].isoformat()
+        return dict(zip(fields, values))
+
+    return serialize
+
+
+KEY_FIELDS = (
+    "id", "key_number", "is_taken", "key_slot_id", "device_id", "last_user_id",
+    "last_device_id", "assigned_role_id", "created_at", "updated_at"
+)
+serialize_key = _row_serializer(KEY_FIELDS, ("created_at", "updated_at"))
+
+
+# Ссылки на другие сущности хранятся как pk, в ответах - их внешние id
+_SlotDevice = aliased(Device)
+_LastUser = aliased(User)
+_LastDevice = aliased(Device)
+
+
+def select_keys():
+    """Колонки ключа в порядке KEY_FIELDS (device_id - устройство ячейки)."""
+    return (
+        select(
+            Key.id, Key.key_number, Key.is_taken, KeySlot.id, _SlotDevice.id, _LastUser.id,
+            _LastDevice.id, Role.id, Key.created_at, Key.updated_at
+        )
+        .join(Role, Role.pk == Key.assigned_role_pk)
+        .outerjoin(KeySlot, KeySlot.pk == Key.key_slot_pk)
+        .outerjoin(_SlotDevice, _SlotDevice.pk == KeySlot.device_pk)
+        .outerjoin(_LastUser, _LastUser.pk == Key.last_user_pk)
+        .outerjoin(_LastDevice, _LastDevice.pk == Key.last_device_pk)
+    )
+
+
+USER_FIELDS = ("id", "name", "nfc_tag", "role_id", "role_name")
+serialize_user = _row_serializer(USER_FIELDS)
+
+
+def select_users():
+    return select(User.id, User.name, User.nfc_tag, Role.id, Role.name).outerjoin(
+        Role, Role.pk == User.role_pk
+    )
+
+
+DEVICE_FIELDS = ("id", "ip_address", "auth_token", "timeout", "created_at", "updated_at")
+serialize_device = _row_serializer(DEVICE_FIELDS, ("created_at", "updated_at"))
+
+
+def select_devices():
+    return select(
+        Device.id, Device.ip_address, Device.auth_token, Device.timeout, Device.created_at, Device.updated_at
+    )
+
+
+SLOT_FIELDS = ("slot_id", "slot_number", "device_id", "key_number")
+serialize_slot = _row_serializer(SLOT_FIELDS)
+
+
+def select_slots():
+    # Одна строка на ячейку, даже если в ней по ошибке несколько ключей
+    # (такие ячейки находит check_consistency): показывается наименьший номер
+    slot_key = (
+        select(Key.key_slot_pk, func.min(Key.key_number).label("key_number"))
+        .where(Key.key_slot_pk.isnot(None))
+        .group_by(Key.key_slot_pk)
+        .subquery()
+    )
+    return (
+        select(KeySlot.id, KeySlot.number, Device.id, slot_key.c.key_number)
+        .join(Device, Device.pk == KeySlot.device_pk)
+        .outerjoin(slot_key, slot_key.c.key_slot_pk == KeySlot.pk)
+    )
+
+
+OPERATION_FIELDS = ("id", "user_id", "key_number", "device_id", "type", "timestamp")
+serialize_operation = _row_serializer(OPERATION_FIELDS, ("timestamp",))
+
+
+def select_operations():
+    return (
+        select(Operation.id, User.id, Key.key_number, Device.id, Operation.type, Operation.timestamp)
+        .outerjoin(User, User.pk == Operation.user_pk)
+        .outerjoin(Key, Key.pk == Operation.key_pk)
+        .outerjoin(Device, Device.pk == Operation.device_pk)
+    )
+
+
+ROLE_FIELDS = ("id", "name")
+serialize_role = _row_serializer(ROLE_FIELDS)
+
+
+def select_roles():
+    return select(Role.id, Role.name)
+
+
+JOB_FIELDS = (
+    "id", "kind", "status", "progress", "error", "cancel_requested",
+    "created_at", "started_at", "finished_at", "updated_at"
+)
+serialize_job = _row_serializer(JOB_FIELDS, ("created_at", "started_at", "finished_at", "updated_at"))
+
+
+def select_jobs():
+    """Колонки задачи в порядке JOB_FIELDS (без параметров и результата)."""
+    return select(
+        Job.id, Job.kind, Job.status, Job.progress, Job.error, Job.cancel_requested,
+        Job.created_at, Job.started_at, Job.finished_at, Job.updated_at
+    )
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON через orjson. Ключи сортируются, а даты и прочие нестандартные
+    типы проходят через default() стандартного провайдера Flask,
+    поэтому ответы совпадают с jsonify по содержимому.
+    """
+
+    option = (
+        (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+         | orjson.OPT_PASSTHROUGH_DATACLASS)
+        if orjson else 0
+    )
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.option
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=self.default, option=option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
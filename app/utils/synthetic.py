@@ -0,0 +1,245 @@
+import io
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.models import db, Role, User, Device, KeySlot, Key, KeyHolding, Operation
+from app.utils.partitions import ensure_operation_partitions
+
+SHIFT_HOURS = 8
+SHIFT_SECONDS = SHIFT_HOURS * 3600
+# Доля смен в выходные относительно будних дней
+WEEKEND_WEIGHT = 0.3
+CHUNK_SIZE = 100000
+# Сколько ключей обрабатывается за раз при выборе смен
+KEY_BATCH = 500
+# Конец журнала по умолчанию при заданном seed: от текущего времени зависели бы
+# границы смен, и один seed давал бы разные данные в разные дни
+SEEDED_END = datetime(2025, 1, 1)
+
+
+def _is_postgres():
+    return db.engine.dialect.name == "postgresql"
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def _bulk_insert(table, rows, chunk_size=CHUNK_SIZE):
+    """Вставка словарей: через COPY в PostgreSQL, пакетным INSERT в остальных БД."""
+    if not rows:
+        return
+    if not _is_postgres():
+        for i in range(0, len(rows), chunk_size):
+            db.session.execute(table.insert(), rows[i:i + chunk_size])
+        return
+
+    columns = list(rows[0])
+    preparer = db.engine.dialect.identifier_preparer
+    statement = "COPY {} ({}) FROM STDIN".format(
+        preparer.format_table(table), ", ".join(preparer.quote(c) for c in columns)
+    )
+    cursor = db.session.connection().connection.cursor()
+    for i in range(0, len(rows), chunk_size):
+        buffer = io.StringIO()
+        for row in rows[i:i + chunk_size]:
+            buffer.write("\t".join(_copy_value(row[c]) for c in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+
+
+def _reset_sequences(*tables):
+    # pk вставлены явно: последовательности PostgreSQL продолжают с максимального
+    if not _is_postgres():
+        return
+    for table in tables:
+        name = db.engine.dialect.identifier_preparer.format_table(table)
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{name}', 'pk'), (SELECT max(pk) FROM {name}))"
+        ))
+
+
+def _ids(rng, count):
+    # Детерминированные (по seed) идентификаторы в формате uuid4().hex[:8], как public_id
+    # в моделях. При 32 битах совпадения вероятны уже на десятках тысяч строк -
+    # повторы генерируются заново
+    ids, seen = [], set()
+    while len(ids) < count:
+        value = rng.bytes(4).hex()
+        if value not in seen:
+            seen.add(value)
+            ids.append(value)
+    return ids
+
+
+def _holds_per_key(rng, keys, holds, max_holds):
+    # Популярность ключей неравномерна: немногие ключи берут почти каждую смену
+    weights = rng.lognormal(0, 1, keys)
+    per_key = np.floor(weights / weights.sum() * holds).astype(np.int64)
+    return np.clip(per_key, 1, max_holds)
+
+
+def _generate_holds(rng, per_key, shift_starts, shift_weights, now):
+    """
+    Для каждого ключа выбирает смены, в которые его брали (чаще в будни),
+    и время выдачи/возврата внутри смены. Ключ возвращается до начала
+    следующей смены, поэтому выдачи и возвраты каждого ключа чередуются.
+    """
+    key_parts, take_parts, return_parts = [], [], []
+    inverse = 1 / shift_weights
+    for start in range(0, len(per_key), KEY_BATCH):
+        batch = per_key[start:start + KEY_BATCH]
+        # Взвешенная выборка без повторений: k наибольших u ** (1 / w)
+        scores = rng.random((len(batch), len(shift_starts))) ** inverse
+        order = np.argsort(-scores, axis=1)
+        for offset, count in enumerate(batch):
+            shifts = np.sort(order[offset, :count])
+            shift_ts = shift_starts[shifts]
+            take = shift_ts + np.clip(rng.normal(900, 600, count), 0, 3600).astype(np.int64)
+            duration = np.clip(rng.normal(6.5 * 3600, 3600, count), 300, None).astype(np.int64)
+            ret = np.minimum(take + duration, shift_ts + SHIFT_SECONDS - 60)
+            key_parts.append(np.full(count, start + offset, np.int32))
+            take_parts.append(take)
+            return_parts.append(ret)
+
+    key = np.concatenate(key_parts)
+    take = np.concatenate(take_parts)
+    ret = np.concatenate(return_parts)
+    # Смена ещё идёт: ключ пока на руках, возврата нет
+    returned = ret <= now
+    return key, take, ret, returned
+
+
+def generate_data(devices=1000, slots_per_device=20, keys=20000, users=50000, roles=50,
+                  operations=10_000_000, days=365, seed=None, end=None, progress=None):
+    """
+    Заполняет пустую БД синтетическими устройствами, ячейками, ключами,
+    пользователями и журналом операций с посменным ритмом (смены по 8 часов
+    с 00:00 UTC, в выходные реже) за days дней до end. Одинаковый seed даёт
+    одинаковые данные: без end журнал при заданном seed заканчивается
+    SEEDED_END, без seed - текущим временем. Возвращает число созданных операций.
+    """
+    if db.session.query(Key.id).first() is not None:
+        raise RuntimeError("В базе уже есть ключи: генератор рассчитан на пустую БД")
+    slots = devices * slots_per_device
+    if keys > slots:
+        raise RuntimeError(f"Ключей ({keys}) больше, чем ячеек ({slots})")
+
+    rng = np.random.default_rng(seed)
+    if end is None:
+        end = SEEDED_END if seed is not None else datetime.utcnow()
+    now = end.replace(microsecond=0)
+    start = now - timedelta(days=days)
+    notify = progress or (lambda message: None)
+
+    role_ids = _ids(rng, roles)
+    device_ids = _ids(rng, devices)
+    slot_ids = _ids(rng, slots)
+    key_ids = _ids(rng, keys)
+    user_ids = _ids(rng, users)
+    user_role = rng.integers(0, roles, users)
+    key_role = rng.integers(0, roles, keys)
+    # Ключи равномерно распределены по ячейкам всех устройств
+    key_slot = np.arange(keys, dtype=np.int64) * slots // keys
+    key_device = key_slot // slots_per_device
+
+    # pk сущности с индексом i - i + 1 (БД пустая)
+    _bulk_insert(Role.__table__, [
+        {"pk": i + 1, "public_id": role_id, "name": f"Role {i + 1}"} for i, role_id in enumerate(role_ids)
+    ])
+    _bulk_insert(Device.__table__, [
+        {"pk": i + 1, "public_id": device_id, "ip_address": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+         "auth_token": f"synthetic-{device_id}", "timeout": 30, "created_at": start, "updated_at": start}
+        for i, device_id in enumerate(device_ids)
+    ])
+    _bulk_insert(KeySlot.__table__, [
+        {"pk": i + 1, "public_id": slot_id, "number": i % slots_per_device + 1, "is_locked": False,
+         "device_pk": i // slots_per_device + 1, "created_at": start, "updated_at": start}
+        for i, slot_id in enumerate(slot_ids)
+    ])
+    _bulk_insert(User.__table__, [
+        {"pk": i + 1, "public_id": user_id, "name": f"User {i + 1}", "nfc_tag": rng.bytes(7).hex().upper(),
+         "role_pk": int(user_role[i]) + 1, "created_at": start, "updated_at": start}
+        for i, user_id in enumerate(user_ids)
+    ])
+    db.session.commit()
+    notify(f"{roles} roles, {devices} devices, {slots} slots, {users} users")
+
+    # Смены, начавшиеся хотя бы за час до текущего момента
+    first_shift = int((start - datetime(1970, 1, 1)).total_seconds()) // SHIFT_SECONDS * SHIFT_SECONDS
+    now_ts = int((now - datetime(1970, 1, 1)).total_seconds())
+    shift_starts = np.arange(first_shift, now_ts - 3600, SHIFT_SECONDS, dtype=np.int64)
+    weekday = (shift_starts // 86400 + 3) % 7
+    shift_weights = np.where(weekday >= 5, WEEKEND_WEIGHT, 1.0)
+
+    per_key = _holds_per_key(rng, keys, operations // 2, len(shift_starts))
+    key, take, ret, returned = _generate_holds(rng, per_key, shift_starts, shift_weights, now_ts)
+    # Ключ берут пользователи той роли, за которой он закреплён
+    users_by_role = [np.flatnonzero(user_role == r) for r in range(roles)]
+    holder = np.empty(len(key), np.int64)
+    for r in range(roles):
+        mask = key_role[key] == r
+        if len(users_by_role[r]):
+            holder[mask] = rng.choice(users_by_role[r], mask.sum())
+        else:
+            holder[mask] = rng.integers(0, users, mask.sum())
+
+    # Журнал в хронологическом порядке, чтобы id операций росли со временем
+    op_key = np.concatenate([key, key[returned]])
+    op_user = np.concatenate([holder, holder[returned]])
+    op_ts = np.concatenate([take, ret[returned]])
+    op_take = np.concatenate([np.ones(len(key), bool), np.zeros(returned.sum(), bool)])
+    order = np.argsort(op_ts, kind="stable")
+    op_key, op_user, op_ts, op_take = op_key[order], op_user[order], op_ts[order], op_take[order]
+
+    # Итоговое состояние ключа - по его последней операции
+    last = np.full(keys, -1, np.int64)
+    last[op_key] = np.arange(len(op_key))
+    key_rows = []
+    for i, key_id in enumerate(key_ids):
+        taken = last[i] >= 0 and bool(op_take[last[i]])
+        key_rows.append({
+            "pk": i + 1,
+            "public_id": key_id,
+            "key_number": f"{i + 1:06d}",
+            "is_taken": taken,
+            "key_slot_pk": None if taken else int(key_slot[i]) + 1,
+            "assigned_role_pk": int(key_role[i]) + 1,
+            "last_user_pk": int(op_user[last[i]]) + 1 if last[i] >= 0 else None,
+            "last_device_pk": int(key_device[i]) + 1 if last[i] >= 0 else None,
+            "created_at": start,
+            "updated_at": now
+        })
+    _bulk_insert(Key.__table__, key_rows)
+    _bulk_insert(KeyHolding.__table__, [
+        {"key_pk": i + 1, "user_id": user_ids[op_user[last[i]]], "role_id": role_ids[user_role[op_user[last[i]]]],
+         "device_id": device_ids[key_device[i]],
+         "taken_at": datetime.utcfromtimestamp(int(op_ts[last[i]]))}
+        for i in range(keys) if key_rows[i]["is_taken"]
+    ])
+    _reset_sequences(Role.__table__, Device.__table__, KeySlot.__table__, User.__table__, Key.__table__)
+    db.session.commit()
+    notify(f"{keys} keys")
+
+    ensure_operation_partitions(since=start.date())
+    table = Operation.__table__
+    for i in range(0, len(op_ts), CHUNK_SIZE):
+        chunk = slice(i, i + CHUNK_SIZE)
+        timestamps = op_ts[chunk].astype("datetime64[s]").tolist()
+        _bulk_insert(table, [
+            {"user_pk": u + 1, "key_pk": k + 1, "device_pk": int(key_device[k]) + 1,
+             "role_pk": int(user_role[u]) + 1, "type": "TAKE" if t else "RETURN", "timestamp": ts}
+            for k, u, t, ts in zip(op_key[chunk].tolist(), op_user[chunk].tolist(),
+                                   op_take[chunk].tolist(), timestamps)
+        ])
+        db.session.commit()
+        notify(f"{min(i + CHUNK_SIZE, len(op_ts))} operations")
+    return len(op_ts)
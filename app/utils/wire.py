@@ -0,0 +1,66 @@
+from flask import request, jsonify, Response, abort
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+CBOR = "application/cbor"
+
+
+def _response_types():
+    types = [JSON]
+    if msgpack:
+        types += list(MSGPACK_TYPES)
+    if cbor2:
+        types.append(CBOR)
+    return types
+
+
+def parse_body():
+    """Тело запроса устройства в JSON, MessagePack или CBOR (по Content-Type)."""
+    mimetype = request.mimetype
+    if mimetype in MSGPACK_TYPES:
+        if not msgpack:
+            abort(415)
+        return _decode(msgpack.unpackb, request.get_data(), raw=False)
+    if mimetype == CBOR:
+        if not cbor2:
+            abort(415)
+        return _decode(cbor2.loads, request.get_data(), errors=(cbor2.CBORError,))
+    return request.get_json()
+
+
+def _decode(loads, data, errors=(), **kwargs):
+    # Битое тело - ошибка клиента (400), как у request.get_json(), а не 500.
+    # msgpack сообщает об ошибках подклассами ValueError, cbor2 - своими (CBORError)
+    try:
+        body = loads(data, **kwargs)
+    except (ValueError, TypeError) + errors:
+        abort(400)
+    if not isinstance(body, dict):
+        abort(400)
+    return body
+
+
+def respond(payload):
+    """Ответ в формате, который клиент запросил в Accept (по умолчанию JSON)."""
+    mimetype = request.accept_mimetypes.best_match(_response_types(), default=JSON)
+    if mimetype in MSGPACK_TYPES:
+        return Response(msgpack.packb(payload, use_bin_type=True), mimetype=mimetype)
+    if mimetype == CBOR:
+        return Response(cbor2.dumps(payload), mimetype=CBOR)
+    return jsonify(payload)
+
+
+def lean_profile():
+    """Сокращённый ответ только с тем, что нужно прошивке (?profile=lean)."""
+    return request.args.get("profile") == "lean" or request.headers.get("X-Response-Profile") == "lean"
@@ -0,0 +1,58 @@
+# Замер векторизованной аналитики на синтетическом журнале.
+#   python benchmarks/bench_analytics.py --events 10000000
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils import analytics
+from app.utils.analytics import OperationArrays, TAKE, RETURN
+
+
+def synthetic_operations(events, keys, roles, seed):
+    rng = np.random.default_rng(seed)
+    # Каждый ключ чередует выдачу и возврат, как в реальном журнале
+    per_key = events // keys // 2 * 2
+    key = np.repeat(np.arange(keys, dtype=np.int32), per_key)
+    type_ = np.tile(np.array([TAKE, RETURN], dtype=np.int8), len(key) // 2)
+    gaps = rng.exponential(3600, len(key)).astype(np.int64) + 1
+    ts = 1_700_000_000 + np.cumsum(gaps.reshape(keys, per_key), axis=1).ravel()
+    role = rng.integers(0, roles, len(key), dtype=np.int32)
+    shuffle = rng.permutation(len(key))
+    return OperationArrays(
+        key[shuffle], role[shuffle], type_[shuffle], ts[shuffle],
+        [f"k{i}" for i in range(keys)], [f"r{i}" for i in range(roles)]
+    )
+
+
+def measure(name, fn):
+    start = time.perf_counter()
+    fn()
+    print(f"{name:<22} {time.perf_counter() - start:8.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=10_000_000)
+    parser.add_argument("--keys", type=int, default=20_000)
+    parser.add_argument("--roles", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ops = synthetic_operations(args.events, args.keys, args.roles, args.seed)
+    size = ops.key.nbytes + ops.role.nbytes + ops.type.nbytes + ops.ts.nbytes
+    print(f"{len(ops)} events, {size / 2 ** 20:.0f} MiB in arrays")
+
+    measure("holding_intervals", lambda: analytics.holding_intervals(ops))
+    measure("top_keys", lambda: analytics.top_keys(ops, 10))
+    measure("role_utilization", lambda: analytics.role_utilization(ops, {}, 86400 * 365))
+    measure("hour_of_week_heatmap", lambda: analytics.hour_of_week_heatmap(ops))
+    measure("holding_percentiles", lambda: analytics.holding_percentiles(ops))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Микробенчмарки составляющих запроса устройства.
+#   python benchmarks/bench_hot_path.py                     # замер
+#   python benchmarks/bench_hot_path.py --save main         # сохранить как baseline
+#   python benchmarks/bench_hot_path.py --compare main      # сравнить с baseline
+# При --compare код выхода 1, если какой-то замер медленнее baseline больше чем на --threshold.
+# В репозитории лежит baselines/reference.json (--compare reference); абсолютные значения
+# зависят от машины, поэтому для проверки регрессий лучше сохранить свой baseline
+# на той же машине - остальные файлы baselines/ git игнорирует.
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from app import create_app
+from app.models import Key, KeySlot, Operation, Device, Role, User
+from app.utils.decorators import require_device_auth, rate_limit
+from app.utils.jwt_utils import generate_jwt, decode_jwt
+from app.utils.rate_limit import rate_limiter
+from app.utils.serializers import serialize_key, OrjsonProvider, orjson
+from flask.json.provider import DefaultJSONProvider
+
+
+def _keys(count):
+    now = datetime.utcnow()
+    role, user = Role(id="r1"), User(id="u1")
+    devices = [Device(id=f"d{i}") for i in range((count + 19) // 20)]
+    keys = []
+    for i in range(count):
+        slot = KeySlot(id=f"s{i}", number=i % 20 + 1, device=devices[i // 20])
+        keys.append(Key(
+            id=f"k{i}", key_number=f"{i:06d}", is_taken=False, key_slot=slot,
+            assigned_role=role, last_user=user, last_device=slot.device,
+            created_at=now, updated_at=now
+        ))
+    return keys
+
+
+def cases(app):
+    """Имя замера -> функция без аргументов (одна итерация)."""
+    token = generate_jwt({"device_id": "d1", "device_pk": 1, "auth_time": 0})
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def view():
+        return "ok"
+
+    auth_only = require_device_auth(view)
+    auth_and_limit = require_device_auth(rate_limit(view))
+    # Лимит не должен срабатывать во время замера
+    rate_limiter.enabled = False
+
+    def in_request(fn):
+        def run():
+            with app.test_request_context("/device/auth_card/", method="POST", headers=headers):
+                fn()
+        return run
+
+    # Строки в том виде, в каком их возвращает select_keys()
+    rows_10k = [
+        (k.id, k.key_number, k.is_taken, k.key_slot.id, k.key_slot.device.id, k.last_user.id,
+         k.last_device.id, k.assigned_role.id, k.created_at, k.updated_at)
+        for k in _keys(10000)
+    ]
+    rows_100 = rows_10k[:100]
+    dicts_1k = [serialize_key(row) for row in rows_10k[:1000]]
+    dicts_10k = [serialize_key(row) for row in rows_10k]
+    now = datetime.utcnow()
+
+    def with_context(fn):
+        def run():
+            with app.app_context():
+                fn()
+        return run
+
+    stdlib_json = DefaultJSONProvider(app)
+    result = {
+        "jwt_encode": lambda: generate_jwt({"device_id": "d1", "device_pk": 1, "auth_time": 0}),
+        "jwt_decode": lambda: decode_jwt(token),
+        "request_context": in_request(view),
+        "require_device_auth": in_request(auth_only),
+        "require_device_auth+rate_limit": in_request(auth_and_limit),
+        "scan_card_key_dicts_100": lambda: [serialize_key(row) for row in rows_100],
+        "serialize_key_rows_10k": lambda: [serialize_key(row) for row in rows_10k],
+        "jsonify_1k_keys": with_context(lambda: stdlib_json.response(dicts_1k)),
+        "jsonify_10k_keys": with_context(lambda: stdlib_json.response(dicts_10k)),
+        "operation_construct": lambda: Operation(
+            user_pk=1, key_pk=1, device_pk=1, role_pk=1, type="TAKE", timestamp=now
+        ),
+    }
+    if orjson:
+        fast_json = OrjsonProvider(app)
+        result["orjson_1k_keys"] = with_context(lambda: fast_json.response(dicts_1k))
+        result["orjson_10k_keys"] = with_context(lambda: fast_json.response(dicts_10k))
+    return result
+
+
+def measure(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    # Минимум по повторам меньше всего зависит от фонового шума
+    return min(timer.repeat(repeat, number)) / number
+
+
+def _environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count(),
+        "orjson": orjson is not None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", metavar="NAME", help="Сохранить результаты в baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="Сравнить с baselines/NAME.json")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Допустимое замедление (доля)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Только замеры, содержащие подстроку")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        selected = {name: fn for name, fn in cases(app).items() if args.filter in name}
+    results = {}
+    for name, fn in selected.items():
+        results[name] = measure(fn, args.repeat)
+
+    baseline = {}
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        environment = _environment()
+        differs = [k for k in environment if saved.get(k) != environment[k]]
+        if differs:
+            print("Baseline снят в другом окружении (" + ", ".join(
+                f"{k}: {saved.get(k)} -> {environment[k]}" for k in differs
+            ) + "), сравнение приблизительное\n")
+
+    regressions = []
+    for name, seconds in results.items():
+        line = f"{name:<34} {seconds * 1e6:12.2f} us"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f"  {baseline[name] * 1e6:12.2f} us  {change:+7.1%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save}.json"), "w") as f:
+            json.dump({
+                **_environment(),
+                "created_at": datetime.utcnow().isoformat(),
+                "results": results
+            }, f, indent=2, sort_keys=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
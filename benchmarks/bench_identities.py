@@ -0,0 +1,195 @@
+# Размер индексов operation и время соединений до и после flask migrate-identities.
+# Строит в пустой базе PostgreSQL исходную схему со строковыми первичными ключами,
+# заполняет её через generate_series, замеряет запросы, выполняет migrate_identities()
+# и повторяет замеры на целочисленных pk.
+#   python benchmarks/bench_identities.py --database-url postgresql+psycopg2://.../keybox_ids --operations 5000000
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import create_engine, inspect, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Схема до миграции - как её создаёт db.create_all() исходной версии (строковые id,
+# внешние ключи ссылаются на id). Таблиц key_holding, key_state_snapshot и прочих
+# в ней ещё нет: их создаёт migrate_identities() после перевода на pk
+LEGACY_SCHEMA = [
+    'CREATE TABLE role (id VARCHAR(64) NOT NULL PRIMARY KEY, name VARCHAR NOT NULL UNIQUE)',
+    'CREATE TABLE device (id VARCHAR(64) NOT NULL PRIMARY KEY, ip_address VARCHAR, auth_token VARCHAR UNIQUE,'
+    ' timeout INTEGER, created_at TIMESTAMP, updated_at TIMESTAMP)',
+    'CREATE TABLE "user" (id VARCHAR(64) NOT NULL PRIMARY KEY, name VARCHAR, nfc_tag VARCHAR UNIQUE,'
+    ' created_at TIMESTAMP, updated_at TIMESTAMP, role_id VARCHAR REFERENCES role (id))',
+    'CREATE TABLE key_slot (id VARCHAR(64) NOT NULL PRIMARY KEY, number INTEGER NOT NULL, is_locked BOOLEAN,'
+    ' device_id VARCHAR NOT NULL REFERENCES device (id), created_at TIMESTAMP, updated_at TIMESTAMP,'
+    ' CONSTRAINT uq_slot_per_device UNIQUE (number, device_id))',
+    'CREATE TABLE "key" (id VARCHAR(40) NOT NULL PRIMARY KEY, key_number VARCHAR(20) NOT NULL UNIQUE,'
+    ' is_taken BOOLEAN, key_slot_id VARCHAR REFERENCES key_slot (id) ON DELETE SET NULL,'
+    ' assigned_role_id VARCHAR NOT NULL REFERENCES role (id), last_user_id VARCHAR REFERENCES "user" (id),'
+    ' last_device_id VARCHAR REFERENCES device (id), created_at TIMESTAMP, updated_at TIMESTAMP)',
+    "CREATE TYPE operationtype AS ENUM ('TAKE', 'RETURN')",
+    'CREATE TABLE operation (id SERIAL NOT NULL PRIMARY KEY, user_id VARCHAR REFERENCES "user" (id),'
+    ' key_id VARCHAR REFERENCES "key" (id), device_id VARCHAR REFERENCES device (id),'
+    ' type operationtype NOT NULL, timestamp TIMESTAMP)',
+]
+# В исходной схеме индексов operation не было. Те же индексы на строковых колонках
+# строятся после заполнения (как и индексы migrate_identities()), чтобы сравнение
+# показывало разницу в ширине ключей, а не наличие индексов
+LEGACY_INDEXES = [
+    'CREATE INDEX ix_operation_key_id_timestamp ON operation (key_id, timestamp)',
+    'CREATE INDEX ix_operation_user_id ON operation (user_id)',
+    'CREATE INDEX ix_operation_device_id ON operation (device_id)',
+    'CREATE INDEX ix_operation_timestamp_id ON operation (timestamp, id)',
+]
+
+
+def _id(prefix, expression):
+    # 8 символов, как uuid4().hex[:8] в моделях
+    return f"substr(md5('{prefix}' || ({expression})::text), 1, 8)"
+
+
+def fill(conn, args):
+    conn.execute(text(
+        f"INSERT INTO role SELECT {_id('r', 'i')}, 'Role ' || i FROM generate_series(1, {args.roles}) i"
+    ))
+    conn.execute(text(
+        f"INSERT INTO device SELECT {_id('d', 'i')}, '10.0.0.' || i, 'token-' || i, 30, now(), now() "
+        f"FROM generate_series(1, {args.devices}) i"
+    ))
+    conn.execute(text(
+        f"INSERT INTO \"user\" SELECT {_id('u', 'i')}, 'User ' || i, 'TAG' || i, now(), now(), "
+        f"{_id('r', f'i % {args.roles} + 1')} FROM generate_series(1, {args.users}) i"
+    ))
+    conn.execute(text(
+        f"INSERT INTO key_slot SELECT {_id('s', 'i')}, (i - 1) / {args.devices} + 1, false, "
+        f"{_id('d', f'(i - 1) % {args.devices} + 1')}, now(), now() FROM generate_series(1, {args.keys}) i"
+    ))
+    conn.execute(text(
+        f"INSERT INTO \"key\" SELECT {_id('k', 'i')}, lpad(i::text, 6, '0'), false, {_id('s', 'i')}, "
+        f"{_id('r', f'i % {args.roles} + 1')}, NULL, NULL, now(), now() FROM generate_series(1, {args.keys}) i"
+    ))
+    # Операции равномерно за год: ключ, пользователь его роли и устройство ячейки ключа
+    conn.execute(text(
+        f"INSERT INTO operation (user_id, key_id, device_id, type, timestamp) "
+        f"SELECT {_id('u', f'(k % {args.roles}) + 1 + {args.roles} * (i % ({args.users} / {args.roles}))')}, "
+        f"{_id('k', 'k')}, {_id('d', f'(k - 1) % {args.devices} + 1')}, "
+        f"CASE WHEN i % 2 = 0 THEN 'TAKE'::operationtype ELSE 'RETURN'::operationtype END, "
+        f"timestamp '2024-01-01' + (i * interval '1 second') * (365 * 86400 / {args.operations}) "
+        f"FROM (SELECT i, i % {args.keys} + 1 AS k FROM generate_series(1, {args.operations}) i) s"
+    ))
+    for statement in LEGACY_INDEXES:
+        conn.execute(text(statement))
+
+
+# Запросы в двух вариантах: {pk} - первичный ключ, {user}/{key}/{device}/{role} - внешние ключи
+QUERIES = {
+    # Выдачи по ролям за всё время (analytics.load_operations)
+    "takes per role": (
+        'SELECT u.{role}, count(*) FROM operation o JOIN "user" u ON u.{pk} = o.{user} '
+        "WHERE o.type = 'TAKE' GROUP BY u.{role}"
+    ),
+    # Журнал за месяц с внешними id (select_operations)
+    "month of operations with joins": (
+        'SELECT count(*), count(u.{public}), count(k.key_number), count(d.{public}) FROM operation o '
+        'LEFT JOIN "user" u ON u.{pk} = o.{user} LEFT JOIN "key" k ON k.{pk} = o.{key} '
+        "LEFT JOIN device d ON d.{pk} = o.{device} "
+        "WHERE o.timestamp >= '2024-06-01' AND o.timestamp < '2024-07-01'"
+    ),
+    # Последняя операция каждого ключа (check_consistency)
+    "latest operation per key": (
+        'SELECT count(*) FROM "key" k JOIN LATERAL (SELECT o.type FROM operation o WHERE o.{key} = k.{pk} '
+        "ORDER BY o.timestamp DESC LIMIT 1) last ON true"
+    ),
+}
+
+BEFORE = {"pk": "id", "public": "id", "user": "user_id", "key": "key_id", "device": "device_id", "role": "role_id"}
+AFTER = {"pk": "pk", "public": "public_id", "user": "user_pk", "key": "key_pk", "device": "device_pk", "role": "role_pk"}
+
+
+def measure(conn, columns, repeat):
+    result = {}
+    for name, query in QUERIES.items():
+        sql = text(query.format(**columns))
+        conn.execute(sql)  # прогрев кэша
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(sql).all()
+            times.append(time.perf_counter() - start)
+        result[name] = statistics.median(times)
+    return result
+
+
+def sizes(conn):
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_relation_size(c.oid) FROM pg_class c "
+        "WHERE c.relkind IN ('r', 'i') AND (c.relname = 'operation' OR c.relname LIKE 'ix_operation%' "
+        "OR c.relname = 'operation_pkey')"
+    )).all()
+    return dict(rows)
+
+
+def vacuum(engine, full=False):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM FULL ANALYZE" if full else "VACUUM ANALYZE"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", required=True, help="Пустая база PostgreSQL")
+    parser.add_argument("--operations", type=int, default=5_000_000)
+    parser.add_argument("--keys", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--roles", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    if inspect(engine).get_table_names():
+        sys.exit("База не пустая: замер создаёт свою схему")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(text(statement))
+        start = time.perf_counter()
+        fill(conn, args)
+        print(f"fill: {time.perf_counter() - start:.1f} s")
+    vacuum(engine)
+    with engine.connect() as conn:
+        size_before = sizes(conn)
+        time_before = measure(conn, BEFORE, args.repeat)
+
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("JOB_WORKERS", "0")
+    from app import create_app, db
+    from app.utils.schema import migrate_identities
+
+    app = create_app()
+    with app.app_context():
+        start = time.perf_counter()
+        migrate_identities()
+        print(f"migrate_identities: {time.perf_counter() - start:.1f} s")
+        db.session.remove()
+        db.engine.dispose()
+
+    # UPDATE при миграции переписывает все строки operation: без VACUUM FULL
+    # сравнивались бы таблицы с мёртвыми версиями строк
+    vacuum(engine, full=True)
+    with engine.connect() as conn:
+        size_after = sizes(conn)
+        time_after = measure(conn, AFTER, args.repeat)
+
+    print(f"\n{'relation':<34} {'before':>12} {'after':>12}")
+    for name in sorted(set(size_before) | set(size_after)):
+        print(f"{name:<34} {size_before.get(name, 0) / 2 ** 20:10.1f} MB "
+              f"{size_after.get(name, 0) / 2 ** 20:10.1f} MB")
+    print(f"\n{'query':<34} {'before':>12} {'after':>12}")
+    for name in QUERIES:
+        print(f"{name:<34} {time_before[name] * 1000:9.1f} ms {time_after[name] * 1000:9.1f} ms "
+              f"{time_after[name] / time_before[name] - 1:+7.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Задержка доставки инвалидаций между процессами через LISTEN/NOTIFY (INVALIDATION_BACKEND=postgres).
+# Несколько процессов-подписчиков, как воркеры gunicorn, и публикующий процесс;
+# задержка - от publish() до вызова обработчика в другом процессе.
+#   DATABASE_URL=postgresql+psycopg2://... python benchmarks/bench_invalidation.py --subscribers 4 --messages 2000
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _bus(database_url):
+    from flask import Flask
+    from app.utils.invalidation import invalidation_bus
+
+    app = Flask(__name__)
+    app.config.update(INVALIDATION_BACKEND="postgres", SQLALCHEMY_DATABASE_URI=database_url)
+    invalidation_bus.init_app(app)
+    return invalidation_bus
+
+
+def subscriber(database_url, ready, results):
+    delays, done = [], threading.Event()
+
+    def on_message(entity, entity_id):
+        if entity == "*":
+            # Сброс после подключения LISTEN: подписчик готов
+            ready.release()
+        elif entity_id is None:
+            done.set()
+        else:
+            delays.append(time.time() - float(entity_id))
+
+    bus = _bus(database_url)
+    bus.subscribe("bench", on_message)
+    done.wait(120)
+    results.put(delays)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=4, help="Процессов-подписчиков")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="Сообщений в секунду")
+    args = parser.parse_args()
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url or not database_url.startswith("postgresql"):
+        sys.exit("Нужен DATABASE_URL базы PostgreSQL")
+
+    ctx = multiprocessing.get_context("spawn")
+    ready, results = ctx.Semaphore(0), ctx.Queue()
+    processes = [ctx.Process(target=subscriber, args=(database_url, ready, results)) for _ in range(args.subscribers)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.acquire()
+
+    bus = _bus(database_url)
+    interval = 1 / args.rate
+    start = time.perf_counter()
+    for i in range(args.messages):
+        bus.publish("bench", repr(time.time()))
+        # Ровный темп, а не пачка: задержка не должна включать очередь отправки
+        time.sleep(max(0.0, start + (i + 1) * interval - time.perf_counter()))
+    bus.publish("bench", None)
+
+    delays = np.concatenate([np.array(results.get(timeout=150)) for _ in processes]) * 1000
+    for process in processes:
+        process.join()
+    expected = args.messages * args.subscribers
+    print(f"delivered {len(delays)}/{expected} messages to {args.subscribers} processes")
+    if len(delays):
+        print("delay ms: " + "  ".join(
+            f"p{p} {np.percentile(delays, p):.2f}" for p in (50, 95, 99)
+        ) + f"  max {delays.max():.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Замер восстановления состояния ключей на синтетическом журнале в SQLite.
+#   python benchmarks/bench_key_state.py --operations 10000000
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(name, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{name:<28} {time.perf_counter() - start:8.3f} s")
+    return result
+
+
+def fill_operations(db, Operation, operations, keys, seed, chunk_size=100000):
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 1, 1)
+    # Равномерный поток операций за год; каждый ключ чередует выдачу и возврат
+    seconds = np.sort(rng.integers(0, 365 * 86400, operations))
+    key_codes = rng.integers(0, keys, operations)
+    taken = np.zeros(keys, bool)
+    table = Operation.__table__
+    for i in range(0, operations, chunk_size):
+        rows = []
+        for sec, key in zip(seconds[i:i + chunk_size].tolist(), key_codes[i:i + chunk_size].tolist()):
+            taken[key] = not taken[key]
+            rows.append({
+                "key_pk": key + 1,
+                "user_pk": key % 1000 + 1,
+                "device_pk": key % 500 + 1,
+                "type": "TAKE" if taken[key] else "RETURN",
+                "timestamp": start + timedelta(seconds=sec)
+            })
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+    return start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--operations", type=int, default=10_000_000)
+    parser.add_argument("--keys", type=int, default=20_000)
+    parser.add_argument("--every-hours", type=int, default=24)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+
+    from app import create_app, db
+    from app.models import Operation
+    from app.utils import key_state
+
+    app = create_app()
+    with app.app_context():
+        start = measure("fill operations", lambda: fill_operations(
+            db, Operation, args.operations, args.keys, args.seed))
+        measure("build_snapshots", lambda: key_state.build_snapshots(args.every_hours))
+
+        rng = np.random.default_rng(args.seed)
+        moments = [start + timedelta(seconds=int(s)) for s in rng.integers(0, 365 * 86400, args.queries)]
+        replayed = []
+
+        def all_keys():
+            for ts in moments:
+                replayed.append(key_state.state_at(ts)[2])
+
+        measure(f"state_at x{args.queries}", all_keys)
+        print(f"{'replayed per query':<28} {int(np.mean(replayed)):8d} ops")
+        measure(f"state_at one key x{args.queries}", lambda: [key_state.state_at(ts, 1) for ts in moments])
+        measure("full replay (no snapshot)", lambda: key_state.fold({}, key_state._operations(until=moments[0])))
+
+
+if __name__ == "__main__":
+    main()
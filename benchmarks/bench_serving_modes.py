@@ -0,0 +1,201 @@
+# Пропускная способность API при синхронных воркерах gunicorn и в режиме gevent_app.py.
+# Ключницы из fleet_load.py касаются карт, а ещё часть устройств держит long-poll
+# /device/commands/: в синхронном режиме каждый такой запрос занимает воркер (поток).
+# Для режима gevent перебираются размеры пула соединений - по результату выбирается DB_POOL_SIZE.
+#   DATABASE_URL=... python benchmarks/bench_serving_modes.py --keyboxes 100 --pollers 200
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from fleet_load import Keybox, Stats, load_fleet, token_error
+
+# Допустимая потеря пропускной способности при меньшем пуле
+POOL_TOLERANCE = 0.95
+
+
+class Poller(threading.Thread):
+    """Устройство, которое всё время ждёт команды в long-poll."""
+
+    def __init__(self, port, device_id, auth_token, stop):
+        super().__init__(daemon=True)
+        self.port = port
+        self.device_id = device_id
+        self.auth_token = auth_token
+        self.stop = stop
+        self.polls = 0
+
+    def call(self, conn, method, path, body=None, token=None):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b"{}")
+
+    def run(self):
+        token, since, conn = None, 0, None
+        while not self.stop.is_set():
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+                if token is None:
+                    status, data = self.call(conn, "POST", "/device/init/", {
+                        "device_id": self.device_id, "auth_key": self.auth_token
+                    })
+                    token = data.get("token") if status == 200 else None
+                    if token is None:
+                        self.stop.wait(1)
+                        continue
+                status, data = self.call(conn, "GET", f"/device/commands/?since={since}&wait=30", token=token)
+                if status == 200:
+                    since = data["version"]
+                    self.polls += 1
+                elif token_error(status, data):
+                    token = None
+            except (OSError, http.client.HTTPException, ValueError):
+                if conn:
+                    conn.close()
+                conn = None
+                self.stop.wait(0.5)
+
+
+def port_open(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def wait_for_port(port, is_open, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if port_open(port) == is_open:
+            return
+        time.sleep(0.2)
+    raise RuntimeError(f"Порт {port} {'не открылся' if is_open else 'занят'}")
+
+
+def start_server(mode, args, pool_size):
+    env = dict(
+        os.environ,
+        RATE_LIMIT_ENABLED="false",
+        JOB_WORKERS="0",
+        DB_POOL_SIZE=str(pool_size),
+        DB_MAX_OVERFLOW="0",
+    )
+    command = [
+        sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}",
+        "--timeout", "120", "--log-level", "warning",
+    ]
+    if mode == "sync":
+        command += ["-k", "sync", "run:app"]
+    elif mode == "gthread":
+        command += ["-k", "gthread", "--threads", str(args.threads), "run:app"]
+    else:
+        command += ["-k", "gevent", "--worker-connections", str(args.worker_connections), "gevent_app:app"]
+    wait_for_port(args.port, is_open=False)
+    # Своя группа процессов: при остановке завершаются и воркеры с незакрытыми long-poll
+    server = subprocess.Popen(command, cwd=ROOT, env=env, start_new_session=True)
+    wait_for_port(args.port, is_open=True)
+    # Воркеры создают приложение после открытия порта
+    time.sleep(3)
+    return server
+
+
+def run_mode(mode, args, fleet, pool_size):
+    server = start_server(mode, args, pool_size)
+    stats, stop = Stats(), threading.Event()
+    load_args = argparse.Namespace(
+        base_url=f"http://127.0.0.1:{args.port}", think=args.think, ramp_up=2,
+        shift_every=0, surge_seconds=0, surge_factor=1, refresh=True,
+    )
+    boxes = [
+        Keybox(load_args, device_id, auth_token, tags, stats, stop, args.seed + i)
+        for i, (device_id, auth_token, tags) in enumerate(fleet[:args.keyboxes])
+    ]
+    pollers = [
+        Poller(args.port, device_id, auth_token, stop)
+        for device_id, auth_token, _ in (fleet * args.pollers)[:args.pollers]
+    ]
+    try:
+        for thread in pollers:
+            thread.start()
+        time.sleep(2)
+        start = time.perf_counter()
+        for thread in boxes:
+            thread.start()
+        time.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in boxes:
+            thread.join(timeout=35)
+    finally:
+        stop.set()
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+    latencies = np.concatenate([np.array(v) for v in stats.latencies.values()] or [np.zeros(0)])
+    errors = {}
+    for by_status in stats.errors.values():
+        for status, count in by_status.items():
+            errors[status or "conn"] = errors.get(status or "conn", 0) + count
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50": np.percentile(latencies, 50) * 1000 if len(latencies) else float("nan"),
+        "p95": np.percentile(latencies, 95) * 1000 if len(latencies) else float("nan"),
+        "errors": errors,
+        "polls": sum(p.polls for p in pollers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keyboxes", type=int, default=100, help="Ключниц, к которым подносят карты")
+    parser.add_argument("--pollers", type=int, default=200, help="Устройств в long-poll /device/commands/")
+    parser.add_argument("--think", type=float, default=0.5, help="Средняя пауза между касаниями, с")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=2, help="Процессов gunicorn")
+    parser.add_argument("--threads", type=int, default=8, help="Потоков на процесс для gthread")
+    parser.add_argument("--worker-connections", type=int, default=1000)
+    parser.add_argument("--pool-sizes", default="2,5,10,20", help="Размеры пула для режима gevent")
+    parser.add_argument("--modes", default="sync,gthread,gevent")
+    parser.add_argument("--port", type=int, default=5077)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fleet = load_fleet(max(args.keyboxes, args.pollers), args.seed)
+    if not fleet:
+        sys.exit("В БД нет устройств с ключами и пользователями (см. flask generate-data)")
+    random.Random(args.seed).shuffle(fleet)
+
+    runs = []
+    for mode in args.modes.split(","):
+        pool_sizes = [int(s) for s in args.pool_sizes.split(",")] if mode == "gevent" else [args.threads]
+        for pool_size in pool_sizes:
+            result = run_mode(mode, args, fleet, pool_size)
+            runs.append((mode, pool_size, result))
+            print(f"{mode:<8} pool={pool_size:<3} {result['rps']:8.1f} req/s  p50 {result['p50']:8.1f} ms  "
+                  f"p95 {result['p95']:8.1f} ms  long-polls {result['polls']}  errors {result['errors'] or '-'}",
+                  flush=True)
+
+    gevent_runs = [(pool_size, result) for mode, pool_size, result in runs if mode == "gevent"]
+    if gevent_runs:
+        best = max(result["rps"] for _, result in gevent_runs)
+        pool_size = min(size for size, result in gevent_runs if result["rps"] >= best * POOL_TOLERANCE)
+        print(f"\nНаименьший пул gevent с пропускной способностью не ниже {POOL_TOLERANCE:.0%} "
+              f"от лучшей: DB_POOL_SIZE={pool_size} на процесс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# Нагрузка от парка ключниц по настоящему протоколу устройств.
+# Устройства, ключи и пользователи берутся из БД (например, после flask generate-data),
+# запросы идут в запущенный экземпляр API:
+#   DATABASE_URL=... python benchmarks/fleet_load.py --base-url http://127.0.0.1:5000 --keyboxes 200
+# Для поиска точки насыщения запустите API с RATE_LIMIT_ENABLED=false,
+# иначе ответы 429 будут считаться ошибками.
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import jwt
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ENDPOINTS = ["init", "refresh", "auth_card", "get_key", "get_empty_slot", "return_key"]
+# Токен обновляется, когда от срока жизни осталось меньше этой доли
+REFRESH_AT = 0.2
+
+
+def load_fleet(keyboxes, seed):
+    """Устройства с токенами и, для каждого, NFC-метки пользователей ролей, чьи ключи лежат в нём."""
+    from app import create_app, db
+    from app.models import Device, Key, KeySlot, User
+    from config import Config
+
+    class FleetConfig(Config):
+        # Приложение нужно только для чтения парка из БД: без фоновых задач,
+        # планировщика просрочек и LISTEN шины инвалидаций
+        JOB_WORKERS = 0
+        OVERDUE_ENABLED = False
+        INVALIDATION_BACKEND = "memory"
+        READ_REPLICA_URLS = ""
+
+    app = create_app(FleetConfig)
+    with app.app_context():
+        devices = db.session.query(Device.id, Device.auth_token).order_by(Device.id).all()
+        random.Random(seed).shuffle(devices)
+        devices = devices[:keyboxes]
+        roles_by_device = defaultdict(set)
+        rows = (
+            db.session.query(Device.id, Key.assigned_role_pk)
+            .join(KeySlot, KeySlot.device_pk == Device.pk)
+            .join(Key, Key.key_slot_pk == KeySlot.pk)
+            .filter(Device.id.in_([d.id for d in devices]))
+            .distinct()
+        )
+        for device_id, role_pk in rows:
+            roles_by_device[device_id].add(role_pk)
+        tags_by_role = defaultdict(list)
+        for role_pk, nfc_tag in db.session.query(User.role_pk, User.nfc_tag).filter(User.nfc_tag.isnot(None)):
+            tags_by_role[role_pk].append(nfc_tag)
+
+    fleet = []
+    for device_id, auth_token in devices:
+        tags = [tag for role in roles_by_device[device_id] for tag in tags_by_role[role]]
+        if tags:
+            fleet.append((device_id, auth_token, tags))
+    return fleet
+
+
+def token_error(status, body):
+    """
+    Ответ, после которого нужен новый токен. Истёкший токен require_device_auth
+    отклоняет с 403, отозванный - с 401; ошибки токена приходят в поле "error",
+    а 401 scan_card для неизвестной карты - в "status"/"log" и токен не касается.
+    """
+    return status in (401, 403) and "error" in body
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if status >= 400 or status == 0:
+                self.errors[endpoint][status] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(len(v) for v in self.latencies.values())
+
+
+class Keybox(threading.Thread):
+    """
+    Одна ключница: подносят карту, берут доступный ключ или возвращают
+    ранее взятый в свободную ячейку, между касаниями - пауза.
+    """
+
+    def __init__(self, args, device_id, auth_token, tags, stats, stop, seed):
+        super().__init__(daemon=True)
+        self.args = args
+        self.device_id = device_id
+        self.auth_token = auth_token
+        self.tags = tags
+        self.stats = stats
+        self.stop = stop
+        self.rng = random.Random(seed)
+        self.url = urlsplit(args.base_url)
+        self.conn = None
+        self.token = None
+        # (iat, exp) текущего токена - для /device/refresh/
+        self.token_times = None
+        # NFC-метка -> id взятого в этой ключнице ключа
+        self.held = {}
+
+    def request(self, endpoint, method, path, body=None):
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        payload = json.dumps(body) if body is not None else None
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            if self.conn:
+                self.conn.close()
+            self.conn = None
+            status, data = 0, b""
+        self.stats.record(endpoint, time.perf_counter() - start, status)
+        try:
+            body = json.loads(data) if data else {}
+        except ValueError:
+            body = {}
+        if endpoint not in ("init", "refresh") and token_error(status, body):
+            self.token = None
+        return status, body
+
+    def think_time(self):
+        mean = self.args.think
+        if self.args.shift_every and time.time() % self.args.shift_every < self.args.surge_seconds:
+            mean /= self.args.surge_factor
+        return self.rng.expovariate(1 / mean) if mean > 0 else 0
+
+    def set_token(self, token):
+        self.token = token
+        if token:
+            payload = jwt.decode(token, options={"verify_signature": False})
+            self.token_times = (payload["iat"], payload["exp"])
+
+    def init(self):
+        self.token = None
+        status, data = self.request("init", "POST", "/device/init/", {
+            "device_id": self.device_id, "auth_key": self.auth_token
+        })
+        self.set_token(data.get("token") if status == 200 else None)
+
+    def refresh_if_due(self):
+        iat, exp = self.token_times
+        if time.time() < exp - (exp - iat) * REFRESH_AT:
+            return
+        status, data = self.request("refresh", "POST", "/device/refresh/")
+        # Цепочка оборвалась или токен отозван - следующий цикл выполнит init
+        self.set_token(data.get("token") if status == 200 else None)
+
+    def take(self, tag):
+        status, data = self.request("auth_card", "POST", "/device/auth_card/", {"nfcId": tag})
+        available = data.get("available_keys") if status == 200 else None
+        if not available:
+            return
+        key_number = self.rng.choice(available)["key_number"]
+        status, data = self.request("get_key", "POST", "/device/get_key/", {
+            "key_number": key_number, "nfcId": tag
+        })
+        if status == 200:
+            self.held[tag] = data["keyUuid"]
+
+    def give_back(self, tag):
+        key_id = self.held.pop(tag)
+        self.request("auth_card", "POST", "/device/auth_card/", {"nfcId": tag})
+        status, data = self.request("get_empty_slot", "GET", "/device/get_empty_slot/")
+        if status != 200:
+            return
+        self.request("return_key", "POST", "/device/return_key/", {
+            "keySlotNumber": data["keySlotNumber"], "keyId": key_id, "nfcId": tag
+        })
+
+    def run(self):
+        # Ключницы включаются не одновременно
+        self.stop.wait(self.rng.uniform(0, self.args.ramp_up))
+        while not self.stop.is_set():
+            if self.token is None:
+                self.init()
+                if self.token is None:
+                    self.stop.wait(1)
+                    continue
+            elif self.args.refresh:
+                self.refresh_if_due()
+                if self.token is None:
+                    continue
+            if self.held and self.rng.random() < 0.5:
+                self.give_back(self.rng.choice(list(self.held)))
+            else:
+                self.take(self.rng.choice(self.tags))
+            self.stop.wait(self.think_time())
+        if self.conn:
+            self.conn.close()
+
+
+def report(stats, elapsed):
+    print(f"\n{'endpoint':<16}{'requests':>10}{'rps':>9}{'errors':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    total = 0
+    for endpoint in ENDPOINTS:
+        values = np.array(stats.latencies.get(endpoint, []))
+        if not len(values):
+            continue
+        total += len(values)
+        errors = sum(stats.errors[endpoint].values())
+        p50, p95, p99 = np.percentile(values, (50, 95, 99)) * 1000
+        print(f"{endpoint:<16}{len(values):>10}{len(values) / elapsed:>9.1f}{errors:>9}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}")
+    print(f"{'total':<16}{total:>10}{total / elapsed:>9.1f}")
+    for endpoint, by_status in stats.errors.items():
+        if not by_status:
+            continue
+        details = ", ".join(f"{status or 'conn'}: {count}" for status, count in sorted(by_status.items()))
+        print(f"errors {endpoint}: {details}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--keyboxes", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=60, help="Длительность в секундах")
+    parser.add_argument("--think", type=float, default=5, help="Средняя пауза между касаниями, с")
+    parser.add_argument("--ramp-up", type=float, default=5, help="За сколько секунд включаются все ключницы")
+    parser.add_argument("--shift-every", type=float, default=0,
+                        help="Период пересменки в секундах (0 - без пересменок)")
+    parser.add_argument("--surge-seconds", type=float, default=30, help="Длительность пика пересменки")
+    parser.add_argument("--surge-factor", type=float, default=10, help="Во сколько раз чаще касания в пик")
+    parser.add_argument("--no-refresh", dest="refresh", action="store_false",
+                        help="Не обновлять токен через /device/refresh/, а ждать 401 и делать init")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fleet = load_fleet(args.keyboxes, args.seed)
+    if not fleet:
+        sys.exit("В БД нет устройств с ключами и пользователями (см. flask generate-data)")
+    print(f"{len(fleet)} keyboxes against {args.base_url}")
+
+    stats = Stats()
+    stop = threading.Event()
+    boxes = [
+        Keybox(args, device_id, auth_token, tags, stats, stop, args.seed + i)
+        for i, (device_id, auth_token, tags) in enumerate(fleet)
+    ]
+    start = time.perf_counter()
+    for box in boxes:
+        box.start()
+    try:
+        last = 0
+        while time.perf_counter() - start < args.duration:
+            time.sleep(5)
+            done = stats.total()
+            print(f"{time.perf_counter() - start:6.0f} s  {(done - last) / 5:8.1f} req/s")
+            last = done
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for box in boxes:
+        box.join(timeout=35)
+    report(stats, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
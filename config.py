@@ -5,7 +5,60 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/keybox")
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Пул соединений на процесс. В режиме gevent_app.py одновременных запросов
+    # больше, чем потоков, но соединение нужно только на время запросов к БД:
+    # размер 5 подобран по benchmarks/bench_serving_modes.py (см. gevent_app.py)
+    SQLALCHEMY_ENGINE_OPTIONS = {} if SQLALCHEMY_DATABASE_URI.startswith("sqlite") else {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", 30)),
+    }
     SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
+
+    # Реплики для чтения в админских отчётах (через запятую)
+    READ_REPLICA_URLS = os.getenv("READ_REPLICA_URLS", "")
+    REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 10))
+    REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", 5))
+
+    # Шина инвалидаций кэшей между экземплярами API: memory | postgres.
+    # memory работает в пределах процесса: при нескольких воркерах или экземплярах
+    # нужен postgres, иначе кэши (и индекс поиска без pg_trgm) отстают до перечитывания
+    INVALIDATION_BACKEND = os.getenv("INVALIDATION_BACKEND", "memory")
+    INVALIDATION_DATABASE_URL = os.getenv("INVALIDATION_DATABASE_URL")
+
+    # Ограничение частоты запросов устройств (token bucket)
+    RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    DEVICE_RATE_PER_SECOND = float(os.getenv("DEVICE_RATE_PER_SECOND", 2))
+    DEVICE_RATE_BURST = int(os.getenv("DEVICE_RATE_BURST", 10))
+    IP_RATE_PER_SECOND = float(os.getenv("IP_RATE_PER_SECOND", 20))
+    IP_RATE_BURST = int(os.getenv("IP_RATE_BURST", 50))
+    # Например redis://redis:6379/0, чтобы лимиты были общими для всех экземпляров
+    RATE_LIMIT_STORAGE_URL = os.getenv("RATE_LIMIT_STORAGE_URL")
+    # Сколько обратных прокси (nginx, балансировщик) стоит перед приложением:
+    # адрес клиента для лимита по IP берётся из X-Forwarded-For через ProxyFix.
+    # 0 - прокси нет, используется адрес TCP-соединения
+    TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+
+    # Просроченные ключи: срок по роли ("role_id=минуты,..."), иначе Device.timeout
+    # устройства выдачи в минутах, иначе OVERDUE_DEFAULT_MINUTES
+    OVERDUE_ENABLED = os.getenv("OVERDUE_ENABLED", "true").lower() == "true"
+    OVERDUE_DEFAULT_MINUTES = int(os.getenv("OVERDUE_DEFAULT_MINUTES", 480))
+    OVERDUE_ROLE_MINUTES = os.getenv("OVERDUE_ROLE_MINUTES", "")
+
+    # Ответы JSON через orjson (если пакет установлен)
+    ORJSON_ENABLED = os.getenv("ORJSON_ENABLED", "true").lower() == "true"
+
+    # Потоки для фоновых задач /admin/jobs/ в процессе API. По умолчанию 0:
+    # задачи выполняет отдельный процесс flask run-jobs, а не воркеры API,
+    # где они делили бы пул соединений с запросами устройств
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", 0))
+
+    # Архив журнала операций
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 180))
+    ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", 5000))
+    # Интервал снимков состояния ключей (flask snapshot-key-state)
+    KEY_SNAPSHOT_HOURS = int(os.getenv("KEY_SNAPSHOT_HOURS", 24))
     SWAGGER = {
         "title": "KeyBox API",
         "uiversion": 3
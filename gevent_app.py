@@ -0,0 +1,28 @@
+# Кооперативный режим запуска: запросы устройств, ожидающие БД,
+# не занимают отдельный поток, а переключаются как гринлеты.
+#   gunicorn -k gevent -w 2 --worker-connections 1000 gevent_app:app
+#
+# Соединений с БД нужно намного меньше, чем worker-connections: long-poll
+# /device/commands/ возвращает соединение в пул на время ожидания, а остальные
+# запросы держат его только на время своих запросов к БД. По
+# benchmarks/bench_serving_modes.py (2 процесса, 100 ключниц + 200 long-poll)
+# пропускная способность не растёт при пуле больше 2-10 соединений на процесс
+# и падает при 40, поэтому в этом режиме пул не расширяется сверх DB_POOL_SIZE.
+import os
+
+os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+# Фоновые задачи (архивация, пересчёты) заняли бы цикл событий на секунды и
+# соединения общего пула - здесь их не выполняем, для них запускается flask run-jobs
+os.environ["JOB_WORKERS"] = "0"
+
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+
+patch_psycopg()
+
+from app import create_app
+
+app = create_app()
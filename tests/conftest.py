@@ -0,0 +1,64 @@
+import pytest
+
+from app import create_app, db
+from app.models import Device, Key, KeySlot, Role, User
+from app.utils.admin_jwt_utils import generate_admin_jwt
+from config import Config
+
+
+@pytest.fixture
+def app(tmp_path):
+    class TestConfig(Config):
+        # Своя SQLite на каждый тест, без фоновых потоков и лимитов частоты
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'keybox.db'}"
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+        JOB_WORKERS = 0
+        OVERDUE_ENABLED = False
+        RATE_LIMIT_ENABLED = False
+        INVALIDATION_BACKEND = "memory"
+        READ_REPLICA_URLS = ""
+        ARCHIVE_DIR = str(tmp_path / "archive")
+
+    app = create_app(TestConfig)
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_headers():
+    return {"Authorization": "Bearer " + generate_admin_jwt(1)}
+
+
+@pytest.fixture
+def seed(app):
+    """Роль, устройство с двумя ячейками, пользователь и ключ в первой ячейке."""
+    with app.app_context():
+        role = Role(name="staff")
+        device = Device(ip_address="10.0.0.1", auth_token="device-secret", timeout=30)
+        db.session.add_all([role, device])
+        db.session.flush()
+        slot1, slot2 = KeySlot(number=1, device=device), KeySlot(number=2, device=device)
+        user = User(name="Ivanov", nfc_tag="NFC1", role=role)
+        db.session.add_all([slot1, slot2, user])
+        db.session.flush()
+        key = Key(key_number="101", assigned_role=role, key_slot=slot1)
+        db.session.add(key)
+        db.session.commit()
+        return {
+            "role": role.id, "device": device.id, "auth_token": device.auth_token,
+            "slot1": slot1.id, "slot2": slot2.id, "user": user.id, "key": key.id,
+        }
+
+
+@pytest.fixture
+def device_headers(client, seed):
+    response = client.post("/device/init/", json={"device_id": seed["device"], "auth_key": seed["auth_token"]})
+    assert response.status_code == 200
+    return {"Authorization": "Bearer " + response.json["token"]}
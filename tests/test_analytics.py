@@ -0,0 +1,23 @@
+from app.models import Role, User, db
+
+
+def test_role_change_keeps_history_with_the_old_role(app, client, seed, admin_headers, device_headers):
+    take = {"nfcId": "NFC1", "key_number": "101"}
+    give_back = {"nfcId": "NFC1", "keyId": seed["key"], "keySlotNumber": 1}
+    assert client.post("/device/get_key/", json=take, headers=device_headers).status_code == 200
+    assert client.post("/device/return_key/", json=give_back, headers=device_headers).status_code == 200
+
+    with app.app_context():
+        other = Role(name="guards")
+        db.session.add(other)
+        db.session.flush()
+        User.query.filter_by(id=seed["user"]).one().role_pk = other.pk
+        db.session.commit()
+
+    from app.utils import analytics
+    analytics._cache.clear()
+    roles = {row["role_id"]: row for row in client.get("/admin/analytics/roles/", headers=admin_headers).json}
+    assert list(roles) == [seed["role"]]
+    assert roles[seed["role"]]["takes"] == 1
+    by_role = client.get("/admin/analytics/holding_times/", headers=admin_headers).json["by_role"]
+    assert [row["role_id"] for row in by_role] == [seed["role"]]
@@ -0,0 +1,55 @@
+import gzip
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import Key, Operation, User, db
+from app.utils.archive import _archive_lock, archive_operations, read_archived_operations
+
+
+def _add_operations(count, days_ago=400):
+    user, key = User.query.first(), Key.query.first()
+    at = datetime.utcnow() - timedelta(days=days_ago)
+    db.session.add_all([
+        Operation(user=user, key=key, device=None, type="TAKE" if i % 2 == 0 else "RETURN",
+                  timestamp=at + timedelta(minutes=i))
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def test_archive_moves_old_operations(app, seed, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    with app.app_context():
+        _add_operations(25)
+        assert archive_operations(archive_dir, 180, chunk_size=10) == 25
+        assert Operation.query.count() == 0
+        archived = list(read_archived_operations(archive_dir))
+    assert len(archived) == 25
+    assert {row["key_number"] for row in archived} == {"101"}
+
+
+def test_second_run_is_refused_while_archiving(app, seed, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    with app.app_context():
+        _add_operations(5)
+        (tmp_path / "archive").mkdir()
+        with _archive_lock(archive_dir):
+            with pytest.raises(RuntimeError):
+                archive_operations(archive_dir, 180)
+        assert Operation.query.count() == 5
+        assert archive_operations(archive_dir, 180) == 5
+    for path in (tmp_path / "archive").glob("*.csv.gz"):
+        with gzip.open(path, "rt") as f:
+            f.read()
+
+
+def test_archive_job_is_not_queued_twice(client, admin_headers):
+    first = client.post("/admin/jobs/", json={"kind": "archive_operations"}, headers=admin_headers)
+    assert first.status_code == 202
+    second = client.post("/admin/jobs/", json={"kind": "archive_operations"}, headers=admin_headers)
+    assert second.status_code == 409
+    assert second.json["job_id"] == first.json["id"]
+    # Другие типы задач не ограничены
+    assert client.post("/admin/jobs/", json={"kind": "rebuild_holdings"}, headers=admin_headers).status_code == 202
+    assert client.post("/admin/jobs/", json={"kind": "rebuild_holdings"}, headers=admin_headers).status_code == 202
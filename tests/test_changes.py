@@ -0,0 +1,108 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app import create_app, db
+from app.models import ChangeLog, Device, Role, User
+from app.utils import changes
+from app.utils.changes import build_delta, build_snapshot, current_version, prune_change_log
+from config import Config
+
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def _device_pk(seed):
+    return Device.query.filter_by(id=seed["device"]).one().pk
+
+
+def _rename(user_id, name):
+    user = User.query.filter_by(id=user_id).one()
+    user.name = name
+    db.session.commit()
+
+
+def test_delta_returns_changes_after_snapshot(app, seed):
+    with app.app_context():
+        device_pk = _device_pk(seed)
+        version = build_snapshot(device_pk)["version"]
+        _rename(seed["user"], "Petrov")
+
+        delta = build_delta(device_pk, version)
+        assert [u["id"] for u in delta["users"]] == [seed["user"]]
+        assert delta["version"] > version and not delta["more"]
+        assert build_delta(device_pk, delta["version"])["users"] == []
+
+
+def test_transaction_shares_one_version(app, seed):
+    with app.app_context():
+        role = Role.query.filter_by(id=seed["role"]).one()
+        db.session.add_all([User(name=f"U{n}", nfc_tag=f"T{n}", role=role) for n in range(3)])
+        db.session.commit()
+        versions = {v for (v,) in db.session.query(ChangeLog.version).filter(ChangeLog.entity == "user")}
+        assert len(versions) == 2  # seed и эта транзакция
+
+
+def test_delta_pages_end_on_version_boundary(app, seed, monkeypatch):
+    monkeypatch.setattr(changes, "DELTA_LIMIT", 2)
+    with app.app_context():
+        device_pk = _device_pk(seed)
+        since = current_version()
+        role = Role.query.filter_by(id=seed["role"]).one()
+        for batch in ((0, 1, 2), (3,)):
+            db.session.add_all([User(name=f"U{n}", nfc_tag=f"T{n}", role=role) for n in batch])
+            db.session.commit()
+
+        # Транзакция из трёх записей больше страницы - отдаётся целиком
+        first = build_delta(device_pk, since)
+        assert len(first["users"]) == 3 and first["more"]
+        second = build_delta(device_pk, first["version"])
+        assert [u["nfc_tag"] for u in second["users"]] == ["T3"] and not second["more"]
+
+
+def test_stale_or_foreign_cursor_needs_full_snapshot(app, seed):
+    with app.app_context():
+        device_pk = _device_pk(seed)
+        old = current_version()
+        _rename(seed["user"], "Petrov")
+        _rename(seed["user"], "Sidorov")
+        ChangeLog.query.update({ChangeLog.created_at: datetime.utcnow() - timedelta(days=60)})
+        db.session.commit()
+
+        assert prune_change_log(30) > 0
+        assert build_delta(device_pk, old) is None
+        assert build_delta(device_pk, current_version()) is not None
+        assert build_delta(device_pk, current_version() + 100) is None
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="TEST_POSTGRES_URL не задан")
+def test_postgres_delta_waits_for_earlier_transaction():
+    class PostgresConfig(Config):
+        SQLALCHEMY_DATABASE_URI = POSTGRES_URL
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+        JOB_WORKERS = 0
+        OVERDUE_ENABLED = False
+        INVALIDATION_BACKEND = "memory"
+        READ_REPLICA_URLS = ""
+
+    app = create_app(PostgresConfig)
+    with app.app_context():
+        role = Role(name=f"changes-{datetime.utcnow().timestamp()}")
+        first, second = User(name="First", role=role), User(name="Second", role=role)
+        db.session.add_all([role, first, second])
+        db.session.commit()
+        since = current_version()
+
+        # Транзакция с меньшим номером фиксируется позже соседней
+        slow = Session(db.engine)
+        slow.get(User, first.pk).name = "First 2"
+        slow.flush()
+        _rename(second.id, "Second 2")
+
+        delta = build_delta(0, since)
+        assert delta["users"] == []
+        slow.commit()
+        slow.close()
+        delta = build_delta(0, delta["version"])
+        assert {u["id"] for u in delta["users"]} == {first.id, second.id}
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from app.utils.device_commands import DeviceCommandRegistry
+
+
+def test_wait_times_out_with_same_version():
+    registry = DeviceCommandRegistry()
+    registry.push("d1", {"type": "config", "timeout": 30})
+    start = time.monotonic()
+    assert registry.wait("d1", 1, 0.2) == (1, [], False)
+    assert 0.15 <= time.monotonic() - start < 2
+
+
+def test_push_wakes_only_that_device():
+    registry = DeviceCommandRegistry()
+    results = {}
+
+    def park(device_id):
+        results[device_id] = registry.wait(device_id, 0, 2)
+
+    threads = [threading.Thread(target=park, args=(d,)) for d in ("d1", "d2")]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    registry.push("d1", {"type": "slot_lock", "slot_number": 1, "is_locked": True})
+    threads[0].join()
+    assert time.monotonic() - start < 1
+    assert results["d1"] == (1, [{"type": "slot_lock", "slot_number": 1, "is_locked": True}], False)
+    threads[1].join()
+    assert results["d2"] == (0, [], False)
+
+
+def test_invalidate_cancels_wait_with_full_config():
+    registry = DeviceCommandRegistry()
+    registry.push("d1", {"type": "config", "timeout": 30})
+    threading.Timer(0.1, registry.invalidate, ("d1",)).start()
+    version, commands, full = registry.wait("d1", 1, 5)
+    assert (version, commands, full) == (2, [], True)
+
+
+def test_since_from_previous_run_gets_full_config():
+    registry = DeviceCommandRegistry()
+    assert registry.wait("d1", 7, 0)[2]
+
+
+def test_long_poll_endpoint(app, client, seed, admin_headers, device_headers):
+    full = client.get("/device/commands/", headers=device_headers).json
+    assert full["full"]
+    assert {"type": "slot_lock", "slot_number": 1, "is_locked": False} in full["commands"]
+
+    start = time.monotonic()
+    idle = client.get(f"/device/commands/?since={full['version']}&wait=0.3", headers=device_headers).json
+    assert time.monotonic() - start >= 0.25
+    assert idle == {"status": "success", "version": full["version"], "full": False, "commands": []}
+
+    # Изменение админа отпускает ожидающий запрос раньше таймаута
+    def lock_slot():
+        time.sleep(0.2)
+        with app.test_client() as admin:
+            admin.put(f"/admin/update_slot/{seed['slot2']}/", json={"is_locked": True}, headers=admin_headers)
+
+    thread = threading.Thread(target=lock_slot)
+    thread.start()
+    start = time.monotonic()
+    woken = client.get(f"/device/commands/?since={full['version']}&wait=10", headers=device_headers).json
+    thread.join()
+    assert time.monotonic() - start < 5
+    assert not woken["full"]
+    assert {"type": "slot_lock", "slot_number": 2, "is_locked": True} in woken["commands"]
+
+
+def test_long_poll_rejects_bad_wait(client, device_headers):
+    assert client.get("/device/commands/?since=0&wait=nan", headers=device_headers).status_code == 400
+    assert client.get("/device/commands/?since=0&wait=abc", headers=device_headers).status_code == 400
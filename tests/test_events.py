@@ -0,0 +1,111 @@
+import threading
+import time
+
+from app.utils.events import EventHub, stream_events
+
+
+def test_publish_reaches_every_subscriber():
+    hub = EventHub()
+    subs = [hub.subscribe() for _ in range(300)]
+    hub.publish("key_taken", {"key_id": "k1"})
+    for sub in subs:
+        events, reset = hub.wait(sub, 0)
+        assert [(e[1], e[2]) for e in events] == [("key_taken", {"key_id": "k1"})]
+        assert not reset
+
+
+def test_wait_times_out_without_events():
+    hub = EventHub()
+    sub = hub.subscribe()
+    start = time.monotonic()
+    assert hub.wait(sub, 0.2) == ([], False)
+    assert 0.15 <= time.monotonic() - start < 2
+
+
+def test_wait_wakes_on_publish():
+    hub = EventHub()
+    sub = hub.subscribe()
+    threading.Timer(0.1, hub.publish, ("key_returned", {"key_id": "k1"})).start()
+    start = time.monotonic()
+    events, _ = hub.wait(sub, 5)
+    assert [e[1] for e in events] == ["key_returned"]
+    assert time.monotonic() - start < 2
+
+
+def test_buffer_overflow_requests_reset():
+    hub = EventHub(buffer_size=3)
+    sub = hub.subscribe()
+    for i in range(5):
+        hub.publish("key_taken", {"n": i})
+    events, reset = hub.wait(sub, 0)
+    assert reset
+    assert [e[2]["n"] for e in events] == [2, 3, 4]
+
+
+def test_resume_from_last_event_id():
+    hub = EventHub()
+    first = hub.publish("key_taken", {"n": 1})
+    hub.publish("key_returned", {"n": 2})
+    hub.publish("key_taken", {"n": 3})
+    sub = hub.subscribe(hub.event_id(first))
+    events, reset = hub.wait(sub, 0)
+    assert not reset
+    assert [e[2]["n"] for e in events] == [2, 3]
+
+
+def test_resume_with_foreign_or_evicted_id_resets():
+    hub = EventHub(history_size=2)
+    first = hub.publish("key_taken", {"n": 1})
+    for i in range(3):
+        hub.publish("key_taken", {"n": i})
+    assert hub.wait(hub.subscribe(hub.event_id(first)), 0)[1]
+    assert hub.wait(hub.subscribe("other-1"), 0)[1]
+
+
+def test_closing_stream_unsubscribes():
+    hub = EventHub()
+    sub = hub.subscribe()
+    stream = stream_events(hub, sub, heartbeat=0.05)
+    assert next(stream) == "retry: 3000\n\n"
+    assert next(stream) == ": keep-alive\n\n"
+    assert hub.subscriber_count() == 1
+    # Клиент отключился: сервер закрывает генератор ответа
+    stream.close()
+    assert hub.subscriber_count() == 0
+
+
+def test_events_endpoint_streams_key_changes(app, client, seed, admin_headers, device_headers):
+    from app.utils.events import event_hub
+
+    response = client.get("/admin/events/", headers=admin_headers, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    assert next(chunks) == b"retry: 3000\n\n"
+
+    taken = client.post("/device/get_key/", json={"nfcId": "NFC1", "key_number": "101"}, headers=device_headers)
+    assert taken.status_code == 200
+    chunk = next(chunks).decode()
+    assert "event: key_taken" in chunk
+    assert seed["key"] in chunk
+    event_id = chunk.split("id: ", 1)[1].split("\n", 1)[0]
+    response.close()
+    assert event_hub.subscriber_count() == 0
+
+    # Переподключение с Last-Event-ID получает только пропущенные события
+    client.post(
+        "/device/return_key/", json={"nfcId": "NFC1", "keyId": seed["key"], "keySlotNumber": 1},
+        headers=device_headers,
+    )
+    response = client.get("/admin/events/", headers={**admin_headers, "Last-Event-ID": event_id}, buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    chunk = next(chunks).decode()
+    assert "event: key_returned" in chunk
+    assert "key_taken" not in chunk
+    response.close()
+
+
+def test_events_endpoint_requires_admin_token(client):
+    assert client.get("/admin/events/").status_code == 401
+    assert client.get("/admin/events/?access_token=bad").status_code == 401
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from app.utils.invalidation import InvalidationBus
+
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def test_publish_reaches_local_subscribers():
+    bus = InvalidationBus()
+    received = []
+    bus.subscribe("user", lambda entity, entity_id: received.append(("user", entity_id)))
+    bus.subscribe("*", lambda entity, entity_id: received.append(("*", entity, entity_id)))
+    bus.subscribe("key", lambda entity, entity_id: received.append(("key", entity_id)))
+    bus.publish("user", "u1")
+    assert received == [("user", "u1"), ("*", "user", "u1")]
+
+
+def test_remote_only_handlers_skip_own_messages():
+    bus = InvalidationBus()
+    received = []
+    bus.subscribe("device", lambda entity, entity_id: received.append(entity_id), remote_only=True)
+    bus.publish("device", "d1")
+    assert received == []
+    bus._receive_remote("device", "d2")
+    assert received == ["d2"]
+
+
+def test_reset_reaches_every_handler_and_errors_are_isolated():
+    bus = InvalidationBus()
+    received = []
+
+    def broken(entity, entity_id):
+        raise RuntimeError("boom")
+
+    bus.subscribe("user", broken)
+    bus.subscribe("user", lambda entity, entity_id: received.append((entity, entity_id)))
+    bus.subscribe("key", lambda entity, entity_id: received.append((entity, entity_id)))
+    bus._receive_remote("*", None)
+    assert sorted(received) == [("*", None), ("*", None)]
+
+
+def test_admin_edit_invalidates_search_index(client, seed, admin_headers):
+    assert client.get("/admin/search/?q=ivanov", headers=admin_headers).json["results"]
+    response = client.put(f"/admin/update_user/{seed['user']}/", json={"name": "Petrov"}, headers=admin_headers)
+    assert response.status_code == 200
+    # Индекс поиска в памяти подписан на шину: новое имя находится сразу, без перечитывания
+    results = client.get("/admin/search/?q=petrov", headers=admin_headers).json["results"]
+    assert [row["id"] for row in results] == [seed["user"]]
+    assert client.get("/admin/search/?q=ivanov", headers=admin_headers).json["results"] == []
+
+
+def _listen(database_url, ready, results):
+    from flask import Flask
+    from app.utils.invalidation import invalidation_bus
+
+    app = Flask(__name__)
+    app.config.update(INVALIDATION_BACKEND="postgres", SQLALCHEMY_DATABASE_URI=database_url)
+    delays = []
+
+    def on_message(entity, entity_id):
+        if entity == "*":
+            ready.release()
+        elif entity_id is None:
+            results.put(delays)
+        else:
+            delays.append(time.time() - float(entity_id))
+
+    invalidation_bus.subscribe("test", on_message)
+    invalidation_bus.init_app(app)
+    time.sleep(30)
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="TEST_POSTGRES_URL не задан")
+def test_postgres_transport_reaches_other_processes():
+    from flask import Flask
+
+    ctx = multiprocessing.get_context("spawn")
+    ready, results = ctx.Semaphore(0), ctx.Queue()
+    processes = [ctx.Process(target=_listen, args=(POSTGRES_URL, ready, results), daemon=True) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        assert ready.acquire(timeout=20)
+
+    bus = InvalidationBus()
+    app = Flask(__name__)
+    app.config.update(INVALIDATION_BACKEND="postgres", SQLALCHEMY_DATABASE_URI=POSTGRES_URL)
+    bus.init_app(app)
+    for _ in range(200):
+        bus.publish("test", repr(time.time()))
+        time.sleep(0.002)
+    bus.publish("test", None)
+
+    delays = sorted(d for _ in processes for d in results.get(timeout=20))
+    for process in processes:
+        process.terminate()
+    assert len(delays) == 200 * len(processes)
+    # Задержка LISTEN/NOTIFY - миллисекунды; порог с запасом для нагруженной машины
+    assert delays[int(len(delays) * 0.99)] < 0.5
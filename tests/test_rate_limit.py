@@ -0,0 +1,25 @@
+from app.utils.rate_limit import MemoryBucketStore
+
+
+def test_bucket_limits_burst_then_refills():
+    store = MemoryBucketStore()
+    results = [store.take("device:d1", 1000, 3)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+    allowed, wait = store.take("device:d2", 0.5, 1)
+    assert allowed and wait == 0
+    allowed, wait = store.take("device:d2", 0.5, 1)
+    assert not allowed and 1.5 < wait <= 2
+
+
+def test_overflow_evicts_least_recently_used_down_to_half():
+    store = MemoryBucketStore(max_buckets=10)
+    for i in range(10):
+        store.take(f"ip:{i}", 0.001, 5)
+    store.take("ip:0", 0.001, 5)
+    store.take("ip:new", 0.001, 5)
+    assert len(store._buckets) == 5
+    assert list(store._buckets)[-2:] == ["ip:0", "ip:new"]
+    # До следующей очистки новые ключи добавляются без неё
+    for i in range(5):
+        store.take(f"ip:more{i}", 0.001, 5)
+    assert len(store._buckets) == 10
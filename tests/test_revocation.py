@@ -0,0 +1,47 @@
+from sqlalchemy import event
+
+from app import db
+from app.models import Device, Key, Operation
+from app.utils.revocation import token_revocations
+
+
+def _init_then_delete(app, client, admin_headers):
+    """Устройство без ячеек: получает токен и удаляется через админку."""
+    with app.app_context():
+        device = Device(ip_address="10.0.0.2", auth_token="spare-secret", timeout=30)
+        db.session.add(device)
+        db.session.commit()
+        device_id = device.id
+    response = client.post("/device/init/", json={"device_id": device_id, "auth_key": "spare-secret"})
+    assert response.status_code == 200
+    headers = {"Authorization": "Bearer " + response.json["token"]}
+    response = client.delete(f"/admin/delete_device/{device_id}/", headers=admin_headers)
+    assert response.status_code == 200
+    return device_id, headers
+
+
+def test_deleted_device_token_is_revoked(app, client, seed, admin_headers):
+    _, headers = _init_then_delete(app, client, admin_headers)
+
+    response = client.post("/device/get_key/", json={"key_number": "101", "nfcId": "NFC1"}, headers=headers)
+    assert response.status_code == 401
+
+
+def test_missed_revocation_is_caught_on_commit(app, client, seed, admin_headers, monkeypatch):
+    # На SQLite внешние ключи проверяются только с PRAGMA foreign_keys
+    with app.app_context():
+        @event.listens_for(db.engine, "connect")
+        def _foreign_keys(dbapi_connection, _):
+            dbapi_connection.execute("PRAGMA foreign_keys=ON")
+        db.engine.dispose()
+    device_id, headers = _init_then_delete(app, client, admin_headers)
+    # Другой воркер, до которого отзыв ещё не дошёл
+    monkeypatch.setattr(token_revocations, "is_revoked", lambda device_id, issued_at: False)
+
+    response = client.post("/device/get_key/", json={"key_number": "101", "nfcId": "NFC1"}, headers=headers)
+    assert response.status_code == 401
+    with app.app_context():
+        assert Operation.query.count() == 0
+        assert not Key.query.filter_by(key_number="101").one().is_taken
+    monkeypatch.undo()
+    assert token_revocations.is_revoked(device_id, 0)
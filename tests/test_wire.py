@@ -0,0 +1,81 @@
+import json
+from datetime import datetime
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+from app.utils.serializers import OrjsonProvider, orjson
+
+msgpack = pytest.importorskip("msgpack")
+cbor2 = pytest.importorskip("cbor2")
+
+FORMATS = {
+    "application/json": (lambda body: json.dumps(body).encode(), json.loads),
+    "application/msgpack": (msgpack.packb, lambda data: msgpack.unpackb(data, raw=False)),
+    "application/cbor": (cbor2.dumps, cbor2.loads),
+}
+
+
+@pytest.mark.parametrize("request_type", FORMATS)
+@pytest.mark.parametrize("response_type", FORMATS)
+def test_auth_card_round_trip(client, seed, device_headers, request_type, response_type):
+    dumps = FORMATS[request_type][0]
+    loads = FORMATS[response_type][1]
+    response = client.post(
+        "/device/auth_card/", data=dumps({"nfcId": "NFC1"}),
+        headers={**device_headers, "Content-Type": request_type, "Accept": response_type},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == response_type
+    body = loads(response.data)
+    assert body["status"] == "success"
+    assert [key["key_number"] for key in body["available_keys"]] == ["101"]
+
+
+def test_get_key_with_msgpack_and_error_in_requested_format(client, seed, device_headers):
+    headers = {**device_headers, "Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+    body = msgpack.packb({"nfcId": "NFC1", "key_number": "101"})
+    taken = client.post("/device/get_key/", data=body, headers=headers)
+    assert msgpack.unpackb(taken.data, raw=False)["keyUuid"] == seed["key"]
+    again = client.post("/device/get_key/", data=body, headers=headers)
+    assert again.status_code == 400
+    assert again.mimetype == "application/msgpack"
+    assert msgpack.unpackb(again.data, raw=False)["status"] == "error"
+
+
+def test_accept_quality_and_default(client, seed, device_headers):
+    body = json.dumps({"nfcId": "NFC1"})
+    headers = {**device_headers, "Content-Type": "application/json"}
+    preferred = client.post(
+        "/device/auth_card/", data=body,
+        headers={**headers, "Accept": "application/json;q=0.5, application/cbor"},
+    )
+    assert preferred.mimetype == "application/cbor"
+    assert client.post("/device/auth_card/", data=body, headers=headers).mimetype == "application/json"
+    unknown = client.post("/device/auth_card/", data=body, headers={**headers, "Accept": "text/csv"})
+    assert unknown.mimetype == "application/json"
+
+
+@pytest.mark.parametrize("content_type, data", [
+    ("application/msgpack", b"\xc1"),
+    ("application/msgpack", msgpack.packb([1, 2])),
+    ("application/cbor", b"\xff\xff"),
+    ("application/cbor", cbor2.dumps("text")),
+    ("application/json", b"{broken"),
+])
+def test_malformed_body_is_rejected(client, seed, device_headers, content_type, data):
+    response = client.post(
+        "/device/get_key/", data=data, headers={**device_headers, "Content-Type": content_type}
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson не установлен")
+def test_orjson_provider_matches_default_json(app):
+    payload = {"b": 1, "a": [None, True, 1.5], "at": datetime(2025, 1, 2, 3, 4, 5), "name": "Иванов"}
+    with app.app_context():
+        fast = OrjsonProvider(app).response(payload)
+        standard = DefaultJSONProvider(app).response(payload)
+    assert fast.mimetype == standard.mimetype
+    assert json.loads(fast.data) == json.loads(standard.data)
+    assert list(json.loads(fast.data)) == sorted(payload)